@@ -6,6 +6,8 @@ Plots histogram, time-domain and spectral snapshot of the ADC values in realtime
 '''
 '''
 Revisions:
+2013-03-07      Overlapped spectrum averaging. Don't re-read the RF gain for every plot.
+2013-03-04      Optionally read captures from the corr_snap_daemon ring buffer.
 2011-04-04  JRM Overhaul. Merge with RFI system's time domain to include histogram and spectrum plot.
 2011-03-xx  JRM Misc modifications, feature additions etc
 2011-02-24  JRM Port to RFI system
@@ -71,7 +73,7 @@ def drawDataCallback(n_samples,indep,trig_level):
     subplots[0].set_xlabel('ADC sample bins.')
     matplotlib.pyplot.ylim(ymax = (max(histData) * 1.05))            
 
-    cal_data=c.calibrate_adc_snapshot(ant_str,raw_data=unpackedData,n_chans=n_chans)
+    cal_data=c.calibrate_adc_snapshot(ant_str,raw_data=unpackedData,n_chans=n_chans,overlap=opts.overlap,rf_gain=rf_gain)
     calData=cal_data['adc_v']*1000
     max_lev =numpy.max(numpy.abs(calData))
     abs_levs=numpy.abs(unpackedData)
@@ -119,7 +121,7 @@ def drawDataCallback(n_samples,indep,trig_level):
 
     subplots[2].cla()
 
-    empty_spec=c.calibrate_adc_snapshot(ant_str,raw_data=unpackedData[0:max_pos-1],n_chans=n_chans)
+    empty_spec=c.calibrate_adc_snapshot(ant_str,raw_data=unpackedData[0:max_pos-1],n_chans=n_chans,overlap=opts.overlap,rf_gain=rf_gain)
     emptySpectrum=empty_spec['spectrum_dbm']
     fullSpectrum=cal_data['spectrum_dbm']
     freqs=cal_data['freqs']
@@ -139,10 +141,17 @@ def drawDataCallback(n_samples,indep,trig_level):
 
 # the function that gets data given a required polarisation
 def getUnpackedData(trig_level=-1):
+    global last_seq
     # get the data
-    adc_snap_raw = corr.snap.get_adc_snapshots(c,[ant_str],trig_level=trig_level,sync_to_pps=False)[ant_str]
+    if opts.ring:
+        # read from the acquisition daemon rather than triggering the hardware ourselves
+        adc_snap_raw = corr.snap_acq.get_adc_snapshot_ring(c,ant_str,newer_than=last_seq)
+        last_seq = adc_snap_raw['seq']
+        timestamp = adc_snap_raw['timestamp']
+    else:
+        adc_snap_raw = corr.snap.get_adc_snapshots(c,[ant_str],trig_level=trig_level,sync_to_pps=False)[ant_str]
+        timestamp=c.time_from_mcnt(adc_snap_raw['timestamp'])
     unpackedBytes = adc_snap_raw['data']
-    timestamp=c.time_from_mcnt(adc_snap_raw['timestamp'])
     stat=c.feng_status_get(opts.antAndPol)
     stat.update(c.adc_amplitudes_get(antpols=[ant_str])[ant_str]) 
 
@@ -184,12 +193,17 @@ if __name__ == '__main__':
     #    help = 'Choose the units for y-axis in freq plots. Options include dBuV,dBm. Default:dBm')
     p.add_option('-c', '--n_chans', dest = 'n_chans', type='int', default = 1024, 
         help = 'Number of frequency channels to resolve in software FFT. Default:1024')
+    p.add_option('-o', '--overlap', dest = 'overlap', type='float', default = 0.5, 
+        help = 'Fractional overlap of the FFT segments averaged in the software spectrum. Default:0.5')
     p.add_option('-a', '--antenna', dest = 'antAndPol', action = 'store', help = 'Specify an antenna and pol for which to get ADC histograms. 3x will give pol     x for antenna three. 27y will give pol y for antenna 27.')
     p.add_option('-l', '--trig_level', dest = 'trig_level', type='int', default = 0, 
         help = 'Ask the hardware to wait for a signal with at least this amplitude (in ADC counts) before capturing. Valid range: 0-127. Default:0')
+    p.add_option('-r', '--ring', dest = 'ring', action = 'store_true', default=False,
+        help = 'Read captures from the ring buffer of a running corr_snap_daemon.py instead of triggering the snap block. Trigger level is then set by the daemon.')
     p.set_description(__doc__)
     opts, args = p.parse_args(sys.argv[1:])
     verbose=opts.verbose
+    last_seq=0
     n_chans=opts.n_chans
     if opts.file: filename=opts.file
     else: filename=None
@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+"""Benchmarks correlator control operations (see corr.bench) against fake ROACHes on this machine, for a range of board counts and network latencies.
+
+Results are printed and, with -o, appended to a JSON lines file. With -C, they are compared with an earlier results file, and the script exits with status 1 if any scenario got slower (by more than -t) or needed more KATCP requests.
+
+Revs:
+2013-03-28  Initial.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import corr, sys, logging
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('%prog [options] [CONFIG_FILE]')
+    p.set_description(__doc__)
+    p.add_option('-s', '--scenarios', dest = 'scenarios', type = 'string', default = ','.join(sorted(corr.bench.SCENARIOS.keys())),
+        help = 'Comma separated list of scenarios to run. Default: %s.' % ','.join(sorted(corr.bench.SCENARIOS.keys())))
+    p.add_option('-b', '--boards', dest = 'boards', type = 'string', default = '1x1,2x2,4x4,8x8',
+        help = 'Comma separated list of board counts to run on, as FxX (F engine boards x X engine boards). Default: 1x1,2x2,4x4,8x8.')
+    p.add_option('-l', '--latencies', dest = 'latencies', type = 'string', default = '0',
+        help = 'Comma separated list of reply latencies to run with, in milliseconds. Default: 0.')
+    p.add_option('-j', '--jitter', dest = 'jitter', type = 'float', default = 0.0,
+        help = 'Random extra reply latency, up to this many milliseconds. Default: 0.')
+    p.add_option('-r', '--repeats', dest = 'repeats', type = 'int', default = 5,
+        help = 'Number of times to run each scenario. Default: 5.')
+    p.add_option('-p', '--port', dest = 'port', type = 'int', default = 7147,
+        help = 'KATCP port for the fake boards. Default: 7147.')
+    p.add_option('-o', '--output', dest = 'output', type = 'string', default = None,
+        help = 'Append the results to this JSON lines file.')
+    p.add_option('-C', '--compare', dest = 'compare', type = 'string', default = None,
+        help = 'Compare the results with those in this file.')
+    p.add_option('-t', '--tolerance', dest = 'tolerance', type = 'float', default = 0.2,
+        help = 'Fractional increase in median time counted as a regression by -C. Default: 0.2.')
+    opts, args = p.parse_args(sys.argv[1:])
+
+logging.basicConfig(level = logging.INFO)
+
+boards = [tuple([int(n) for n in b.split('x')]) for b in opts.boards.split(',')]
+latencies = [float(l) / 1e3 for l in opts.latencies.split(',')]
+results = corr.bench.bench_suite(opts.scenarios.split(','), boards, latencies = latencies, jitter = opts.jitter / 1e3,
+    repeats = opts.repeats, filename = opts.output, template = args[0] if len(args) > 0 else None, port = opts.port)
+
+print('%-18s %6s %8s %10s %10s %10s %10s %10s %12s %7s' % ('scenario', 'boards', 'lat (ms)', 'p50 (s)', 'p90 (s)', 'max (s)',
+    'requests', 'kB in', 'kB out', 'errors'))
+for r in results:
+    print('%-18s %6s %8.1f %10.4f %10.4f %10.4f %10i %10.1f %12.1f %7i' % (r['scenario'], '%ix%i' % (r['n_f'], r['n_x']),
+        r['latency'] * 1e3, r['p50'], r['p90'], r['max'], r['requests'] // r['repeats'], r['bytes_in'] / 1024. / r['repeats'],
+        r['bytes_out'] / 1024. / r['repeats'], len(r['errors'])))
+
+if opts.compare != None:
+    regressions = 0
+    for cmp in corr.bench.results_compare(corr.bench.results_load(opts.compare), results, tolerance = opts.tolerance):
+        print('%-18s %6s %8.1f: median %.4f -> %.4f s (x%.2f), %i -> %i requests%s' % (cmp['scenario'], '%ix%i' % (cmp['n_f'],
+            cmp['n_x']), cmp['latency'] * 1e3, cmp['old_p50'], cmp['new_p50'], cmp['time_ratio'], cmp['old_requests'],
+            cmp['new_requests'], ' REGRESSION' if cmp['regression'] else ''))
+        regressions += cmp['regression']
+    if regressions > 0:
+        sys.exit(1)
@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+"""Runs fake ROACHes (see corr.fake_roach.FakeRoach): KATCP servers answering as tcpborphserver does, from in-memory registers, for testing and benchmarking control software without hardware.
+
+The boards listen on the KATCP port at consecutive loopback addresses, starting at 127.0.0.1 by default, so a correlator config file listing those addresses as its servers can be run against them.
+
+Revs:
+2013-03-28  Initial.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import corr, sys, time, logging
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('%prog [options] [REGISTER_MAP]')
+    p.set_description(__doc__)
+    p.add_option('-n', '--n_roaches', dest = 'n_roaches', type = 'int', default = 1,
+        help = 'Number of boards to run. Default: 1.')
+    p.add_option('-i', '--ip', dest = 'ip', type = 'string', default = '127.0.0.1',
+        help = 'Address of the first board. Default: 127.0.0.1.')
+    p.add_option('-p', '--port', dest = 'port', type = 'int', default = 7147,
+        help = 'KATCP port. Default: 7147.')
+    p.add_option('-b', '--bof', dest = 'bofs', type = 'string', action = 'append', default = None,
+        help = 'Name of a bof file the boards can be programmed with. Use more than once for more. Default: fake.bof.')
+    p.add_option('-l', '--latency', dest = 'latency', type = 'float', default = 0.0,
+        help = 'Delay every reply by this many seconds. Default: 0.')
+    p.add_option('-j', '--jitter', dest = 'jitter', type = 'float', default = 0.0,
+        help = 'Delay every reply by up to this many more seconds, at random. Default: 0.')
+    p.add_option('-t', '--service_time', dest = 'service_time', type = 'float', default = 0.0,
+        help = 'Seconds each request keeps the board busy. Default: 0.')
+    p.add_option('-g', '--progdev_time', dest = 'progdev_time', type = 'float', default = 0.0,
+        help = 'Seconds programming takes. Default: 0.')
+    p.add_option('-s', '--strict', dest = 'strict', action = 'store_true', default = False,
+        help = 'Refuse access to registers not in the register map, rather than creating them.')
+    p.add_option('-u', '--unprogrammed', dest = 'unprogrammed', action = 'store_true', default = False,
+        help = 'Start the boards unprogrammed.')
+    opts, args = p.parse_args(sys.argv[1:])
+
+logging.basicConfig(level = logging.INFO)
+
+roaches = corr.fake_roach.fake_roaches_start(opts.n_roaches, port = opts.port, first_host = opts.ip,
+    registers = args[0] if len(args) > 0 else {}, bofs = opts.bofs if opts.bofs != None else ['fake.bof'],
+    programmed = not opts.unprogrammed, latency = opts.latency, jitter = opts.jitter, service_time = opts.service_time,
+    progdev_time = opts.progdev_time, auto_create = not opts.strict)
+print('Running %i fake ROACHes, %s to %s on port %i. Press Ctrl-C to stop.' % (len(roaches), roaches[0].host, roaches[-1].host, opts.port))
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    for roach in roaches:
+        roach.stop()
+    print('Requests handled: %s' % ', '.join(['%s %i' % (name, sum([r.request_counts.get(name, 0) for r in roaches]))
+        for name in sorted(set(sum([list(r.request_counts.keys()) for r in roaches], [])))]))
@@ -400,6 +400,23 @@ class DeviceExampleServer(katcp.DeviceServer):
         except:
             return katcp.Message.reply(orgmsg.name,'fail',"something broke. oops.")
 
+    @request(Str(),Int(default=0),Float(default=-1),include_msg=True)
+    def request_get_adc_snapshot_ring(self, sock, orgmsg, ant_str, newer_than, timeout):
+        """Returns the latest ADC snapshot for the antenna specified from the snapshot acquisition daemon's ring buffer (see corr_snap_daemon.py), without triggering the hardware.
+            \n@Param integer Only return a capture with a sequence number greater than this (default 0: the newest available).
+            \n@Param float Seconds to wait for such a capture (default -1: forever).
+            \n@reply int sequence number of the capture.
+            \n@reply int timestamp (unix milliseconds) of the capture."""
+        if self.c is None:
+            return katcp.Message.reply(orgmsg.name,"fail","... you haven't connected yet!")
+        try:
+            if not ant_str in self.c.config._get_ant_mapping_list(): 
+                return katcp.Message.reply(orgmsg.name,"fail","Antenna not found. Valid entries are %s."%str(self.c.config._get_ant_mapping_list()))
+            snap_data=corr.snap_acq.get_adc_snapshot_ring(self.c,ant_str,newer_than=newer_than,timeout=timeout)
+            return katcp.Message.reply(orgmsg.name,'ok',str(snap_data['seq']),str(int(snap_data['timestamp']*1000)),*snap_data['data'])
+        except Exception as err_msg:
+            return katcp.Message.reply(orgmsg.name,'fail',str(err_msg))
+
     @request(Str(),Int(default=1),include_msg=True)
     def request_get_quant_snapshot(self, sock, orgmsg, ant_str, n_spectra):
         """Grabs a snapshot of data from the quantiser for antenna specified. Optional: number of spectra to grab (default 1)."""
@@ -10,6 +10,7 @@ NOTE: the snap block data width is 32-bit, so that's only 2 samples x 2 pols x 4
 Author: Paul Prozesky
 
 Revisions:
+2013-03-08:     Unpacking and accumulation done with corr.spectra.
 2011-09-21: PVP Initial version.
 '''
 from __future__ import absolute_import
@@ -35,16 +36,6 @@ def exit_clean():
     except: pass
     exit()
 
-def raw2fp(num, nbits = 4):
-    return float(((numpy.int8(num << nbits) >> nbits))) / (2**(nbits-1))
-
-def unpack32bit(num):
-    pol00 = raw2fp((num >> 28) & 0x0f) + (1j * raw2fp((num >> 24) & 0x0f))
-    pol10 = raw2fp((num >> 20) & 0x0f) + (1j * raw2fp((num >> 16) & 0x0f))
-    pol01 = raw2fp((num >> 12) & 0x0f) + (1j * raw2fp((num >>  8) & 0x0f))
-    pol11 = raw2fp((num >>  4) & 0x0f) + (1j * raw2fp((num >>  0) & 0x0f))
-    return [pol00, pol01], [pol10, pol11]
-
 if __name__ == '__main__':
     from optparse import OptionParser
     p = OptionParser()
@@ -76,12 +67,7 @@ try:
     # set up the path to the corner-turner snap output
     corr.corr_functions.write_masked_register(fpgas, corr.corr_nb.register_fengine_fine_control, quant_snap_select = 2)
     reports = dict()
-    spectra = dict()
-    for n, f in enumerate(fpgas):
-        reports[n] = dict()
-        spectra[n] = dict()
-        spectra[n][0] = dict()
-        spectra[n][1] = dict()
+    spectra = corr.spectra.SpectrumAccumulator(n_chans, n_inputs = len(fpgas) * 2)
     n_xeng = 2**2
     snap_depth_w = 2**13
     values_per_fchan = 128
@@ -89,49 +75,33 @@ try:
     bytes_per_sword = 4
     sword_per_fchan = values_per_fchan / values_per_sword
     fchan_per_snap = snap_depth_w / sword_per_fchan
-    fchan_lookup = []
-    for r in range(0, n_chans / n_xeng): fchan_lookup.extend(list(range(r, n_chans, n_chans / n_xeng)))
+    fchan_lookup = numpy.arange(n_chans).reshape(n_xeng, n_chans // n_xeng).T.ravel()
     up32 = dict()
     for n, f in enumerate(fpgas): up32[n] = []
     # grab the data and decode it
     print('Grabbing and processing the spectrum data from corner-turner output snap block (offset/%i)... %5i' % (n_chans, 0), end=' ')
     for offset in range(0, n_chans / fchan_per_snap):
-    #for offset in range(0, 1):
         print(7 * '\b', '%5i' % (offset * fchan_per_snap), end=' ')
         sys.stdout.flush()
         dataFine = corr.snap.snapshots_get(fpgas, dev_names = 'fine_snap_d', man_trig = False, man_valid = False, wait_period = 3, offset = offset * snap_depth_w * 4, circular_capture = False)
-        for n, d in enumerate(dataFine['data']): up32[n].extend(list(struct.unpack('>%iI' % (snap_depth_w*4/4), d)))
+        for n, d in enumerate(dataFine['data']): up32[n].append(numpy.frombuffer(d, dtype = '>u4'))
     print('')
     # process the 32-bit numbers and unscramble the order
-    print('Processing %i frequency channels in %i x %i bytes: %5i' % (n_chans, len(up32), len(up32[0])*bytes_per_sword, 0), end=' ')
+    print('Processing %i frequency channels from %i F engines...' % (n_chans, len(up32)), end=' ')
     starttime = time.time()
-    freq_coverage = []
-    for f in range(0, len(up32[0]) / sword_per_fchan):
-        start_index = f * sword_per_fchan
-        #print '%i(%i)' % (f, fchan_lookup[f]),
-        print(7 * '\b', '%5i' % f, end=' ')
-        sys.stdout.flush()
-        for n, updata in enumerate(up32):
-            pol0 = []
-            pol1 = []
-            for r in range(0, sword_per_fchan):
-                a, b = unpack32bit(up32[n][start_index + r])
-                pol0.extend(a)
-                pol1.extend(b)
-            spectra[n][0][fchan_lookup[f]] = numpy.average(numpy.sqrt(numpy.real(pol0)**2 + numpy.imag(pol0)**2))
-            spectra[n][1][fchan_lookup[f]] = numpy.average(numpy.sqrt(numpy.real(pol1)**2 + numpy.imag(pol1)**2))
-        freq_coverage.append(fchan_lookup[f])
-    print('')
-    print('That took %i seconds.' % (time.time() - starttime))
-    for f in range(0, n_chans):
-        if not freq_coverage.__contains__(f): raise RuntimeError('Missing frequency %i.' % f)
+    for n in up32:
+        corr.spectra.ct_spectrum_add(spectra, numpy.concatenate(up32[n]), fchan_lookup, sword_per_fchan, n_bits = num_bits, pol_inputs = (n * 2, n * 2 + 1))
+    print('done. That took %.3f seconds.' % (time.time() - starttime))
+    missing = numpy.flatnonzero(~spectra.coverage()[0])
+    if len(missing) > 0: raise RuntimeError('Missing frequency %i.' % missing[0])
+    levels = spectra.mean()
     import matplotlib, pylab
-    for i in range(0, len(spectra)):
+    for i in range(0, len(fpgas)):
         matplotlib.pyplot.figure()
         matplotlib.pyplot.subplot(2, 1, 1)
-        matplotlib.pyplot.plot(list(spectra[i][0].values()))
+        matplotlib.pyplot.plot(levels[i * 2])
         matplotlib.pyplot.subplot(2, 1, 2)
-        matplotlib.pyplot.plot(list(spectra[i][1].values()))
+        matplotlib.pyplot.plot(levels[i * 2 + 1])
     matplotlib.pyplot.show()
 
 except KeyboardInterrupt:
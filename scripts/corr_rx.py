@@ -14,6 +14,15 @@
 Author: Simon Ratcliffe
 Revs:
 2010-11-26  JRM Added command-line option for autoscaling.
+2013-03-12      Added HDF5 buffering and compression options.
+2013-03-13      Added ring size option for the receive/storage pipeline.
+2013-03-14      Added receive backend option.
+2013-03-15      Added signal display frame rate option.
+2013-03-16      Added raw capture option (convert with corr_rx_raw_to_h5.py).
+2013-03-17      Added periodic receiver statistics.
+2013-03-18      One receive stream per X engine board if rx_udp_port_stride is set in the config file.
+2013-03-19      Added option to store baselines in canonical order.
+2013-03-20      Added online time/channel averaging and baseline selection options.
 """
 
 from __future__ import absolute_import
@@ -43,6 +52,110 @@ if __name__ == '__main__':
         help='Do not autoscale the data by dividing down by the number of accumulations.  Default: Scale back by n_accs.'
             ,
         )
+    p.add_option(
+        '-b',
+        '--buffer_dumps',
+        dest='buffer_dumps',
+        type='int',
+        default=16,
+        help='Number of dumps to buffer in memory between HDF5 writes. Default: 16.',
+        )
+    p.add_option(
+        '-z',
+        '--compression',
+        dest='compression',
+        type='string',
+        default=None,
+        help='Compress the HDF5 datasets with gzip, lzf or lz4 (lz4 needs hdf5plugin). Default: no compression.',
+        )
+    p.add_option(
+        '-s',
+        '--shuffle',
+        dest='shuffle',
+        action='store_true',
+        default=False,
+        help='Apply the HDF5 byte shuffle filter before compression.',
+        )
+    p.add_option(
+        '-r',
+        '--ring_slots',
+        dest='ring_slots',
+        type='int',
+        default=16,
+        help='Number of heaps that can be queued between the network and storage threads before data heaps are dropped. Default: 16.',
+        )
+    p.add_option(
+        '-k',
+        '--backend',
+        dest='backend',
+        type='string',
+        default='auto',
+        help='SPEAD receiver to use: spead2, python or auto (spead2 if it is installed). Default: auto.',
+        )
+    p.add_option(
+        '-f',
+        '--sd_rate',
+        dest='sd_rate',
+        type='float',
+        default=1.0,
+        help='Maximum number of frames per second to send to the signal display. Default: 1.',
+        )
+    p.add_option(
+        '-w',
+        '--raw',
+        dest='raw',
+        action='store_true',
+        default=False,
+        help='Record to a raw binary capture instead of HDF5, for data rates that HDF5 cannot sustain. Convert afterwards with corr_rx_raw_to_h5.py.',
+        )
+    p.add_option(
+        '-o',
+        '--reorder',
+        dest='reorder',
+        action='store_true',
+        default=False,
+        help='Store the X engine data as vis, in (channel, antenna pair, polarisation product) order, instead of the X engine baseline order.',
+        )
+    p.add_option(
+        '-T',
+        '--time_avg',
+        dest='time_avg',
+        type='int',
+        default=1,
+        help='Also store dumps averaged over this many dumps, in a separate .reduced.h5 file. Default: 1 (no averaging).',
+        )
+    p.add_option(
+        '-C',
+        '--chan_avg',
+        dest='chan_avg',
+        type='int',
+        default=1,
+        help='Also store dumps with this many adjacent channels averaged, in a separate .reduced.h5 file. Default: 1 (no averaging).',
+        )
+    p.add_option(
+        '-B',
+        '--baselines',
+        dest='baselines',
+        type='string',
+        default=None,
+        help='Comma separated list of baseline indices (antenna pair indices with -o) to keep in the reduced file. Default: all.',
+        )
+    p.add_option(
+        '-R',
+        '--reduced_only',
+        dest='reduced_only',
+        action='store_true',
+        default=False,
+        help='Only store the reduced (averaged and selected) data, not the full rate dumps.',
+        )
+    p.add_option(
+        '-t',
+        '--stats_period',
+        dest='stats_period',
+        type='float',
+        default=0,
+        help='Print receiver statistics (heap rates, losses and latencies) every this many seconds. Default: 0 (only at the end).',
+        )
     p.add_option(
         '-v',
         '--verbose',
@@ -72,11 +185,27 @@ data_port = config['rx_udp_port']
 sd_ip = config['sig_disp_ip_str']
 sd_port = config['sig_disp_port']
 mode = config['xeng_format']
+rx_backend = opts.backend
+rx_backend_kwargs = {}
+if config['rx_udp_port_stride'] > 0 and mode != 'inter':
+    print('Ignoring rx_udp_port_stride: it needs the inter X engine output format, not %s. Receiving a single stream.' % mode)
+elif config['rx_udp_port_stride'] > 0:
+    # each X engine board sends its inter format heaps to its own port: receive them in parallel and merge into full (cont format) dumps
+    rx_backend = 'multi'
+    rx_backend_kwargs = {'n_streams': len(config['servers_x']), 'port_stride': config['rx_udp_port_stride'], 'stream_backend': opts.backend}
+    mode = 'cont'
 
 filename = str(time.time()) + '.corr.h5'
+sinks = None
+if opts.raw:
+    filename = filename[0:-3]
+    sinks = [corr.rx_store.RawSink(filename)]
 
 print('Initalising SPEAD transports for %s data...' % mode)
-print('Data reception on port', data_port)
+if rx_backend == 'multi':
+    print('Data reception on %i ports from %i, every %i.' % (rx_backend_kwargs['n_streams'], data_port, rx_backend_kwargs['port_stride']))
+else:
+    print('Data reception on port', data_port)
 print('Sending Signal Display data to %s:%i.' % (sd_ip, sd_port))
 print('Storing to file %s' % filename)
 
@@ -87,14 +216,34 @@ crx = corr.rx.CorrRx(
     sd_port=sd_port,
     acc_scale=acc_scale,
     filename=filename,
+    h5_buffer_dumps=opts.buffer_dumps,
+    h5_compression=opts.compression,
+    h5_shuffle=opts.shuffle,
+    ring_slots=opts.ring_slots,
+    rx_backend=rx_backend,
+    rx_backend_kwargs=rx_backend_kwargs,
+    sd_rate=opts.sd_rate,
+    sinks=sinks,
+    bl_reorder=opts.reorder,
+    reduce_time_avg=opts.time_avg,
+    reduce_chan_avg=opts.chan_avg,
+    reduce_baselines=(None if opts.baselines == None else [int(bl) for bl in opts.baselines.split(',')]),
+    reduced_only=opts.reduced_only,
     log_level=(logging.DEBUG if verbose else logging.INFO),
     )
 try:
     crx.daemon = True
     crx.start()
+    last_stats = time.time()
     while crx.isAlive():
         time.sleep(0.1)
+        if opts.stats_period > 0 and (time.time() - last_stats) >= opts.stats_period:
+            last_stats = time.time()
+            stats = crx.stats.get()
+            print('%.1f heaps/s, %.1f MB/s. %s' % (stats['heap_rate'], stats['byte_rate'] / 1e6, crx.stats.summary()))
+            sys.stdout.flush()
     print('RX process ended.')
+    print(crx.stats.summary())
     crx.join()
 except KeyboardInterrupt:
     print('Stopping...')
@@ -0,0 +1,35 @@
+#! /usr/bin/env python
+"""Converts a raw capture made by corr_rx.py --raw (corr.rx_store.RawSink) to an HDF5 file, as corr_rx.py would have written it live.
+
+Revs:
+2013-03-16  Initial.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import corr, time, sys, os
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('%prog [options] RAW_CAPTURE_BASENAME [H5_FILE]')
+    p.set_description(__doc__)
+    p.add_option('-z', '--compression', dest = 'compression', type = 'string', default = None,
+        help = 'Compress the HDF5 datasets with gzip, lzf or lz4 (lz4 needs hdf5plugin). Default: no compression.')
+    p.add_option('-s', '--shuffle', dest = 'shuffle', action = 'store_true', default = False,
+        help = 'Apply the HDF5 byte shuffle filter before compression.')
+    opts, args = p.parse_args(sys.argv[1:])
+
+    if args == []:
+        print('Please specify the raw capture to convert (without its .raw/.idx/.items extension).')
+        exit()
+    basename = args[0]
+    if basename.endswith('.raw'):
+        basename = basename[0:-4]
+    filename = args[1] if len(args) > 1 else os.path.basename(basename) + '.h5'
+
+start_time = time.time()
+print('Converting %s to %s...' % (basename, filename), end=' ')
+sys.stdout.flush()
+n_updates = corr.rx_store.raw_to_h5(basename, filename, compression = opts.compression, shuffle = opts.shuffle)
+print('done. %i item updates in %.1f seconds.' % (n_updates, time.time() - start_time))
@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+"""Records a correlator output stream to disk, or replays a recording to a local receiver (eg corr_rx.py) for testing without hardware.
+
+record: saves the UDP packets arriving on the port to BASENAME.pkts/.pidx, until nothing arrives for a few seconds.
+packets: replays a packet recording.
+heaps: replays a raw heap capture made by corr_rx.py --raw (BASENAME.raw/.idx/.items), re-encoded as SPEAD heaps.
+
+Replay keeps the recorded timing by default. Use -x to speed it up, or -x 0 to send as fast as possible and find the receiver's limit.
+
+Revs:
+2013-03-21  Initial.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import corr, time, sys, logging
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('%prog [options] record|packets|heaps BASENAME')
+    p.set_description(__doc__)
+    p.add_option('-i', '--ip', dest = 'ip', type = 'string', default = '127.0.0.1',
+        help = 'IP address to replay to. Default: 127.0.0.1.')
+    p.add_option('-p', '--port', dest = 'port', type = 'int', default = 7148,
+        help = 'UDP port to record from or replay to. Default: 7148.')
+    p.add_option('-x', '--speedup', dest = 'speedup', type = 'float', default = 1.0,
+        help = 'Replay this many times faster than recorded. 0: as fast as possible. Default: 1.')
+    p.add_option('-l', '--loops', dest = 'loops', type = 'int', default = 1,
+        help = 'Number of times to replay a packet recording. Default: 1.')
+    p.add_option('-t', '--idle_timeout', dest = 'idle_timeout', type = 'float', default = 2.0,
+        help = 'Stop recording after this many seconds without packets. Default: 2.')
+    p.add_option('-n', '--max_packets', dest = 'max_packets', type = 'int', default = None,
+        help = 'Stop recording after this many packets. Default: no limit.')
+    opts, args = p.parse_args(sys.argv[1:])
+
+    if len(args) < 2 or args[0] not in ['record', 'packets', 'heaps']:
+        print('Please specify record, packets or heaps, and the capture basename.')
+        exit()
+    mode, basename = args[0], args[1]
+
+logging.basicConfig(level = logging.INFO)
+
+try:
+    if mode == 'record':
+        rec = corr.rx_replay.PacketRecorder(opts.port, basename, idle_timeout = opts.idle_timeout, max_packets = opts.max_packets)
+        print('Recording packets from port %i. Press Ctrl-C to stop.' % opts.port)
+        try:
+            rec.record()
+        except KeyboardInterrupt:
+            rec.stop()
+        print('Recorded %i packets, %i bytes.' % (rec.n_packets, rec.n_bytes))
+    else:
+        if mode == 'packets':
+            stats = corr.rx_replay.replay_packets(basename, opts.ip, opts.port, speedup = opts.speedup, loops = opts.loops)
+        else:
+            stats = corr.rx_replay.replay_heaps(basename, opts.ip, opts.port, speedup = opts.speedup)
+        print('Sent %i %s (%i bytes) in %.3f seconds: %.1f per second, %.3f Gb/s, %.1f times real time.' % (stats['count'], mode,
+            stats['bytes'], stats['elapsed'], stats['rate'], stats['bits_per_second'] / 1e9, stats['speedup_achieved']))
+except KeyboardInterrupt:
+    print('Stopped.')
@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+"""Streams simulated X engine output (see corr.sim.CorrSimulator) as SPEAD heaps, for load testing receivers (eg corr_rx.py) without hardware.
+
+Dumps are sent at the simulated correlator's own rate by default. Use -x to send faster, or -x 0 to send as fast as possible.
+
+Revs:
+2013-03-27  Initial.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import corr, sys, logging
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('%prog [options]')
+    p.set_description(__doc__)
+    p.add_option('-i', '--ip', dest = 'ip', type = 'string', default = '127.0.0.1',
+        help = 'IP address to send to. Default: 127.0.0.1.')
+    p.add_option('-p', '--port', dest = 'port', type = 'int', default = 7148,
+        help = 'UDP port to send to. Default: 7148.')
+    p.add_option('-n', '--n_dumps', dest = 'n_dumps', type = 'int', default = 100,
+        help = 'Number of dumps to send. Default: 100.')
+    p.add_option('-x', '--speedup', dest = 'speedup', type = 'float', default = 1.0,
+        help = 'Send this many times faster than the simulated correlator. 0: as fast as possible. Default: 1.')
+    p.add_option('-a', '--n_ants', dest = 'n_ants', type = 'int', default = 8,
+        help = 'Number of dual polarisation antennas. Default: 8.')
+    p.add_option('-c', '--n_chans', dest = 'n_chans', type = 'int', default = 1024,
+        help = 'Number of frequency channels. Default: 1024.')
+    p.add_option('-e', '--n_xeng', dest = 'n_xeng', type = 'int', default = 8,
+        help = 'Number of X engines. Default: 8.')
+    p.add_option('-f', '--format', dest = 'xeng_format', type = 'string', default = 'inter',
+        help = 'X engine output format, inter or cont. Default: inter.')
+    p.add_option('-A', '--n_accs', dest = 'n_accs', type = 'int', default = 4096,
+        help = 'Number of spectra accumulated per dump, sets the dump rate. Default: 4096.')
+    p.add_option('-r', '--correlation', dest = 'correlation', type = 'float', default = 0.1,
+        help = 'Fraction of the noise common to all inputs. Default: 0.1.')
+    p.add_option('-s', '--n_streams', dest = 'n_streams', type = 'int', default = 1,
+        help = 'Spread the X engines over this many ports, as with one port per X engine board. Default: 1.')
+    p.add_option('-d', '--port_stride', dest = 'port_stride', type = 'int', default = 1,
+        help = 'Spacing of the ports used with -s. Default: 1.')
+    opts, args = p.parse_args(sys.argv[1:])
+
+logging.basicConfig(level = logging.INFO)
+
+try:
+    sim = corr.sim.CorrSimulator(n_ants = opts.n_ants, n_chans = opts.n_chans, n_xeng = opts.n_xeng, xeng_format = opts.xeng_format,
+        n_accs = opts.n_accs, correlation = opts.correlation)
+    print('Sending %i dumps of %i channels and %i baselines, one every %.3f seconds in real time, to %s:%i.' % (opts.n_dumps,
+        opts.n_chans, sim.n_bls, sim.int_time, opts.ip, opts.port))
+    stats = sim.stream(opts.ip, opts.port, n_dumps = opts.n_dumps, speedup = opts.speedup, n_streams = opts.n_streams,
+        port_stride = opts.port_stride)
+    print('Sent %i heaps in %i packets (%i bytes of data) in %.3f seconds: %.3f Gb/s, %.1f times real time.' % (stats['heaps'],
+        stats['packets'], stats['bytes'], stats['elapsed'], stats['bits_per_second'] / 1e9, stats['realtime']))
+except KeyboardInterrupt:
+    print('Stopped.')
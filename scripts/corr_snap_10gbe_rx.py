@@ -10,6 +10,7 @@ Revs:
 2010-07-23: JRM Ported for cor-0.5.5
                 Added option to capture from core other than 0.
 2011-06-30: PVP Updated to use new snapshot blocks and snap class.
+2013-03-11:     Packet analysis done with array operations by snap.xeng_rx_packets_decode.
 
 '''
 from __future__ import absolute_import
@@ -33,73 +34,6 @@ def exit_clean():
     except: pass
     exit()
 
-def unpack(f, hdr_index, pkt_len):
-    hdr_64bit = snap_data[f]['data'][hdr_index].data
-    pkt_mcnt = hdr_64bit >> 16
-    pkt_ant = hdr_64bit & ((2**16) - 1)
-    pkt_freq = pkt_mcnt % c.config['n_chans']
-    pkt_xeng = pkt_freq / (c.config['n_chans'] / c.config['n_xeng'])
-
-    sum_polQ_r = 0
-    sum_polQ_i = 0
-    sum_polI_r = 0
-    sum_polI_i = 0
-
-    # average the packet contents - ignore first entry (header)
-    for pkt_index in range(1, pkt_len):
-        pkt_64bit = snap_data[f]['data'][hdr_index + pkt_index].data
-        for offset in range(0, 64, 16):
-            polQ_r = (pkt_64bit & ((2**(offset+16)) - (2**(offset+12))))>>(offset+12)
-            polQ_i = (pkt_64bit & ((2**(offset+12)) - (2**(offset+8))))>>(offset+8)
-            polI_r = (pkt_64bit & ((2**(offset+8)) - (2**(offset+4))))>>(offset+4)
-            polI_i = (pkt_64bit & ((2**(offset+4)) - (2**(offset))))>>offset
-            #square each number and then sum it
-            sum_polQ_r += (float(((numpy.int8(polQ_r << 4)>> 4)))/(2**binary_point))**2
-            sum_polQ_i += (float(((numpy.int8(polQ_i << 4)>> 4)))/(2**binary_point))**2
-            sum_polI_r += (float(((numpy.int8(polI_r << 4)>> 4)))/(2**binary_point))**2
-            sum_polI_i += (float(((numpy.int8(polI_i << 4)>> 4)))/(2**binary_point))**2
-
-    num_accs = (pkt_len-1)*(64/16)
-
-    level_polQ_r = numpy.sqrt(float(sum_polQ_r)/ num_accs)
-    level_polQ_i = numpy.sqrt(float(sum_polQ_i)/ num_accs)
-    level_polI_r = numpy.sqrt(float(sum_polI_r)/ num_accs)
-    level_polI_i = numpy.sqrt(float(sum_polI_i)/ num_accs)
-
-    rms_polQ = numpy.sqrt(((level_polQ_r)**2)  +  ((level_polQ_i)**2))
-    rms_polI = numpy.sqrt(((level_polI_r)**2)  +  ((level_polI_i)**2))
-
-    if level_polQ_r < 1.0/(2**num_bits):
-        ave_bits_used_Q_r = 0
-    else:
-        ave_bits_used_Q_r = numpy.log2(level_polQ_r*(2**binary_point))
-
-    if level_polQ_i < 1.0/(2**num_bits):
-        ave_bits_used_Q_i = 0
-    else:
-        ave_bits_used_Q_i = numpy.log2(level_polQ_i*(2**binary_point))
-
-    if level_polI_r < 1.0/(2**num_bits):
-        ave_bits_used_I_r = 0
-    else:
-        ave_bits_used_I_r = numpy.log2(level_polI_r*(2**binary_point))
-
-    if level_polI_i < 1.0/(2**num_bits):
-        ave_bits_used_I_i = 0
-    else:
-        ave_bits_used_I_i = numpy.log2(level_polI_i*(2**binary_point))
-
-    return {'pkt_mcnt': pkt_mcnt,\
-            'pkt_ant':  pkt_ant,\
-            'pkt_freq': pkt_freq,\
-            'pkt_xeng': pkt_xeng,\
-            'rms_polQ': rms_polQ,\
-            'rms_polI': rms_polI,\
-            'ave_bits_used_Q_r':    ave_bits_used_Q_r,\
-            'ave_bits_used_Q_i':    ave_bits_used_Q_i,\
-            'ave_bits_used_I_r':    ave_bits_used_I_r,\
-            'ave_bits_used_I_i':    ave_bits_used_I_i}
-
 if __name__ == '__main__':
     from optparse import OptionParser
 
@@ -146,7 +80,7 @@ try:
     print('------------------------')
 
     print('Grabbing and unpacking snap data... ', end=' ')
-    snap_data = corr.snap.get_gbe_rx_snapshot(c)
+    snap_data = corr.snap.get_gbe_rx_snapshot(c, as_arrays = True)
     print('done.')
 
     binary_point = c.config['feng_fix_pnt_pos']
@@ -167,103 +101,86 @@ try:
     #        ant += n_ants_per_xaui
 
     report = dict()
-    mcnts = dict()
     print('Analysing packets:')
     for s in snap_data:
-        f = s['fpga_index']        
+        f = s['fpga_index']
+        d = s['data']
         report[f] = dict()
-        mcnts[f] = dict()
         report[f]['pkt_total'] = 0
-        pkt_len = 0
-        prev_eof_index = -1
         report[f]['fpga_index'] = f
-        fpga = c.xfpgas[f]
 
-        for i in range(len(s['data'])):
-            if opts.verbose or opts.raw:
-                pkt_64bit = snap_data[f]['data'][i].data
-                print('[%s] IDX: %4i Contents: %016x' % (c.xsrvs[f], i, pkt_64bit), end=' ')
-                if s['data'][i].led_rx: print('[rx_data]', end=' ')
-                if s['data'][i].valid: print('[valid]', end=' ')
-                if s['data'][i].ack: print('[rd_ack]', end=' ')
-                if not s['data'][i].led_up: print('[LNK DN]', end=' ')
-                if s['data'][i].bad_frame: print('[BAD FRAME]', end=' ')
-                if s['data'][i].overflow: print('[OVERFLOW]', end=' ')
-                if s['data'][i].eof: print('[eof]', end=' ')
+        if opts.verbose or opts.raw:
+            for i in range(len(d['data'])):
+                print('[%s] IDX: %4i Contents: %016x' % (c.xsrvs[f], i, d['data'][i]), end=' ')
+                if d['led_rx'][i]: print('[rx_data]', end=' ')
+                if d['valid'][i]: print('[valid]', end=' ')
+                if d['ack'][i]: print('[rd_ack]', end=' ')
+                if not d['led_up'][i]: print('[LNK DN]', end=' ')
+                if d['bad_frame'][i]: print('[BAD FRAME]', end=' ')
+                if d['overflow'][i]: print('[OVERFLOW]', end=' ')
+                if d['eof'][i]: print('[eof]', end=' ')
                 print('')
-
-            if s['data'][i].eof and not opts.raw:
-                pkt_ip_str = corr.corr_functions.ip2str(s['data'][i].ip_addr)
-                print('[%s] EOF at %4i. Src: %12s. Len: %3i. ' % (c.xsrvs[f], i, pkt_ip_str, i - prev_eof_index), end=' ')
-                report[f]['pkt_total'] += 1
-                hdr_index = prev_eof_index + 1
-                pkt_len = i - prev_eof_index
-                prev_eof_index = i
-
-                if 'dest_ips' not in report[f]:
-                    report[f].update({'dest_ips': {pkt_ip_str: 1}})
-                elif pkt_ip_str in report[f]['dest_ips']:
-                    report[f]['dest_ips'][pkt_ip_str] += 1
-                else:
-                    report[f]['dest_ips'].update({pkt_ip_str: 1})
-
-                if pkt_len != packet_len + 1:
-                    print('[BAD PKT LEN]')
-                    if 'bad_pkt_len' not in report[f]:
-                        report[f]['bad_pkt_len'] = 1
-                    else:
-                        report[f]['bad_pkt_len'] += 1
-                else:
-                    unpkd_pkt = unpack(f, hdr_index, pkt_len)
-                    
-                    # Record the reception of the packet for this antenna, with this mcnt
-                    try: mcnts[f][unpkd_pkt['pkt_mcnt']][unpkd_pkt['pkt_ant']] = i
-                    except: 
-                        mcnts[f][unpkd_pkt['pkt_mcnt']] = numpy.ones(n_ants,numpy.int) * (-1)
-                        mcnts[f][unpkd_pkt['pkt_mcnt']][unpkd_pkt['pkt_ant']] = i
-                    #print mcnts
-
-                    print('HDR @ %4i. MCNT %12u. Ant: %3i. Freq: %4i. Xeng: %2i, 4 bit power: PolQ: %4.2f, PolI: %4.2f' % (hdr_index, unpkd_pkt['pkt_mcnt'], unpkd_pkt['pkt_ant'], unpkd_pkt['pkt_freq'], unpkd_pkt['pkt_xeng'], unpkd_pkt['rms_polQ'], unpkd_pkt['rms_polI']))
-
-                    if 'Antenna%i' % unpkd_pkt['pkt_ant'] not in report[f]:
-                        report[f]['Antenna%i' % unpkd_pkt['pkt_ant']] = 1
-                    else:
-                        report[f]['Antenna%i' % unpkd_pkt['pkt_ant']] += 1
-
-        rcvd_mcnts = list(mcnts[f].keys())
-        rcvd_mcnts.sort()
-
-        if opts.verbose: print('[%s] Received mcnts: ' % c.xsrvs[f], rcvd_mcnts)
+        if opts.raw:
+            continue
+
+        pkts = corr.snap.xeng_rx_packets_decode(d, c.config['n_chans'], c.config['n_xeng'], pkt_len = packet_len, bin_pt = binary_point, n_bits = num_bits)
+        pkt_ip_strs = [corr.corr_functions.ip2str(int(ip)) for ip in pkts['ip_addr']]
+        good = ~pkts['bad_len'] & (pkts['antbase'] < n_ants)
+        for p in range(len(pkts['eof_index'])):
+            print('[%s] EOF at %4i. Src: %12s. Len: %3i. ' % (c.xsrvs[f], pkts['eof_index'][p], pkt_ip_strs[p], pkts['n_words'][p] + 1), end=' ')
+            if pkts['bad_len'][p]:
+                print('[BAD PKT LEN]')
+            else:
+                print('HDR @ %4i. MCNT %12u. Ant: %3i. Freq: %4i. Xeng: %2i, 4 bit power: PolQ: %4.2f, PolI: %4.2f' % (pkts['hdr_index'][p], pkts['mcnt'][p],
+                    pkts['antbase'][p], pkts['freq_chan'][p], pkts['x_eng'][p], pkts['rms'][p][0], pkts['rms'][p][1]))
+
+        report[f]['pkt_total'] = len(pkts['eof_index'])
+        if report[f]['pkt_total'] > 0:
+            report[f]['dest_ips'] = dict([(ip, pkt_ip_strs.count(ip)) for ip in set(pkt_ip_strs)])
+        if pkts['bad_len'].any():
+            report[f]['bad_pkt_len'] = int(pkts['bad_len'].sum())
+        ants, ant_cnts = numpy.unique(pkts['antbase'][~pkts['bad_len']], return_counts = True)
+        for ant, cnt in zip(ants, ant_cnts):
+            report[f]['Antenna%i' % ant] = int(cnt)
+
+        # Record the EOF index of the packet received for each antenna, for every mcnt (-1 where nothing was received)
+        rcvd_mcnts, mcnt_row = numpy.unique(pkts['mcnt'][good], return_inverse = True)
+        mcnts = numpy.ones((len(rcvd_mcnts), n_ants), dtype = int) * (-1)
+        mcnts[mcnt_row, pkts['antbase'][good].astype(int)] = pkts['eof_index'][good]
+
+        if opts.verbose: print('[%s] Received mcnts: ' % c.xsrvs[f], list(rcvd_mcnts))
         report[f]['min_pkt_latency'] = 99999999
         report[f]['max_pkt_latency'] = -1
 
-        for mcnt in rcvd_mcnts[2: -2]:
-            if c.config['feng_out_type'] == 'xaui':
-                # simulate the reception of the loopback antenna's mcnts, but only for the x engines that actually have connected f engines:
-                if f < x_with_connected_cables:
-                    print('Replacing antennas on FPGA %s for mcnt %i' % (c.xsrvs[f], mcnt))
-                    for a in range(base_ants[f][opts.core_n],base_ants[f][opts.core_n] + c.config['n_ants_per_xaui']):
-                        mcnts[f][mcnt][a] = mcnts[f][mcnt].max()
-
-            # find the min and max indices of each mcnt:
-            max_mcnt = mcnts[f][mcnt].max() / pkt_len
-            min_mcnt = mcnts[f][mcnt].min() / pkt_len
-
-            # check to ensure that we received all data for each mcnt, by looking for any indices that weren't recorded:
-            if mcnts[f][mcnt].min() < 0:
-                if 'missing_mcnts' not in report[f]:  report[f]['missing_mcnts'] = [mcnt]
-                else: report[f]['missing_mcnts'].append(mcnt)
-                if opts.verbose:
-                    print("""[%s] We're missing data for mcnt %016i from antennas """ % (c.xsrvs[f], mcnt), end=' ')
-                    for ant in range(n_ants):
-                        if mcnts[f][mcnt][ant] < 0: print(ant, end=' ')
-                    print('')
-
-            # check the latencies in the mcnt values:
-            if opts.verbose: print('[%s] MCNT: %i. Max: %i, Min: %i. Diff: %i' % (c.xsrvs[f], mcnt, max_mcnt, min_mcnt, max_mcnt - min_mcnt))
-            if (max_mcnt - min_mcnt) > 0:
-                if report[f]['max_pkt_latency'] < (max_mcnt - min_mcnt) and min_mcnt >= 0: report[f]['max_pkt_latency'] = max_mcnt - min_mcnt
-                if report[f]['min_pkt_latency'] > (max_mcnt - min_mcnt) and min_mcnt >= 0: report[f]['min_pkt_latency'] = max_mcnt - min_mcnt
+        rcvd_mcnts = rcvd_mcnts[2: -2]
+        mcnts = mcnts[2: -2]
+        if c.config['feng_out_type'] == 'xaui':
+            # simulate the reception of the loopback antenna's mcnts, but only for the x engines that actually have connected f engines:
+            if f < x_with_connected_cables:
+                print('Replacing antennas on FPGA %s for %i mcnts' % (c.xsrvs[f], len(rcvd_mcnts)))
+                a = base_ants[f][opts.core_n]
+                mcnts[:, a:a + c.config['n_ants_per_xaui']] = mcnts.max(axis = 1)[:, numpy.newaxis]
+
+        # find the min and max indices of each mcnt:
+        max_mcnt = mcnts.max(axis = 1) // (packet_len + 1)
+        min_mcnt = mcnts.min(axis = 1) // (packet_len + 1)
+
+        # check to ensure that we received all data for each mcnt, by looking for any indices that weren't recorded:
+        missing = mcnts.min(axis = 1) < 0
+        if missing.any():
+            report[f]['missing_mcnts'] = list(rcvd_mcnts[missing])
+            if opts.verbose:
+                for m in numpy.flatnonzero(missing):
+                    print("""[%s] We're missing data for mcnt %016i from antennas """ % (c.xsrvs[f], rcvd_mcnts[m]), numpy.flatnonzero(mcnts[m] < 0))
+
+        # check the latencies in the mcnt values:
+        if opts.verbose:
+            for m, mcnt in enumerate(rcvd_mcnts):
+                print('[%s] MCNT: %i. Max: %i, Min: %i. Diff: %i' % (c.xsrvs[f], mcnt, max_mcnt[m], min_mcnt[m], max_mcnt[m] - min_mcnt[m]))
+        latency = (max_mcnt - min_mcnt)[((max_mcnt - min_mcnt) > 0) & (min_mcnt >= 0)]
+        if len(latency) > 0:
+            report[f]['max_pkt_latency'] = int(latency.max())
+            report[f]['min_pkt_latency'] = int(latency.min())
 
     print('\n\nDone with all servers.\nSummary:\n==========================')
     for k, r in six.iteritems(report):
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+"""Continuously captures snap blocks at a fixed rate and keeps the last N captures of each in a shared-memory ring buffer.
+Other scripts can then read the captures (see corr.snap_acq) without triggering the hardware themselves.
+
+Revs:
+2013-03-04  Initial.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import corr, time, sys, logging
+
+def exit_fail():
+    print('FAILURE DETECTED. Log entries:\n', end=' ')
+    lh.printMessages()
+    print("Unexpected error:", sys.exc_info())
+    try:
+        acq.stop()
+        c.disconnect_all()
+    except: pass
+    exit()
+
+def exit_clean():
+    try:
+        acq.stop()
+        acq.join()
+        c.disconnect_all()
+    except: pass
+    exit()
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('%prog [options] [CONFIG_FILE]')
+    p.set_description(__doc__)
+    p.add_option('-a', '--antennas', dest = 'ant_strs', type = 'string', default = '',
+        help = 'Comma separated list of antennas whose ADC snap blocks to capture. Default: all.')
+    p.add_option('-s', '--snap', dest = 'snaps', type = 'string', default = '',
+        help = 'Comma separated list of additional snap block names to capture on every F engine (eg quant_snap0,snap_xaui0).')
+    p.add_option('-x', '--xsnap', dest = 'xsnaps', type = 'string', default = '',
+        help = 'Comma separated list of snap block names to capture on every X engine (eg snap_gbe_rx0).')
+    p.add_option('-r', '--rate', dest = 'rate', type = 'float', default = 1.0,
+        help = 'Capture rate in Hz. Default: 1')
+    p.add_option('-n', '--n_slots', dest = 'n_slots', type = 'int', default = 64,
+        help = 'Number of captures to keep per snap block. Default: 64')
+    p.add_option('-d', '--dir', dest = 'ring_dir', type = 'string', default = corr.snap_acq.RING_DIR,
+        help = 'Directory in which to place the ring buffer files. Default: %s' % corr.snap_acq.RING_DIR)
+    p.add_option('-v', '--verbose', dest = 'verbose', action = 'store_true', default = False,
+        help = 'Be verbose about errors.')
+    opts, args = p.parse_args(sys.argv[1:])
+
+    if args == []:
+        config_file = None
+    else:
+        config_file = args[0]
+    verbose = opts.verbose
+
+lh = corr.log_handlers.DebugLogHandler(100)
+
+try:
+    print('Connecting...', end=' ')
+    c = corr.corr_functions.Correlator(config_file = config_file, log_level = logging.DEBUG if verbose else logging.INFO, connect = False, log_handler = lh)
+    c.connect()
+    print('done')
+
+    ant_strs = opts.ant_strs.split(',') if opts.ant_strs != '' else None
+    devices = corr.snap_acq.adc_snap_devices(c, ant_strs)
+    for snap_name in [s for s in opts.snaps.split(',') if s != '']:
+        devices.extend([(fpga, snap_name) for fpga in c.ffpgas])
+    for snap_name in [s for s in opts.xsnaps.split(',') if s != '']:
+        devices.extend([(fpga, snap_name) for fpga in c.xfpgas])
+
+    acq = corr.snap_acq.SnapAcquirer(devices, period = 1.0 / opts.rate, n_slots = opts.n_slots, ring_dir = opts.ring_dir,
+        log_handler = lh, log_level = logging.DEBUG if verbose else logging.INFO)
+    print('Capturing %i snap blocks at %2.2f Hz into %s. Ctrl-C to stop.' % (len(devices), opts.rate, opts.ring_dir))
+    acq.start()
+    while acq.is_alive():
+        time.sleep(1)
+        print('\r%i captures, %i errors.' % (acq.n_captures, acq.n_errors), end=' ')
+        sys.stdout.flush()
+
+except KeyboardInterrupt:
+    exit_clean()
+except:
+    exit_fail()
+exit_clean()
@@ -6,6 +6,7 @@ Grabs the contents of "snap_descramble" for analysis. Valid for rev333 and onwar
 Author: Jason Manley
 
 Rev:
+2013-03-11      Contents analysed with array operations by snap.xeng_descramble_decode.
 2011-06-27  JRM Port to new snapshot blocks
 2010-07-29  JRM Port to corr-0.5.0
                 Added more useful summary logging.
@@ -13,20 +14,10 @@ Rev:
 '''
 from __future__ import absolute_import
 from __future__ import print_function
-import corr, time, numpy, struct, sys, logging, construct
-from construct import *
+import corr, time, numpy, struct, sys, logging
 import six
 from six.moves import range
 
-# OOB signalling bit offsets - seem to be the same for wb and nb:
-data_bitstruct = construct.BitStruct("oob",
-    BitField("data", 16),
-    BitField("mcnt", 13),
-    Flag("valid"),
-    Flag("flag"),
-    Flag("received"))
-data_repeater = construct.GreedyRepeater(data_bitstruct)
-
 dev_prefix = 'snap_descramble'
 
 def exit_fail():
@@ -47,66 +38,6 @@ def exit_clean():
         pass
     exit()
 
-def xeng_in_unpack(oob, start_index):
-    sum_polQ_r = 0
-    sum_polQ_i = 0
-    sum_polI_r = 0
-    sum_polI_i = 0
-    rcvd_errs = 0
-    flag_errs = 0
-    #average the packet contents from the very first entry
-    for slice_index in range(c.config['xeng_acc_len']):
-        abs_index = start_index + slice_index
-        polQ_r = (oob[abs_index]['data'] & ((2**(16)) - (2**(12))))>>(12)
-        polQ_i = (oob[abs_index]['data'] & ((2**(12)) - (2**(8))))>>(8)
-        polI_r = (oob[abs_index]['data'] & ((2**(8)) - (2**(4))))>>(4)
-        polI_i = (oob[abs_index]['data'] & ((2**(4)) - (2**(0))))>>0
-
-        #square each number and then sum it
-        sum_polQ_r += (float(((numpy.int8(polQ_r << 4)>> 4)))/(2**binary_point))**2
-        sum_polQ_i += (float(((numpy.int8(polQ_i << 4)>> 4)))/(2**binary_point))**2
-        sum_polI_r += (float(((numpy.int8(polI_r << 4)>> 4)))/(2**binary_point))**2
-        sum_polI_i += (float(((numpy.int8(polI_i << 4)>> 4)))/(2**binary_point))**2
-
-        if not oob[abs_index]['received']: rcvd_errs += 1
-        if oob[abs_index]['flag']: flag_errs += 1
-
-    num_accs = c.config['xeng_acc_len']
-
-    level_polQ_r = numpy.sqrt(float(sum_polQ_r)/ num_accs)
-    level_polQ_i = numpy.sqrt(float(sum_polQ_i)/ num_accs)
-    level_polI_r = numpy.sqrt(float(sum_polI_r)/ num_accs)
-    level_polI_i = numpy.sqrt(float(sum_polI_i)/ num_accs)
-
-    rms_polQ = numpy.sqrt(((level_polQ_r)**2)  +  ((level_polQ_i)**2))
-    rms_polI = numpy.sqrt(((level_polI_r)**2)  +  ((level_polI_i)**2))
-
-    if level_polQ_r < 1.0/(2**num_bits):
-        ave_bits_used_Q_r = 0
-    else:
-        ave_bits_used_Q_r = numpy.log2(level_polQ_r*(2**binary_point))
-    if level_polQ_i < 1.0/(2**num_bits):
-        ave_bits_used_Q_i = 0
-    else:
-        ave_bits_used_Q_i = numpy.log2(level_polQ_i*(2**binary_point))
-    if level_polI_r < 1.0/(2**num_bits):
-        ave_bits_used_I_r = 0
-    else:
-        ave_bits_used_I_r = numpy.log2(level_polI_r*(2**binary_point))
-    if level_polI_i < 1.0/(2**num_bits):
-        ave_bits_used_I_i = 0
-    else:
-        ave_bits_used_I_i = numpy.log2(level_polI_i*(2**binary_point))
-
-    return {'rms_polQ':rms_polQ,\
-            'rms_polI':rms_polI,\
-            'rcvd_errs':rcvd_errs,\
-            'flag_errs':flag_errs,\
-            'ave_bits_used_Q_r':ave_bits_used_Q_r,\
-            'ave_bits_used_Q_i':ave_bits_used_Q_i,\
-            'ave_bits_used_I_r':ave_bits_used_I_r,\
-            'ave_bits_used_I_i':ave_bits_used_I_i}
-
 def grab_snap_data(c, dev_name):
     """
     Grab the required amount of data off the snap blocks on the x-engines.
@@ -151,16 +82,16 @@ def create_data(c, xeng_number):
     for f, fpga in enumerate(c.xfpgas):
         if snapdump['lengths'][f] == 0:
             print('Warning: got nothing back from snap block %s on %s.' % (dev_name, c.xsrvs[f]))
-        else:
-            oobdata[f] = data_repeater.parse(snapdump['data'][f])
+        oobdata[f] = corr.snap.descramble_words_unpack(snapdump['data'][f])
     print('done.')
 
     if opts.verbose:
         for f, fpga in enumerate(c.xfpgas):
             i = snapdump['offsets'][f]
-            for ir, oob in enumerate(oobdata[f]):
-                pkt_mcnt = oob['mcnt']
-                pkt_data = oob['data']
+            oob = oobdata[f]
+            for ir in range(len(oob['data'])):
+                pkt_mcnt = oob['mcnt'][ir]
+                pkt_data = oob['data'][ir]
                 exp_ant = (i / c.config['xeng_acc_len']) % c.config['n_ants']
                 xeng = (c.config['x_per_fpga'])*f + xeng_number
                 if c.config['xeng_format'] == 'inter': 
@@ -173,74 +104,58 @@ def create_data(c, xeng_number):
                 xeng_slice = i % c.config['xeng_acc_len']+1
                 print('[%s] Xeng%i BRAM IDX: %6i Valid IDX: %10i Rounded MCNT: %6i. Global MCNT: %6i. Freq %4i, Data: 0x%04x. EXPECTING: slice %3i/%3i of ant %3i, freq %3i.' % (fpga.host, \
                         xeng, ir, i, pkt_mcnt, act_mcnt, act_freq, pkt_data, xeng_slice, c.config['xeng_acc_len'], exp_ant, exp_freq), end=' ')
-                if oob['valid']: 
+                if oob['valid'][ir]: 
                     print('[VALID]', end=' ')
                     i = i + 1
-                if oob['received']:  print('[RCVD]', end=' ')
-                if oob['flag']:      print('[FLAG_BAD]', end=' ')
+                if oob['received'][ir]:  print('[RCVD]', end=' ')
+                if oob['flag'][ir]:      print('[FLAG_BAD]', end=' ')
                 print('')
 
-    #print len(dmp['data'][0])
-    #print dmp['lengths']
-
+    rep = dict()
+    plot_data = None
     if not raw_capture and not opts.circ:
         print('Analysing contents of %s...' % dev_name)
-        rep = dict()
-        mcnts = dict()
+        n_ants = c.config['n_ants']
+        n_chans = c.config['n_chans']
         freqs = []
         last_freq = -1
         if opts.plot:
-            import numpy
             plot_data = []
-            for i in range(0, c.config['n_ants']):
-                plot_data.append([numpy.zeros(c.config['n_chans']), numpy.zeros(c.config['n_chans'])])
-        else:
-            plot_data = None
+            for i in range(0, n_ants):
+                plot_data.append([numpy.zeros(n_chans), numpy.zeros(n_chans)])
         for f, fpga in enumerate(c.xfpgas):
             rep[f] = dict()
-            for i in range(0, snapdump['lengths'][f] / 4, c.config['xeng_acc_len']):        
-                pkt_mcnt = oobdata[f][i]['mcnt']
-                pkt_data = oobdata[f][i]['data']
-                exp_ant = (i / c.config['xeng_acc_len']) % c.config['n_ants']
-                xeng = (c.config['x_per_fpga']) * f + xeng_number
-                if c.config['xeng_format'] == 'inter': 
-                    exp_mcnt = ((i/c.config['xeng_acc_len'])/c.config['n_ants'])*c.config['n_xeng'] + xeng
-                    exp_freq = (i/c.config['xeng_acc_len'])/c.config['n_ants'] * c.config['n_xeng'] + ((c.config['x_per_fpga']) * f + xeng_number)
-                else:
-                    exp_mcnt = ((i/c.config['xeng_acc_len'])/c.config['n_ants'])+ xeng*(c.config['n_chans']/c.config['n_xeng'])
-                    exp_freq = (exp_mcnt) % c.config['n_chans']
-                xeng_unpkd = xeng_in_unpack(oobdata[f], i)
-                if not freqs.__contains__(exp_freq):
+            xeng = (c.config['x_per_fpga']) * f + xeng_number
+            blocks = corr.snap.xeng_descramble_decode(oobdata[f], c.config['xeng_acc_len'], n_ants, bin_pt = binary_point, n_bits = num_bits)
+            spectrum = numpy.arange(len(blocks['index'])) // n_ants
+            if c.config['xeng_format'] == 'inter': 
+                exp_freqs = spectrum * c.config['n_xeng'] + xeng
+            else:
+                exp_freqs = (spectrum + xeng * (n_chans // c.config['n_xeng'])) % n_chans
+            exp_ants = blocks['ant']
+            for b, i in enumerate(blocks['index']):
+                exp_freq = exp_freqs[b]
+                if exp_freq not in freqs:
                     if exp_freq != last_freq + 1:
                         print('Frequency jumped from %d to %d' % (last_freq, exp_freq))
                     freqs.append(exp_freq)
                     last_freq = exp_freq
-                if opts.plot:
-                    plot_data[exp_ant][0][exp_freq] = plot_data[exp_ant][0][exp_freq] + xeng_unpkd['rms_polQ']
-                    plot_data[exp_ant][1][exp_freq] = plot_data[exp_ant][1][exp_freq] + xeng_unpkd['rms_polI']
-                print('[%s] IDX: %6i. XENG: %3i. ANT: %4i. FREQ: %4i. 4 bit power: PolQ: %4.2f, PolI: %4.2f' % (fpga.host, i, xeng, exp_ant, exp_freq, xeng_unpkd['rms_polQ'], xeng_unpkd['rms_polI']), end=' ')
-                if xeng_unpkd['rcvd_errs'] > 0: 
-                    print('[%i RCV ERRS!]'%xeng_unpkd['rcvd_errs'], end=' ')
-                    if 'Rcv Errors' not in rep[f]:
-                        rep[f]['Rcv Errors ant %i'%exp_ant] = 1
-                    else:
-                        rep[f]['Rcv Errors ant %i'%exp_ant] += 1
-                if xeng_unpkd['flag_errs'] > 0: 
-                    print('[%i FLAGGED DATA]'%xeng_unpkd['flag_errs'], end=' ')
-                    if 'Flagged bad data ant %i'%exp_ant not in rep[f]:
-                        rep[f]['Flagged bad data ant %i'%exp_ant] = 1
-                    else:
-                        rep[f]['Flagged bad data ant %i'%exp_ant] += 1
-                if xeng_unpkd['flag_errs']==0 and xeng_unpkd['rcvd_errs']==0: 
-                    if 'Good data received ant %i'%exp_ant not in rep[f]:
-                        rep[f]['Good data received ant %i'%exp_ant] = 1
-                    else:
-                        rep[f]['Good data received ant %i'%exp_ant] += 1
-                if 'Total data received' not in rep[f]:
-                    rep[f]['Total data received'] = 1
-                else:
-                    rep[f]['Total data received'] += 1
+                print('[%s] IDX: %6i. XENG: %3i. ANT: %4i. FREQ: %4i. 4 bit power: PolQ: %4.2f, PolI: %4.2f' % (fpga.host, i, xeng, exp_ants[b], exp_freq, blocks['rms'][b][0], blocks['rms'][b][1]), end=' ')
+                if blocks['rcvd_errs'][b] > 0: print('[%i RCV ERRS!]' % blocks['rcvd_errs'][b], end=' ')
+                if blocks['flag_errs'][b] > 0: print('[%i FLAGGED DATA]' % blocks['flag_errs'][b], end=' ')
                 print('')
+            if opts.plot:
+                for ant in range(n_ants):
+                    sel = exp_ants == ant
+                    for pol in range(2):
+                        numpy.add.at(plot_data[ant][pol], exp_freqs[sel], blocks['rms'][sel, pol])
+            rcvd_bad = blocks['rcvd_errs'] > 0
+            flag_bad = blocks['flag_errs'] > 0
+            for name, sel in [('Rcv Errors ant %i', rcvd_bad), ('Flagged bad data ant %i', flag_bad), ('Good data received ant %i', ~rcvd_bad & ~flag_bad)]:
+                for ant, cnt in enumerate(numpy.bincount(exp_ants[sel], minlength = n_ants)):
+                    if cnt > 0: rep[f][name % ant] = int(cnt)
+            if len(exp_ants) > 0:
+                rep[f]['Total data received'] = len(exp_ants)
 
     return snapdump, oobdata, rep, plot_data
 
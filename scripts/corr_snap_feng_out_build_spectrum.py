@@ -9,6 +9,7 @@ Assumes the correlator is already initialsed and running etc.
 Author: Paul Prozesky
 
 Revisions:
+2013-03-08:     Packet decoding and spectrum accumulation moved to corr.snap and corr.spectra.
 2012-01-25: JRM Added support for snap_10gbe_tx for correlators without XAUI links.
 2011-09-12: PVP Initial version.
 '''
@@ -47,156 +48,52 @@ def print_packet_info_basic(server, count, d):
     if d.link_up: print('[LINK UP]', end=' ')
     print('') 
 
-def print_10gbe_pkt_info_basic(server, count, d):
-    print('') 
-
-def print_packet_info(server, header_index, length, unpacked, mcount):
+def print_packet_info(server, decoded, p):
     print('[%s] [Pkt@ %4i Len: %2i]     (MCNT %16u ANT: %1i, Freq: %4i)  RMS: X: %1.2f Y: %1.2f.  {X: %1.2f+%1.2fj (%2.1f & %2.1f bits), Y:%1.2f+%1.2fj (%2.1f & %2.1f bits)} {Pk: X,Y: %1.2f,%1.2f (%2.1f,%2.1f bits)}' % \
         (server,\
-        header_index,\
-        length,\
-        unpacked['pkt_mcnt'],\
-        unpacked['pkt_ant'],\
-        unpacked['pkt_mcnt'] % mcount,\
-        unpacked['rms_polQ'],\
-        unpacked['rms_polI'],\
-        unpacked['level_polQ_r'],\
-        unpacked['level_polQ_i'],\
-        unpacked['ave_bits_used_Q_r'],\
-        unpacked['ave_bits_used_Q_i'],\
-        unpacked['level_polI_r'],\
-        unpacked['level_polI_i'],\
-        unpacked['ave_bits_used_I_r'],\
-        unpacked['ave_bits_used_I_i'],\
-        unpacked['pk_polQ'],\
-        unpacked['pk_polI'],\
-        unpacked['pk_bits_used_Q'],\
-        unpacked['pk_bits_used_I']))
-
-def feng_unpack(f, hdr_index, pkt_len, skip_indices):
-    pkt_64bit = data[f]['data'][hdr_index].data #struct.unpack('>Q',bram_dmp['bram_msb'][f][(4*hdr_index):(4*hdr_index)+4]+bram_dmp['bram_lsb'][f][(4*hdr_index):(4*hdr_index)+4])[0]
-    pkt_mcnt = (pkt_64bit & ((2**64)-(2**16)))>>16
-    pkt_ant  = pkt_64bit & ((2**16)-1)
-    pkt_freq = pkt_mcnt % n_chans
-    sum_polQ_r = 0
-    sum_polQ_i = 0
-    sum_polI_r = 0
-    sum_polI_i = 0
-    pk_polQ = 0
-    pk_polI = 0
-    raw_data = []
-    #average the packet contents - ignore first entry (header)
-    for pkt_index in range(1,(pkt_len)):
-        abs_index = hdr_index + pkt_index
-        if skip_indices.count(abs_index)>0: 
-            #print 'Skipped %i'%abs_index
-            continue
-        pkt_64bit = data[f]['data'][abs_index].data
-        raw_data.append(pkt_64bit)
-        for offset in range(0,64,16):
-            polQ_r = (pkt_64bit & ((2**(offset+16)) - (2**(offset+12))))>>(offset+12)
-            polQ_i = (pkt_64bit & ((2**(offset+12)) - (2**(offset+8))))>>(offset+8)
-            polI_r = (pkt_64bit & ((2**(offset+8)) - (2**(offset+4))))>>(offset+4)
-            polI_i = (pkt_64bit & ((2**(offset+4)) - (2**(offset))))>>offset
-            qr_4b=float(((numpy.int8(polQ_r << 4)>> 4)))/(2**binary_point)
-            qi_4b=float(((numpy.int8(polQ_i << 4)>> 4)))/(2**binary_point)
-            ir_4b=float(((numpy.int8(polI_r << 4)>> 4)))/(2**binary_point)
-            ii_4b=float(((numpy.int8(polI_i << 4)>> 4)))/(2**binary_point)
-            #square each number and then sum it
-            sum_polQ_r += qr_4b**2
-            sum_polQ_i += qi_4b**2
-            sum_polI_r += ir_4b**2
-            sum_polI_i += ii_4b**2
-            if (qr_4b > pk_polQ): pk_polQ = qr_4b
-            if (qi_4b > pk_polQ): pk_polQ = qi_4b
-            if (ir_4b > pk_polI): pk_polI = ir_4b
-            if (ii_4b > pk_polI): pk_polI = ii_4b
-    num_accs = (pkt_len-len(skip_indices))*(64/16)
-    level_polQ_r = numpy.sqrt(float(sum_polQ_r)/ num_accs)
-    level_polQ_i = numpy.sqrt(float(sum_polQ_i)/ num_accs)
-    level_polI_r = numpy.sqrt(float(sum_polI_r)/ num_accs)
-    level_polI_i = numpy.sqrt(float(sum_polI_i)/ num_accs)
-    rms_polQ = numpy.sqrt(((level_polQ_r)**2)  +  ((level_polQ_i)**2))
-    rms_polI = numpy.sqrt(((level_polI_r)**2)  +  ((level_polI_i)**2))
-    #For bit counting, multiply by two (num_bits is 4, not 3 where bin point is) to account for fact that it's signed numbers, so amplitude of 1/16 is actually using +1/16 and -1/16.
-    #To prevent log of zero, we check first.
-    if pk_polQ < 1.0/(2**num_bits):  pk_bits_used_Q = 0
-    else:  pk_bits_used_Q = numpy.log2(pk_polQ*(2**(num_bits)))
-    if pk_polI < 1.0/(2**num_bits):  pk_bits_used_I = 0
-    else:  pk_bits_used_I = numpy.log2(pk_polI*(2**(num_bits)))
-    if level_polQ_r < 1.0/(2**num_bits): ave_bits_used_Q_r = 0
-    else:  ave_bits_used_Q_r = numpy.log2(level_polQ_r*(2**(num_bits)))
-    if level_polQ_i < 1.0/(2**num_bits):  ave_bits_used_Q_i = 0
-    else:  ave_bits_used_Q_i = numpy.log2(level_polQ_i*(2**(num_bits)))
-    if level_polI_r < 1.0/(2**num_bits):  ave_bits_used_I_r = 0
-    else:  ave_bits_used_I_r = numpy.log2(level_polI_r*(2**(num_bits)))
-    if level_polI_i < 1.0/(2**num_bits):  ave_bits_used_I_i = 0
-    else: ave_bits_used_I_i = numpy.log2(level_polI_i*(2**(num_bits)))
-    return {'raw_packets': raw_data,\
-            'pkt_mcnt': pkt_mcnt,\
-            'pkt_ant':pkt_ant,\
-            'pkt_freq':pkt_freq,\
-            'rms_polQ':rms_polQ,\
-            'rms_polI':rms_polI,\
-            'level_polQ_r':level_polQ_r,\
-            'level_polQ_i':level_polQ_i,\
-            'level_polI_r':level_polI_r,\
-            'level_polI_i':level_polI_i,\
-            'pk_polQ':pk_polQ,\
-            'pk_polI':pk_polI,\
-            'pk_bits_used_Q':pk_bits_used_Q,\
-            'pk_bits_used_I':pk_bits_used_I,\
-            'ave_bits_used_Q_r':ave_bits_used_Q_r,\
-            'ave_bits_used_Q_i':ave_bits_used_Q_i,\
-            'ave_bits_used_I_r':ave_bits_used_I_r,\
-            'ave_bits_used_I_i':ave_bits_used_I_i}
+        decoded['hdr_index'][p],\
+        decoded['n_words'][p] + 1,\
+        decoded['mcnt'][p],\
+        decoded['ant'][p],\
+        decoded['freq'][p],\
+        decoded['rms'][p][0],\
+        decoded['rms'][p][1],\
+        decoded['level'][p][0],\
+        decoded['level'][p][1],\
+        decoded['ave_bits_used'][p][0],\
+        decoded['ave_bits_used'][p][1],\
+        decoded['level'][p][2],\
+        decoded['level'][p][3],\
+        decoded['ave_bits_used'][p][2],\
+        decoded['ave_bits_used'][p][3],\
+        decoded['pk'][p][0],\
+        decoded['pk'][p][1],\
+        decoded['pk_bits_used'][p][0],\
+        decoded['pk_bits_used'][p][1]))
 
 def process_packets(c, f_index, data, spectrum, report):
     fsrv = c.fsrvs[f_index]
-    #print fsrv + ': '
-    report['pkt_total'] = 0
-    pkt_hdr_idx = -1
-    for i, d in enumerate(data):
-        if opts.verbose:
+    if opts.verbose:
+        for i, d in enumerate(data):
             print_packet_info_basic(fsrv, i, d)
-        if d.link_down:
-            print('[%s] LINK DOWN AT %i' % (fsrv, i))
-        elif d.hdr_valid:
-            pkt_hdr_idx = i
-            # skip_indices records positions in XAUI data which are ADC updates and should not be counted towards standard data.
-            skip_indices = []
-            if opts.verbose:
-                print('HEADER RECEIVED INDEX %i' % pkt_hdr_idx)
-        elif d.eof:
-            # skip the first packet entry which has no header (snap block triggered on sync)
-            if pkt_hdr_idx < 0:
-                pkt_hdr_idx=i+1
-                skip_indices = []
-                continue
-            pkt_len = i - pkt_hdr_idx + 1
-            feng_unpkd_pkt = feng_unpack(f_index, pkt_hdr_idx, pkt_len, skip_indices)
-            #print feng_unpkd_pkt['raw_packets']
-            print_packet_info(server = fsrv, header_index = pkt_hdr_idx, length = pkt_len - len(skip_indices), unpacked = feng_unpkd_pkt, mcount = n_chans)
-            if feng_unpkd_pkt['pkt_ant'] != f_index:
-                raise RuntimeError('How did we get a packet from fengine %i read from fengine %i?' % (feng_unpkd_pkt['pkt_ant'], f_index))
-            spectrum[0][feng_unpkd_pkt['pkt_freq']] += feng_unpkd_pkt['rms_polQ']
-            spectrum[1][feng_unpkd_pkt['pkt_freq']]+= feng_unpkd_pkt['rms_polI']
-            if opts.verbose: print('')
-            pkt_hdr_idx=i+1
-            skip_indices = []
-            # packet_len is length of data, not including header
-            if pkt_len - len(skip_indices) != (packet_len + 1):
-                print('MALFORMED PACKET! of length %i starting at index %i' % (pkt_len - len(skip_indices), i))
-                print('len of skip_indices: %i:' % len(skip_indices), skip_indices)
-                if 'Malformed packets' not in report:
-                    report['Malformed packets'] = 1
-                else: 
-                    report['Malformed packets'] += 1
-            if 'pkt_ant_%i' % feng_unpkd_pkt['pkt_ant'] not in report:
-                report['pkt_ant_%i' % feng_unpkd_pkt['pkt_ant']] = 1
-            else: 
-                report['pkt_ant_%i' % feng_unpkd_pkt['pkt_ant']] += 1
-            report['pkt_total'] += 1
+    fields = corr.snap.fields_to_arrays(data, ['data', 'eof', 'link_down'])
+    for i in numpy.flatnonzero(fields['link_down']):
+        print('[%s] LINK DOWN AT %i' % (fsrv, i))
+    decoded = corr.snap.feng_tx_packets_decode(fields['data'], fields['eof'], n_chans, bin_pt = binary_point, n_bits = num_bits)
+    for p in range(len(decoded['mcnt'])):
+        print_packet_info(fsrv, decoded, p)
+    if (decoded['ant'] != f_index).any():
+        raise RuntimeError('How did we get a packet from fengine %i read from fengine %i?' % (decoded['ant'][decoded['ant'] != f_index][0], f_index))
+    corr.spectra.feng_tx_spectrum_add(spectrum, decoded, pol_inputs = (f_index * 2, f_index * 2 + 1))
+    # packet_len is length of data, not including header
+    n_malformed = int((decoded['n_words'] != packet_len).sum())
+    if n_malformed > 0:
+        print('%i MALFORMED PACKETS at indices' % n_malformed, decoded['hdr_index'][decoded['n_words'] != packet_len])
+        report['Malformed packets'] = report.get('Malformed packets', 0) + n_malformed
+    ants, counts = numpy.unique(decoded['ant'], return_counts = True)
+    for ant, count in zip(ants, counts):
+        report['pkt_ant_%i' % ant] = report.get('pkt_ant_%i' % ant, 0) + count
+    report['pkt_total'] = len(decoded['mcnt'])
 
 if __name__ == '__main__':
     from optparse import OptionParser
@@ -238,8 +135,7 @@ try:
     print('You should have %i XAUI cables connected to each F engine FPGA.' % (c.config['n_xaui_ports_per_ffpga']))
     report = []
     for f in c.ffpgas: report.append(dict())
-    spectrum = dict()
-    for f, fpga in enumerate(c.ffpgas): spectrum[f] = [numpy.zeros(n_chans), numpy.zeros(n_chans)]
+    spectrum = corr.spectra.SpectrumAccumulator(n_chans, n_inputs = len(c.ffpgas) * 2)
     packets_per_fset = (128 / (64 / 16)) + 1 # (f_values in set / (packet bits / f_value bits)) + one for the header
     snap_depth = pow(2, 8)
     fsets_per_snap = numpy.floor(snap_depth / packets_per_fset)
@@ -255,7 +151,7 @@ try:
             data = corr.snap.get_xaui_snapsho(c, offset = offset,snap_name = 'snap_gbe_tx%i'%opts.xaui_port)
             #print 'Grabbing and processing the spectrum data from XAUI snap blocks.',
         for d in data:
-            process_packets(c, d['fpga_index'], d['data'], spectrum[d['fpga_index']], report[d['fpga_index']])
+            process_packets(c, d['fpga_index'], d['data'], spectrum, report[d['fpga_index']])
     #print 'Done.\nGot %i 64-bit packets from %i f-engines.' % (len(data[0]['data']), len(data))
     for f, rep in enumerate(report):
         keys = list(report[f].keys())
@@ -268,16 +164,17 @@ try:
     print('==========================')
 
     import matplotlib, pylab
-    for i in range(0, len(spectrum)):
+    levels = spectrum.mean()
+    for i in range(0, len(c.ffpgas)):
         ant_str=c.map_input_to_ant(i*2)
         matplotlib.pyplot.figure()
         matplotlib.pyplot.subplot(2, 1, 1)
-        matplotlib.pyplot.plot(spectrum[i][0])
+        matplotlib.pyplot.plot(levels[i*2])
         matplotlib.pyplot.title('Antenna %s'%ant_str)
 
         ant_str=c.map_input_to_ant(i*2+1)
         matplotlib.pyplot.subplot(2, 1, 2)
-        matplotlib.pyplot.plot(spectrum[i][1])
+        matplotlib.pyplot.plot(levels[i*2+1])
         matplotlib.pyplot.title('Antenna %s'%ant_str)
     matplotlib.pyplot.show()
 
@@ -7,6 +7,7 @@ Author: Paul Prozesky
 Date: 2011-09-07
 
 Revisions:
+2013-03-08      Accumulate with corr.spectra.
 2011-09-07  PVP Initial.
 '''
 from __future__ import absolute_import
@@ -46,7 +47,7 @@ def draw_callback():
             dtp = pol['last_spectrum']
         else:
             pol['plot'].set_title('FFT amplitude output for input %s, averaged over %i spectra.' % (pol['ant_str'], pol['num_accs']))
-            dtp = numpy.divide(pol['accumulations'], pol['num_accs'])
+            dtp = pol['accumulations'].mean()[0]
         if opts.logplot == True:
             pol['plot'].semilogy(dtp)
         else:
@@ -92,13 +93,11 @@ def get_data(pol):
         raise RuntimeError('Mode not supported.')
     print('done.')
     print('\tAccumulating chans...', end=' ') 
-    for a in exclusion_list:
-        unpacked_vals[0][a] = 0
-    if len(pol['last_spectrum']) == 1:
-        pol['last_spectrum'] = numpy.zeros(pol['plot_chans'])
-        pol['accumulations'] = numpy.zeros(pol['plot_chans'])
+    unpacked_vals[:, exclusion_list] = 0
+    if pol['accumulations'] == None:
+        pol['accumulations'] = corr.spectra.SpectrumAccumulator(pol['plot_chans'])
     pol['last_spectrum'] = numpy.abs(unpacked_vals[0])
-    pol['accumulations'] = numpy.sum([pol['accumulations'], numpy.sum(numpy.abs(unpacked_vals), axis = 0)], axis = 0)
+    pol['accumulations'].add_spectra(numpy.abs(unpacked_vals))
     pol['num_accs'] += unpacked_vals.shape[0]
     print('done.')
     return
@@ -291,7 +290,7 @@ try:
         ffpga_n, xfpga_n, fxaui_n, xxaui_n, feng_input = c.get_ant_str_location(ant_str)
         pol_list.append({'ant_str': ant_str})
         pol_list[p]['fpga'] = c.ffpgas[ffpga_n]
-        pol_list[p]['accumulations'] = numpy.zeros(1)
+        pol_list[p]['accumulations'] = None
         pol_list[p]['last_spectrum'] = numpy.zeros(1)
         pol_list[p]['num_accs'] = 0
         pol_list[p]['pol'] = opts.pol
@@ -10,6 +10,7 @@ Author: Jason Manley
 Date: 2009-07-01
 
 Revisions:
+2013-03-08      Accumulate with corr.spectra.
 2011-06-29  JRM Port to new snap.py
 2010-11-24  PP  Fix to plotting
                 Ability to plot multiple antennas
@@ -53,9 +54,9 @@ def drawDataCallback():
         pol['plot'].set_xlabel('Frequency channel')
         pol['plot'].set_ylabel('Average power level')
         if logscale:
-            pol['plot'].semilogy(numpy.divide(pol['accumulations'], pol['num_accs']))
+            pol['plot'].semilogy(spectra.mean()[p])
         else:
-            pol['plot'].plot(numpy.divide(pol['accumulations'], pol['num_accs']))
+            pol['plot'].plot(spectra.mean()[p])
         fig.canvas.draw()
         fig.canvas.manager.window.after(100, drawDataCallback)
 
@@ -66,18 +67,16 @@ def parseAntenna(antArg):
     return ants
 
 def get_data(pol):
+    input_n = polList.index(pol)
     print('Integrating data %i from %s:' % (pol['num_accs'], pol['ant_str']))
     print(' Grabbing data off snap blocks...', end=' ')
     sys.stdout.flush()
-    unpacked_vals, spectra = c.get_quant_snapshot(pol['ant_str'], n_spectra = 1)
+    unpacked_vals, n_spectra = c.get_quant_snapshot(pol['ant_str'], n_spectra = 1)
     print('done.')
     print(' Accumulating...', end=' ')
     sys.stdout.flush()
-    unpacked_vals = numpy.square(numpy.abs(unpacked_vals))
-    if spectra > 1:
-        unpacked_vals = numpy.sum(unpacked_vals, axis = 0)
-    pol['accumulations'] = numpy.sum([pol['accumulations'], unpacked_vals], axis = 0)
-    pol['num_accs'] += spectra
+    spectra.add_spectra(corr.spectra.fft_to_power(unpacked_vals), inputs = input_n)
+    pol['num_accs'] += n_spectra
     print('done.')
     return
 
@@ -133,6 +132,8 @@ try:
         print('This script is only written to work with 4 bit quantised values.')
         exit_clean()
 
+    spectra = corr.spectra.SpectrumAccumulator(n_chans, n_inputs = len(ant_strs))
+
     # set up the figure with a subplot for each polarisation to be plotted
     fig = matplotlib.pyplot.figure()
     for p, ant_str in enumerate(ant_strs):
@@ -140,7 +141,6 @@ try:
             print('Unrecognised input %s. Must be in ' % p, c.config._get_ant_mapping_list())
             exit_clean()
         polList.append({'ant_str':ant_str})
-        polList[p]['accumulations'] = numpy.zeros(c.config['n_chans'])
         polList[p]['num_accs'] = 0
         polList[p]['plot'] = fig.add_subplot(len(ant_strs), 1, p + 1)
 
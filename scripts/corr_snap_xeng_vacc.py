@@ -133,6 +133,7 @@ try:
     print('Done.')
     print('========================\n')
 
+    bl_order = c.get_bl_order()
     for xeng, fpga in enumerate(fpgas):
         print('--------------------')
         print('\nX-engine %i' % xeng)
@@ -146,7 +147,7 @@ try:
             else:
                 freq = (index / n_bls) + x_per_fpga * xeng * c.config['n_chans']/c.config['n_xeng']
             #print '(%i,%i,%i,%i)' % (li, index, bls_index, freq),
-            i, j = c.get_bl_order()[bls_index]
+            i, j = bl_order[bls_index]
             # data is a 128-bit number that was demuxed into 8 16.6 numbers
             real_val = bram_data[xeng][li * 2]
             imag_val = bram_data[xeng][li * 2 + 1]
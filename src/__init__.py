@@ -9,5 +9,5 @@ Email: jason_manley at hotmail.com, aparsons at astron.berkeley.edu
 Revisions:
 """
 from __future__ import absolute_import
-from . import cn_conf, katcp_wrapper, katcp_serial, log_handlers, corr_functions, bf_functions, corr_wb, corr_nb, corr_ddc, scroll, katadc, iadc, termcolors, rx, sim, snap, threaded
+from . import baselines, cn_conf, katcp_wrapper, katcp_serial, log_handlers, corr_functions, bf_functions, corr_wb, corr_nb, corr_ddc, scroll, katadc, iadc, termcolors, rx, rx_store, rx_stats, rx_replay, sim, fake_roach, bench, snap, snap_acq, spectra, threaded
 
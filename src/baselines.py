@@ -0,0 +1,91 @@
+"""
+Reordering of X engine baselines into a canonical layout.
+
+X engines output their correlation products in the order given by Correlator.get_bl_order (the bls_ordering metadata item):
+a list of (input, input) label pairs, such as ('3x', '0y'), in an order that follows from the X engine's architecture.
+BaselineReorder works out once, for a given ordering, the gather index that rearranges the baseline axis of a dump into
+(antenna pair, polarisation product) order, with antenna pairs (i, j), i <= j, in antenna order and polarisation products
+in pol order (xx, xy, yx, yy). Products only available as (j, i) are conjugated. Applying it is a single numpy.take per dump.
+
+Revs:
+2013-03-19  Initial.
+"""
+
+from __future__ import absolute_import
+import re
+import numpy
+
+def _label_str(label):
+    return label.decode() if isinstance(label, bytes) else str(label)
+
+def _ant_key(ant):
+    """Sort numbered antennas numerically, anything else alphabetically after them."""
+    return (0, int(ant), '') if re.match(r'^\d+$', ant) else (1, 0, ant)
+
+class BaselineReorder:
+    """Gather index from an X engine baseline order (a sequence of (input, input) labels, each input being an antenna
+        name followed by a single polarisation character) to the canonical (n_ant_pairs x n_pol_products) order.
+        Attributes: ants (antenna names), pols, ant_pairs ((n_ant_pairs x 2) antenna indices), pol_products ((n_pol_products x 2)
+        pol indices), index (the baseline to take for every canonical product) and conj (products that need conjugating)."""
+    def __init__(self, bls_ordering):
+        labels = [(_label_str(a), _label_str(b)) for a, b in bls_ordering]
+        self.n_bls = len(labels)
+        inputs = set([a for a, b in labels] + [b for a, b in labels])
+        self.ants = sorted(set([i[:-1] for i in inputs]), key = _ant_key)
+        self.pols = sorted(set([i[-1] for i in inputs]))
+        self.ant_pairs = numpy.array([(i, j) for i in range(len(self.ants)) for j in range(i, len(self.ants))], dtype = numpy.int32)
+        self.pol_products = numpy.array([(p, q) for p in range(len(self.pols)) for q in range(len(self.pols))], dtype = numpy.int32)
+        lookup = dict([(bl, n) for n, bl in enumerate(labels)])
+        index = numpy.zeros((len(self.ant_pairs), len(self.pol_products)), dtype = numpy.intp)
+        conj = numpy.zeros(index.shape, dtype = bool)
+        for pair_n, (i, j) in enumerate(self.ant_pairs):
+            for pp_n, (p, q) in enumerate(self.pol_products):
+                a = self.ants[i] + self.pols[p]
+                b = self.ants[j] + self.pols[q]
+                if (a, b) in lookup:
+                    index[pair_n, pp_n] = lookup[(a, b)]
+                elif (b, a) in lookup:
+                    index[pair_n, pp_n] = lookup[(b, a)]
+                    conj[pair_n, pp_n] = True
+                else:
+                    raise RuntimeError('Baseline %s*%s is not in the X engine output.' % (a, b))
+        self.index = index.ravel()
+        self.conj = conj
+        self._conj_index = numpy.flatnonzero(conj.ravel())
+
+    def shape(self, dump_shape):
+        """Shape of the reordered version of a dump of dump_shape (..., n_bls, 2)."""
+        return tuple(dump_shape[:-2]) + (len(self.ant_pairs), len(self.pol_products), dump_shape[-1])
+
+    def pair_labels(self):
+        """Antenna name pairs of the reordered products."""
+        return [(self.ants[i], self.ants[j]) for i, j in self.ant_pairs]
+
+    def pol_labels(self):
+        """Polarisation products (eg 'xy') of the reordered products."""
+        return [self.pols[p] + self.pols[q] for p, q in self.pol_products]
+
+    def apply(self, dump, out = None):
+        """Reorders a dump (..., n_bls, 2) of real/imaginary values, returning an array of shape(dump.shape).
+            out, if given, is a preallocated array of that shape to fill."""
+        dump = numpy.asarray(dump)
+        if dump.shape[-2] != self.n_bls:
+            raise RuntimeError('Expected %i baselines, got a dump of shape %s.' % (self.n_bls, str(dump.shape)))
+        flat_shape = dump.shape[:-2] + (len(self.index), dump.shape[-1])
+        if out is None:
+            out = numpy.empty(self.shape(dump.shape), dtype = dump.dtype)
+        flat = out.reshape(flat_shape)
+        numpy.take(dump, self.index, axis = -2, out = flat)
+        if len(self._conj_index) > 0:
+            flat[..., self._conj_index, 1] *= -1
+        return out
+
+_reorder_cache = {}
+
+def baseline_reorder_get(bls_ordering):
+    """Returns a BaselineReorder for bls_ordering, reusing the one made for the last identical ordering."""
+    key = tuple([(_label_str(a), _label_str(b)) for a, b in bls_ordering])
+    if key not in _reorder_cache:
+        _reorder_cache.clear()
+        _reorder_cache[key] = BaselineReorder(key)
+    return _reorder_cache[key]
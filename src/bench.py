@@ -0,0 +1,203 @@
+"""
+Control-plane benchmarks: times Correlator operations against fake ROACHes (see fake_roach), for a range of board counts
+and network latencies, so that scaling regressions are caught on a workstation rather than at the telescope.
+
+bench_run starts n_f + n_x FakeRoaches on loopback addresses, writes a copy of a correlator config file pointing at them
+(with the number of antennas scaled to the number of F boards), connects a Correlator and runs one of the SCENARIOS a
+number of times. The result is a dictionary of the wall time of each repeat and its min, mean, max and percentiles, the
+KATCP requests and bytes the boards saw (in total and by request name), the client's view of the requests (reply
+latency percentiles and so on by request name, from katcp_wrapper.RequestStats), and the errors raised, if any. The
+boards are given fake_roach.correlator_models, so counters count, snap blocks capture and arming and loads happen on
+time; without them, scenarios that check the state of the hardware fail, though their time and request counts are
+still recorded.
+
+bench_suite runs every combination of scenarios, board counts and latencies, appending the results to a JSON lines
+file as it goes so runs can be compared later with results_compare.
+
+Revs:
+2013-03-28  Initial.
+2013-03-29  Register behaviour models on the fake boards. arm and vacc_sync scenarios.
+            KATCP client request statistics.
+"""
+
+from __future__ import absolute_import
+import corr, time, os, re, json, socket, tempfile, shutil, logging
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+# per-input config entries: (prefix, input number, suffix, value)
+CONFIG_INPUT_KEYS = [re.compile(r'^\s*(rf_gain_)(\d+)()\s*=\s*(.*?)\s*$'),
+    re.compile(r'^\s*(eq_poly_)(\d+)()\s*=\s*(.*?)\s*$'),
+    re.compile(r'^\s*(eq_coeffs_)(\d+)()\s*=\s*(.*?)\s*$'),
+    re.compile(r'^\s*(bf_cal_\w+_input)(\d+)(_beam\d+)\s*=\s*(.*?)\s*$')]
+
+SNAPSHOT_NAME = 'bench_snap'
+
+def _config_get(lines, key):
+    for line in lines:
+        match = re.match(r'^\s*%s\s*=\s*(.*?)\s*$' % re.escape(key), line)
+        if match != None:
+            return match.group(1)
+    raise RuntimeError('No %s in config file.' % key)
+
+def config_write(template, filename, servers_f, servers_x, katcp_port = 7147):
+    """Writes a copy of the config file template to filename, with the given F and X engine servers and KATCP port. The
+        number of antennas is scaled to keep the template's antennas per F board, and the per-input entries (RF gains,
+        EQ and beamformer calibration) are repeated for every input, all with the template's values for input 0."""
+    lines = open(template).readlines()
+    ants_per_f = int(_config_get(lines, 'n_ants')) // len(_config_get(lines, 'servers_f').split(','))
+    n_inputs = ants_per_f * len(servers_f) * 2
+    settings = {'servers_f': ','.join(servers_f), 'servers_x': ','.join(servers_x), 'katcp_port': katcp_port,
+        'n_ants': ants_per_f * len(servers_f)}
+    out = []
+    families = {}
+    for line in lines:
+        key = line.split('=')[0].strip()
+        if '=' in line and key in settings:
+            out.append('%s = %s\n' % (key, settings[key]))
+            continue
+        for pattern in CONFIG_INPUT_KEYS:
+            match = pattern.match(line)
+            if match != None:
+                family = (match.group(1), match.group(3))
+                if family not in families:
+                    families[family] = match.group(4)
+                    out.append(family)
+                break
+        else:
+            out.append(line)
+    fh = open(filename, 'w')
+    for line in out:
+        if isinstance(line, tuple):
+            fh.write(''.join(['%s%i%s = %s\n' % (line[0], n, line[1], families[line]) for n in range(n_inputs)]))
+        else:
+            fh.write(line)
+    fh.close()
+
+def _fr_delay_coeffs(c):
+    return dict([(ant_str, {'delay': 0, 'delay_rate': 0, 'fringe_phase': 0, 'fringe_rate': 0}) for ant_str in c.config._get_ant_mapping_list()])
+
+# name: function run and timed, given the Correlator, a dictionary of host: FakeRoach and any scenario arguments given
+# to bench_run.
+SCENARIOS = {
+    'initialise': lambda c, roaches, **kwargs: c.initialise(**dict({'prog_timeout_s': 0}, **kwargs)),
+    'check_all': lambda c, roaches, **kwargs: c.check_all(**kwargs),
+    'eq_set_all': lambda c, roaches, **kwargs: c.eq_set_all(**kwargs),
+    'fr_delay_set_all': lambda c, roaches, **kwargs: c.fr_delay_set_all(_fr_delay_coeffs(c), **kwargs),
+    'arm': lambda c, roaches, **kwargs: c.arm(**dict({'spead_update': False}, **kwargs)),
+    'vacc_sync': lambda c, roaches, **kwargs: c.vacc_sync(**kwargs),
+    'snapshot': lambda c, roaches, **kwargs: corr.snap.snapshots_get(c.ffpgas, SNAPSHOT_NAME, **dict({'wait_period': 1}, **kwargs)),
+}
+
+def _counts_sum(roaches, attribute):
+    total = {}
+    for roach in roaches:
+        for name, count in getattr(roach, attribute).items():
+            total[name] = total.get(name, 0) + count
+    return total
+
+def bench_run(scenario, n_f, n_x, latency = 0.0, jitter = 0.0, repeats = 5, template = None, port = 7147,
+        first_host = '127.0.0.1', scenario_args = {}, roach_args = {}, models = True, logger = None):
+    """Runs a scenario repeats times on a correlator of n_f F and n_x X engine fake boards, whose replies are delayed
+        by latency seconds plus up to jitter seconds. template is the config file to base the correlator's on (default:
+        corr_functions.default_config). roach_args go to each FakeRoach, and the boards are given the correlator's
+        register models unless models is False. Returns a dictionary of results, see the
+        module description."""
+    if scenario not in SCENARIOS:
+        raise RuntimeError('Unknown scenario %s. Choose from %s.' % (scenario, ', '.join(sorted(SCENARIOS.keys()))))
+    logger = logger if logger != None else logging.getLogger('bench')
+    template = template if template != None else corr.corr_functions.default_config
+    lines = open(template).readlines()
+    run = SCENARIOS[scenario]
+    roaches = corr.fake_roach.fake_roaches_start(n_f + n_x, port = port, first_host = first_host, latency = latency,
+        jitter = jitter, bofs = [_config_get(lines, 'bitstream_f'), _config_get(lines, 'bitstream_x')], **roach_args)
+    tmp_dir = tempfile.mkdtemp(prefix = 'corr_bench')
+    c = None
+    try:
+        config_file = os.path.join(tmp_dir, 'bench')
+        config_write(template, config_file, [r.host for r in roaches[0:n_f]], [r.host for r in roaches[n_f:]], port)
+        c = corr.corr_functions.Correlator(config_file = config_file, log_level = logging.WARN)
+        by_host = dict([(r.host, r) for r in roaches])
+        if models:
+            for model in corr.fake_roach.correlator_models(c.config):
+                for roach in roaches:
+                    roach.model_add(model)
+        for roach in roaches:
+            roach.reset_counts()
+        c.katcp_stats_enable()
+        times = []
+        errors = []
+        logger.info('Running %s %i times on %i F and %i X boards with %.1f ms latency.' % (scenario, repeats, n_f, n_x, latency * 1e3))
+        for repeat in range(repeats):
+            start = time.time()
+            try:
+                run(c, by_host, **scenario_args)
+            except Exception as err:
+                errors.append('%s: %s' % (err.__class__.__name__, err))
+            times.append(time.time() - start)
+        katcp = c.katcp_stats_get()['all']
+    finally:
+        if c != None:
+            c.disconnect_all()
+        for roach in roaches:
+            roach.stop()
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+    requests = _counts_sum(roaches, 'request_counts')
+    result = {'scenario': scenario, 'n_f': n_f, 'n_x': n_x, 'latency': latency, 'jitter': jitter, 'repeats': repeats,
+        'scenario_args': scenario_args, 'time': time.time(), 'host': socket.gethostname(),
+        'times': times, 'min': min(times), 'mean': float(np.mean(times)), 'max': max(times),
+        'requests': sum(requests.values()), 'requests_by_name': requests,
+        'bytes_in': sum(_counts_sum(roaches, 'bytes_in').values()), 'bytes_out': sum(_counts_sum(roaches, 'bytes_out').values()),
+        'katcp': katcp, 'errors': errors}
+    for p in PERCENTILES:
+        result['p%i' % p] = float(np.percentile(times, p))
+    return result
+
+def bench_suite(scenarios, board_counts, latencies = [0.0], jitter = 0.0, repeats = 5, filename = None, logger = None, **kwargs):
+    """Runs bench_run for every combination of scenarios, board_counts (a list of (n_f, n_x)) and latencies (seconds).
+        Each result is appended to filename as it finishes, if given. Returns the list of results."""
+    logger = logger if logger != None else logging.getLogger('bench')
+    results = []
+    for scenario in scenarios:
+        for n_f, n_x in board_counts:
+            for latency in latencies:
+                result = bench_run(scenario, n_f, n_x, latency = latency, jitter = jitter, repeats = repeats, logger = logger, **kwargs)
+                if filename != None:
+                    results_save([result], filename)
+                for err in set(result['errors']):
+                    logger.warn('%s on %i F and %i X boards: %s' % (scenario, n_f, n_x, err))
+                results.append(result)
+    return results
+
+def results_save(results, filename):
+    """Appends results to a JSON lines file, one result per line."""
+    fh = open(filename, 'a')
+    for result in results:
+        fh.write(json.dumps(result, sort_keys = True) + '\n')
+    fh.close()
+
+def results_load(filename):
+    return [json.loads(line) for line in open(filename) if len(line.strip()) > 0]
+
+def _result_key(result):
+    return (result['scenario'], result['n_f'], result['n_x'], result['latency'], result['jitter'])
+
+def results_compare(old, new, tolerance = 0.2):
+    """Compares two lists of results, matching them on scenario, board counts, latency and jitter (the last of each in
+        a list wins). Returns a list of dictionaries of scenario, n_f, n_x, latency, jitter, old and new median times and
+        requests per repeat, time_ratio (new over old median time) and regression: whether the median time grew by more
+        than tolerance (a fraction) or more KATCP requests were made."""
+    old = dict([(_result_key(r), r) for r in old])
+    comparison = []
+    for result in new:
+        key = _result_key(result)
+        if key not in old:
+            continue
+        ratio = result['p50'] / old[key]['p50'] if old[key]['p50'] > 0 else float('inf')
+        old_requests = old[key]['requests'] / float(old[key]['repeats'])
+        new_requests = result['requests'] / float(result['repeats'])
+        comparison.append(dict(zip(['scenario', 'n_f', 'n_x', 'latency', 'jitter'], key), old_p50 = old[key]['p50'], new_p50 = result['p50'],
+            old_requests = old_requests, new_requests = new_requests, time_ratio = ratio,
+            regression = (ratio > 1 + tolerance) or (new_requests > old_requests)))
+    return comparison
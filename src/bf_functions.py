@@ -13,6 +13,11 @@ Revisions:
 2013-03-01 AM calibration
 2013-03-02 RR fbfExceptions
 2013-03-05 AM SPEAD metadata
+2013-03-22 Bulk pipelined coefficient loading
+2013-03-23 Cached fft bin lookup table
+2013-03-24 Vectorised calibration codec
+2013-03-25 Register access grouped by fpga and run in parallel
+2013-03-26 Beam steering
 \n"""
 
 from __future__ import absolute_import
@@ -31,6 +36,32 @@ class fbfException(Exception):
         if logger:
             logger.error('BFError: %s\n%s' % (msg, trace))
 
+def cal_floats2words(values, n_bits=16, bin_pt=15):
+    """Converts complex calibration values to the 32 bit words the bengines take: real and imaginary parts as
+    n_bits fixed point numbers with bin_pt fractional bits, real part in the top 16 bits. Values are rounded to the
+    nearest step and saturate at the ends of the range.
+    Returns the words (as signed 32 bit integers) and the number of real and imaginary parts that saturated."""
+    if n_bits > 16:
+        raise RuntimeError('Calibration values of %i bits do not fit in 16 bits.' % n_bits)
+    values = numpy.asarray(values, dtype=numpy.complex128).reshape(-1)
+    top = 2**(n_bits-1)-1
+    bottom = -2**(n_bits-1)
+    parts = []
+    n_saturated = []
+    for part in [values.real, values.imag]:
+        scaled = numpy.round(part*2.0**bin_pt)
+        n_saturated.append(int(numpy.count_nonzero((scaled > top) | (scaled < bottom))))
+        parts.append(numpy.clip(scaled, bottom, top).astype(numpy.int64))
+    words = ((parts[0] << 16) | (parts[1] & 0xFFFF)).astype(numpy.int32)
+    return words, n_saturated[0], n_saturated[1]
+
+def cal_words2floats(words, bin_pt=15):
+    """Converts 32 bit calibration words (signed or unsigned) as from the bengines back to complex values."""
+    words = numpy.asarray(words, dtype=numpy.int64).reshape(-1) & 0xFFFFFFFF
+    real = (words >> 16).astype(numpy.uint16).view(numpy.int16)
+    imag = (words & 0xFFFF).astype(numpy.uint16).view(numpy.int16)
+    return (real + 1j*imag)/2.0**bin_pt
+
 class fbf:
     """Class for frequency-domain beamformers"""
     def __init__(self, host_correlator, log_level=logging.INFO, simulate=False, optimisations=True):
@@ -48,6 +79,12 @@ class fbf:
         self.syslogger.addHandler(self.log_handler)
         self.syslogger.setLevel(log_level)
         self.c.b = self
+        # values last loaded by bf_bulk_write
+        self._bulk_cache = {}
+        # fft bin lookup table, see map_index_get
+        self._map_index = None
+        # (delay, phase, frequency offset) applied on top of calibration, keyed by (beam, ant_str)
+        self._steering = {}
 
         self.spead_initialise()
         self.syslogger.info('Beamformer created')
@@ -70,6 +107,9 @@ class fbf:
         return value
 
     def set_param(self, param, value):
+        # the fft bin lookup table depends on these
+        if param in ['n_chans', 'bandwidth', 'bf_be_per_fpga']:
+            self.map_index_clear()
         try:
             self.config[param] = value
         except KeyError as ke:
@@ -215,169 +255,136 @@ class fbf:
             indices.append(all_beams.index(beam))
         return indices
 
-    def frequency2fpgas(self, frequencies=all, fft_bins=[], unique=False):
-        """returns fpgas associated with frequencies specified. unique only returns unique fpgas"""
-        fpgas = []
+    def map_index_clear(self):
+        """Discards the fft bin lookup table, it is rebuilt from the configuration on next use"""
+        self._map_index = None
+
+    def map_index_get(self):
+        """Returns the fft bin lookup table, building it if need be. This is a dictionary of the configuration values
+        the mapping depends on, and numpy arrays indexed by fft bin giving the fpga (index into get_fpgas()), bf label
+        on the fpga, bf index across the system, frequency register index and centre frequency of each fft bin"""
+        if self._map_index == None:
+            n_chans = self.get_param('n_chans')
+            bandwidth = self.get_param('bandwidth')
+            bf_be_per_fpga = len(self.get_bfs())
+            n_fpgas = len(self.get_fpgas())
+            bf_fft_bins = n_chans//(n_fpgas*bf_be_per_fpga)
+            fft_bins = numpy.arange(n_chans)
+            bf_index = fft_bins//bf_fft_bins
+            self._map_index = {'n_chans': n_chans, 'bandwidth': bandwidth, 'channel_width': float(bandwidth)/n_chans,
+                               'n_fpgas': n_fpgas, 'bf_be_per_fpga': bf_be_per_fpga, 'bf_fft_bins': bf_fft_bins,
+                               'fpga': bf_index//bf_be_per_fpga,
+                               'bf': numpy.mod(bf_index, bf_be_per_fpga),
+                               'bf_index': bf_index,
+                               'reg_index': numpy.mod(fft_bins, bf_fft_bins),
+                               'frequency': fft_bins*(float(bandwidth)/n_chans)}
+        return self._map_index
+
+    def fft_bins_check(self, fft_bins):
+        """Returns fft bins as an integer array, checking they are in range"""
+        fft_bins = numpy.array(fft_bins, dtype=int).reshape(-1)
+        n_chans = self.map_index_get()['n_chans']
+        if len(fft_bins) > 0 and (fft_bins.max() > n_chans-1 or fft_bins.min() < 0):
+            raise fbfException(1, 'FFT bin/s out of range 0 -> %d' % (n_chans-1),
+                               'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
+                               self.syslogger)
+        return fft_bins
+
+    def _fft_bins_get(self, frequencies, fft_bins):
         if len(fft_bins) == 0:
             fft_bins = self.frequency2fft_bin(frequencies)
+        return self.fft_bins_check(fft_bins)
+
+    def frequency2fpgas(self, frequencies=all, fft_bins=[], unique=False):
+        """returns fpgas associated with frequencies specified. unique only returns unique fpgas"""
+        fft_bins = self._fft_bins_get(frequencies, fft_bins)
         all_fpgas = self.get_fpgas()
-        n_chans = self.get_param('n_chans')
-        n_chans_per_fpga = n_chans/len(all_fpgas)
-        prev_index = -1
-        for fft_bin in fft_bins:
-            index = numpy.int(fft_bin/n_chans_per_fpga) #floor built in
-            if index < 0 or index > len(all_fpgas)-1:
-                raise fbfException(1, 'FPGA index calculated out of range',
-                                   'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
-                                   self.syslogger)
-            if (unique == False) or index != prev_index:
-                fpgas.append(all_fpgas[index])
-            prev_index = index
-        return fpgas
+        indices = self.map_index_get()['fpga'][fft_bins]
+        if unique:
+            # drop repeats of the previous fpga
+            indices = indices[numpy.concatenate(([True], indices[1:] != indices[:-1]))] if len(indices) > 0 else indices
+        return [all_fpgas[index] for index in indices]
 
     def frequency2bf_label(self, frequencies=all, fft_bins=[], unique=False):
         """returns bf labels associated with the frequencies specified"""
-        bf_labels = []
-        bf_be_per_fpga = len(self.get_bfs())
+        bf_be_per_fpga = self.map_index_get()['bf_be_per_fpga']
         bf_indices = self.frequency2bf_index(frequencies, fft_bins, unique=unique)
-        for bf_index in bf_indices:
-            bf_labels.append(numpy.mod(bf_index, bf_be_per_fpga))
-        return bf_labels
+        return numpy.mod(bf_indices, bf_be_per_fpga).tolist()
 
     def frequency2bf_index(self, frequencies=all, fft_bins=[], unique=False):
         """returns bf indices associated with the frequencies specified"""
-        bf_indices = []
-        if len(fft_bins) == 0:
-            fft_bins = self.frequency2fft_bin(frequencies)
-        n_fpgas = len(self.get_fpgas())
-        bf_be_per_fpga = len(self.get_bfs())
-        n_bfs = n_fpgas*bf_be_per_fpga
-        n_chans = self.get_param('n_chans')
-        n_chans_per_bf = n_chans/n_bfs
-        if max(fft_bins) > n_chans-1 or min(fft_bins) < 0:
-            raise fbfException(1, 'FFT bin/s out of range', 'function %s, line no %s\n' %
-                               (__name__, inspect.currentframe().f_lineno), self.syslogger)
-        for fft_bin in fft_bins:
-            bf_index = fft_bin/n_chans_per_bf
-        if unique == False or bf_indices.count(bf_index) == 0:
-            bf_indices.append(fft_bin/n_chans_per_bf)
-        return bf_indices
+        fft_bins = self._fft_bins_get(frequencies, fft_bins)
+        bf_indices = self.map_index_get()['bf_index'][fft_bins]
+        if unique:
+            # first occurrence of each, in order
+            bf_indices = bf_indices[numpy.sort(numpy.unique(bf_indices, return_index=True)[1])]
+        return bf_indices.tolist()
 
     def frequency2frequency_reg_index(self, frequencies=all, fft_bins=[]):
         """Returns list of values to write into frequency register corresponding to frequency specified"""
-        indices = []
-        if len(fft_bins) == 0:
-            fft_bins = self.frequency2fft_bin(frequencies)
-        n_chans = self.get_param('n_chans')
-        bf_be_per_fpga = len(self.get_bfs())
-        n_fpgas = len(self.get_fpgas())
-        divisions = n_fpgas * bf_be_per_fpga
-        if max(fft_bins) > n_chans-1 or min(fft_bins) < 0:
-            raise fbfException(1, 'FFT bin/s out of range',
-                               'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
-                               self.syslogger)
-        for fft_bin in fft_bins:
-            indices.append(numpy.mod(fft_bin, n_chans/divisions))
-        return indices
+        fft_bins = self._fft_bins_get(frequencies, fft_bins)
+        return self.map_index_get()['reg_index'][fft_bins].tolist()
 
     def frequency2fft_bin(self, frequencies=all):
         """returns fft bin associated with specified frequencies"""
-        fft_bins = []
-        n_chans = self.get_param('n_chans')
-        if frequencies == None:
-            fft_bins = []
-        elif frequencies == all:
-            fft_bins = list(range(n_chans))
-        else:
-            bandwidth = self.get_param('bandwidth')
-            start_freq = 0
-            channel_width = bandwidth/n_chans
-            for frequency in frequencies:
-                frequency_normalised = numpy.mod((frequency-start_freq)+channel_width/2, bandwidth)
-                fft_bins.append(numpy.int(frequency_normalised/channel_width))  # conversion to int with truncation
-        return fft_bins
+        mapping = self.map_index_get()
+        if frequencies is None:
+            return []
+        elif frequencies is all:
+            return list(range(mapping['n_chans']))
+        start_freq = 0
+        channel_width = mapping['channel_width']
+        frequencies = numpy.array(frequencies, dtype=float).reshape(-1)
+        frequencies_normalised = numpy.mod((frequencies-start_freq)+channel_width/2, mapping['bandwidth'])
+        # conversion to int with truncation
+        return (frequencies_normalised//channel_width).astype(int).tolist()
 
     def get_bf_bandwidth(self):
         """Returns the bandwidth for one bf engine"""
-        bandwidth = self.get_param('bandwidth')
-        bf_be_per_fpga = len(self.get_bfs())
-        n_fpgas = len(self.get_fpgas())
-        bf_bandwidth = float(bandwidth)/(bf_be_per_fpga*n_fpgas)
-        return bf_bandwidth
+        mapping = self.map_index_get()
+        return mapping['channel_width']*mapping['bf_fft_bins']
 
     def get_bf_fft_bins(self):
         """Returns the number of fft bins for one bf engine"""
-        n_chans = self.get_param('n_chans')
-        bf_be_per_fpga = len(self.get_bfs())
-        n_fpgas = len(self.get_fpgas())
-        bf_fft_bins = n_chans/(bf_be_per_fpga*n_fpgas)
-        return bf_fft_bins
+        return self.map_index_get()['bf_fft_bins']
 
     def get_fft_bin_bandwidth(self):
         """get bandwidth of single fft bin"""
-        n_chans = self.get_param('n_chans')
-        bandwidth = self.get_param('bandwidth')
-        fft_bin_bandwidth = bandwidth/n_chans
-        return fft_bin_bandwidth
+        return self.map_index_get()['channel_width']
 
     def fft_bin2frequency(self, fft_bins=all):
         """returns a list of centre frequencies associated with the fft bins supplied"""
-        frequencies = []
-        n_chans = self.get_param('n_chans')
-        if fft_bins == all:
-            fft_bins = list(range(n_chans))
-        if type(fft_bins) == int:
-            fft_bins = [fft_bins]
-        if max(fft_bins) > n_chans or min(fft_bins) < 0:
-            raise fbfException(1, 'fft_bins out of range 0 -> %d' % (n_chans-1), 'function %s, line no %s\n'
-                               % (__name__, inspect.currentframe().f_lineno), self.syslogger)
-        bandwidth = self.get_param('bandwidth')
-        for fft_bin in fft_bins:
-            frequencies.append((float(fft_bin)/n_chans)*bandwidth)
-        return frequencies
+        if fft_bins is all:
+            return self.map_index_get()['frequency'].tolist()
+        fft_bins = self.fft_bins_check(fft_bins)
+        return self.map_index_get()['frequency'][fft_bins].tolist()
 
     def frequency2fpga_bf(self, frequencies=all, fft_bins=[], unique=False):
         """
         returns a list of dictionaries {fpga, beamformer_index} based on frequency.
         unique gives only unique values
         """
-        locations = []
         if unique != True and unique != False:
             raise fbfException(1, 'unique must be True or False', 'function %s, line no %s\n' %
                                (__name__, inspect.currentframe().f_lineno), self.syslogger)
-        if len(fft_bins) == 0:
-            fft_bins = self.frequency2fft_bin(frequencies)
-        fpgas = self.frequency2fpgas(fft_bins=fft_bins)
-        bfs = self.frequency2bf_label(fft_bins=fft_bins)
-        if len(fpgas) != len(bfs):
-            raise fbfException(1, 'fpga and bfs associated with frequencies not the same length',
-                               'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
-                               self.syslogger)
-        else:
-            pfpga = []
-            pbf = []
-            for index in range(len(fpgas)):
-                fpga = fpgas[index]
-                bf = bfs[index]
-                if (unique == False) or (pfpga != fpga or pbf != bf):
-                    locations.append({'fpga': fpga, 'bf': bf})
-                pbf = bf
-                pfpga = fpga
-        return locations
+        fft_bins = self._fft_bins_get(frequencies, fft_bins)
+        all_fpgas = self.get_fpgas()
+        bf_indices = self.map_index_get()['bf_index'][fft_bins]
+        if unique and len(bf_indices) > 0:
+            # drop repeats of the previous fpga and bf
+            bf_indices = bf_indices[numpy.concatenate(([True], bf_indices[1:] != bf_indices[:-1]))]
+        bf_be_per_fpga = self.map_index_get()['bf_be_per_fpga']
+        return [{'fpga': all_fpgas[bf_index//bf_be_per_fpga], 'bf': bf_index % bf_be_per_fpga}
+                for bf_index in bf_indices.tolist()]
 
     def beam_frequency2location_fpga_bf(self, beams=all, frequencies=all, fft_bins=[], unique=False):
         """returns list of dictionaries {location, fpga, beamformer index} based on beam name, and frequency"""
-        indices = []
         # get beam locations
         locations = self.beam2location(beams)
         # get fpgas and bfs
         fpgas_bfs = self.frequency2fpga_bf(frequencies, fft_bins, unique)
-        for location in locations:
-            for fpga_bf in fpgas_bfs:
-                fpga = fpga_bf['fpga']
-                bf = fpga_bf['bf']
-                indices.append({'location': location, 'fpga': fpga, 'bf': bf})
-        return indices
+        return [{'location': location, 'fpga': fpga_bf['fpga'], 'bf': fpga_bf['bf']}
+                for location in locations for fpga_bf in fpgas_bfs]
 
     def beam2location(self, beams=all):
         """returns location of beam with associated name or index"""
@@ -398,10 +405,29 @@ class fbf:
             antenna_indices = self.map_ant_to_input(beam=beam, ant_strs=ant_strs)
         return antenna_indices
 
+    def fpga_jobs(self, jobs, job_function, *args):
+        """Runs job_function(fpga, job, *args) for every fpga given a job in jobs (a dictionary keyed by fpga host),
+        on all of them at once. Returns a dictionary of the results keyed by host. If any fail, raises a single
+        fbfException with an errors attribute holding the error for every host that failed."""
+        if len(jobs) == 0:
+            return {}
+        targets = [fpga for fpga in self.get_fpgas() if fpga.host in jobs]
+        def run_job(fpga, jobs, *args):
+            return job_function(fpga, jobs[fpga.host], *args)
+        results = corr.threaded.fpga_operation(targets, -1, run_job, jobs, *args)
+        errors = dict([(host, str(result)) for host, result in results.items() if isinstance(result, Exception)])
+        if len(errors) > 0:
+            error = fbfException(1, '%s failed on %i of %i fpgas: %s' % (job_function.__name__, len(errors), len(targets),
+                                 '; '.join(['%s: %s' % (host, errors[host]) for host in sorted(errors.keys())])),
+                                 'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
+                                 self.syslogger)
+            error.errors = errors
+            raise error
+        return results
+
     def write_int(self, device_name, data, offset=0, frequencies=all, fft_bins=[], blindwrite=False):
-        """Writes data to all devices on all bfs in all fpgas associated with the frequencies specified"""
-        # TODO work this out properly
-        timeout = 1
+        """Writes data to all devices on all bfs in all fpgas associated with the frequencies specified.
+        Writes are grouped by fpga and all fpgas are written to at once. Returns the number of writes per fpga host."""
         # get all fpgas, bfs associated with frequencies specified
         targets = self.frequency2fpga_bf(frequencies, fft_bins, unique=True)
         if len(data) > 1 and len(targets) != len(data):
@@ -409,85 +435,59 @@ class fbf:
                                % (len(data), len(targets)), 'function %s, line no %s\n'
                                % (__name__, inspect.currentframe().f_lineno), self.syslogger)
         bf_register_prefix = self.get_param('bf_register_prefix')
-        # if optimisations are enabled and (same data, and multiple targets)
-        # write to all targets with the same register name
-        if self.optimisations and (len(data) == 1 and len(targets) > 1):
+        # group writes by fpga
+        writes = {}
+        for target_index, target in enumerate(targets):
+            if len(data) == 1:
+                datum = int(data[0])
+            else:
+                datum = int(data[target_index])
+            name = '%s%s_%s' % (bf_register_prefix, target['bf'], device_name)
+            # pretend to write if no FPGA
             if self.config.simulate == True:
-                print('optimisations on, single data item, writing in parallel')
-            datum = data[0]
-            n_bfs = len(self.get_bfs())
-            # run through all bfs
-            for bf_index in range(n_bfs):
-                fpgas = []
-                # generate register name
-                name = '%s%s_%s' % (bf_register_prefix, bf_index, device_name)
-                datum = struct.pack(">I", data[0])
-                # find all fpgas to be written to for this bf
-                for target in targets:
-                    if target['bf'] == bf_index:
-                        fpgas.append(target['fpga'])
-                if len(fpgas) != 0:
-                    if self.config.simulate == True:
-                        print('dummy executing non-blocking request for write to %s on %d fpgas' % (name, len(fpgas)))
-                    else:
-                        nottimedout, rv = corr.corr_functions.non_blocking_request(fpgas=fpgas, timeout=timeout,
-                                                                                   request='write',
-                                                                                   request_args=[name, offset*4, datum])
-                        if nottimedout == False:
-                            raise fbfException(1, 'Timeout asynchronously writing 0x%.8x to %s on %d fpgas offset %i'
-                                               % (data[0], name, len(fpgas), offset), 'function %s, line no %s\n'
-                                               % (__name__, inspect.currentframe().f_lineno), self.syslogger)
-                        for k, v in rv.items():
-                            if v['reply'] != 'ok':
-                                raise fbfException(1, 'Got %s instead of ''ok'' when writing 0x%.8x to %s:%s offset %i'
-                                                   % (v['reply'], data[0], k, name, offset), 'function %s, line no %s\n'
-                                                   % (__name__, inspect.currentframe().f_lineno), self.syslogger)
-        # optimisations off, or (many data, or a single target) so many separate writes
+                print('dummy write of 0x%.8x to %s:%s offset %i' % (datum & 0xFFFFFFFF, target['fpga'], name, offset))
+            else:
+                writes.setdefault(target['fpga'].host, []).append((name, datum, offset))
+        # pipelined blind writes if optimisations are enabled, otherwise one at a time
+        if blindwrite and self.optimisations:
+            def write_board(fpga, board_writes):
+                return fpga.blindwrite_int_pipelined(board_writes)
         else:
-            if self.config.simulate == True:
-                print('optimisations off or multiple items or single target')
-            for target_index, target in enumerate(targets):
-                if len(data) == 1 and len(targets) > 1:
-                    datum = data[0]
-                else:
-                    datum = data[target_index]
-                if datum < 0:
-                    datum_str = struct.pack(">i", datum)
-                else:
-                    datum_str = struct.pack(">I", datum)
-                    name = '%s%s_%s' % (bf_register_prefix, target['bf'], device_name)
-                # pretend to write if no FPGA
-                if self.config.simulate == True:
-                    print('dummy write of 0x%.8x to %s:%s offset %i' % (datum, target['fpga'], name, offset))
-                else:
-                    try:
-                        if blindwrite:
-                            target['fpga'].blindwrite(device_name=name, data=datum_str, offset=offset*4)
-                        else:
-                            target['fpga'].write(device_name=name, data=datum_str, offset=offset*4)
-                    except:
-                        raise fbfException(1, 'Error writing 0x%.8x to %s:%s offset %i'
-                                           % (datum, target['fpga'], name, offset*4), 'function %s, line no %s\n'
-                                           % (__name__, inspect.currentframe().f_lineno), self.syslogger)
+            def write_board(fpga, board_writes):
+                for name, datum, board_offset in board_writes:
+                    fpga.write_int(name, datum, blindwrite=blindwrite, offset=board_offset)
+                return len(board_writes)
+        return self.fpga_jobs(writes, write_board)
 
     def read_int(self, device_name, offset=0, frequencies=all, fft_bins=[]):
-        """Reads data from all devices on all bfs in all fpgas associated with the frequencies specified"""
-        values = []
+        """Reads data from all devices on all bfs in all fpgas associated with the frequencies specified.
+        Reads are grouped by fpga and all fpgas are read from at once."""
         # get all unique fpgas, bfs associated with the specified frequencies
         targets = self.frequency2fpga_bf(frequencies, fft_bins, unique=True)
+        bf_register_prefix = self.get_param('bf_register_prefix')
+        # group reads by fpga, remembering where each value goes
+        reads = {}
+        positions = {}
         for target_index, target in enumerate(targets):
-            name = '%s%s_%s' % (self.get_param('bf_register_prefix'), target['bf'], device_name)
+            name = '%s%s_%s' % (bf_register_prefix, target['bf'], device_name)
             # pretend to read if no FPGA
             if self.config.simulate == True:
                 print('dummy read from %s:%s offset %i' % (target['fpga'], name, offset))
             else:
-                try:
-                    values.append(target['fpga'].read_int(device_name=name))
-                except:
-                    raise fbfException(1, 'Error reading from %s:%s offset %i' % (target['fpga'], name, offset),
-                                       'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
-                                       self.syslogger)
-        return values
+                reads.setdefault(target['fpga'].host, []).append((name, offset))
+                positions.setdefault(target['fpga'].host, []).append(target_index)
+        if self.optimisations:
+            def read_board(fpga, board_reads):
+                return fpga.read_int_pipelined(board_reads)
+        else:
+            def read_board(fpga, board_reads):
+                return [fpga.read_int(name, offset=board_offset) for name, board_offset in board_reads]
+        results = self.fpga_jobs(reads, read_board)
+        values = [None] * len(targets)
+        for host, board_values in results.items():
+            for target_index, value in zip(positions[host], board_values):
+                values[target_index] = value
+        return [value for value in values if value != None]
 
     def bf_control_lookup(self, destination, write=True, read=True):
         control = 0
@@ -595,6 +595,8 @@ class fbf:
             raise fbfException(1, 'Invalid destination: %s' % destination,
                                'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
                                self.syslogger)
+        # bf_bulk_write can no longer tell what is loaded here
+        self.bf_bulk_cache_clear(destination)
         # convert frequencies to list of fft_bins
         if len(fft_bins) == 0:
             fft_bins = self.frequency2fft_bin(frequencies)
@@ -705,6 +707,89 @@ class fbf:
                     print('bf_write_int: triggering for no antennas (and no frequencies)')
                 self.write_int('control', [control], 0, fft_bins=fft_bins, blindwrite=blindwrite)
 
+    def bf_bulk_cache_clear(self, destination=None):
+        """Forget the values bf_bulk_write has loaded (for destination only, if given) so the next load writes everything"""
+        if destination == None:
+            self._bulk_cache = {}
+        else:
+            for key in list(self._bulk_cache.keys()):
+                if key[0] == destination:
+                    self._bulk_cache.pop(key)
+
+    def bf_bulk_write(self, destination, values, force=False, window=64):
+        """Loads whole spectra of values into destination ('calibrate' or 'filter') for many beams and antennas at once.
+        values is a dictionary of n_chans values keyed by (beam, ant_str) (ant_str None for filter).
+        The (control, stream, antenna, frequency, value_in) write sequence for every bf is built up front and each fpga's
+        writes are pipelined, with all fpgas loaded in parallel. Bins whose value is unchanged since the last load are
+        skipped unless force is True. Returns the number of register writes made."""
+        if destination not in ['calibrate', 'filter']:
+            raise fbfException(1, 'Invalid destination: %s' % destination,
+                               'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
+                               self.syslogger)
+        mapping = self.map_index_get()
+        n_chans = mapping['n_chans']
+        bf_register_prefix = self.get_param('bf_register_prefix')
+        bf_be_per_fpga = mapping['bf_be_per_fpga']
+        fpgas = self.get_fpgas()
+        bf_fft_bins = mapping['bf_fft_bins']
+        control = self.bf_control_lookup(destination, write=True, read=True)
+        writes = [[] for fpga in fpgas]
+        loaded = {}
+        for (beam, ant_str), data in values.items():
+            data = numpy.array(data, dtype=numpy.int64)
+            if len(data) != n_chans:
+                raise fbfException(1, 'Need %i values for beam %s antenna %s, got %i' % (n_chans, beam, ant_str, len(data)),
+                                   'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
+                                   self.syslogger)
+            location = self.beam2location(beams=beam)[0]
+            if destination == 'calibrate':
+                antenna_index = self.antenna2antenna_indices(beam=beam, ant_strs=self.ants2ants(beam, [ant_str]))[0]
+            else:
+                antenna_index = None
+            key = (destination, location, antenna_index)
+            previous = self._bulk_cache.get(key)
+            if force or previous is None:
+                changed = numpy.ones(n_chans, dtype=bool)
+            else:
+                changed = data != previous
+            loaded[key] = data
+            # one sequence per bf holding changed bins
+            for bf_index in numpy.unique(numpy.flatnonzero(changed)//bf_fft_bins):
+                fpga_index, bf = divmod(int(bf_index), bf_be_per_fpga)
+                names = dict([(reg, '%s%s_%s' % (bf_register_prefix, bf, reg))
+                              for reg in ['control', 'stream', 'antenna', 'frequency', 'value_in']])
+                sequence = [(names['control'], 0), (names['stream'], location)]
+                if antenna_index != None:
+                    sequence.append((names['antenna'], antenna_index))
+                value_in = None
+                start = bf_index*bf_fft_bins
+                for reg_index in numpy.flatnonzero(changed[start:start+bf_fft_bins]):
+                    value = int(data[start+reg_index])
+                    sequence.append((names['frequency'], int(reg_index)))
+                    if value != value_in:
+                        sequence.append((names['value_in'], value))
+                    # enable writes once the first value is set up, every write after that triggers one
+                    if value_in == None:
+                        sequence.append((names['control'], control))
+                    value_in = value
+                writes[fpga_index].extend(sequence)
+        n_writes = sum([len(w) for w in writes])
+        if self.config.simulate:
+            for fpga, w in zip(fpgas, writes):
+                print('dummy pipelined load of %i writes to %s' % (len(w), fpga))
+        elif n_writes > 0:
+            def load(fpga, board_writes, window):
+                return fpga.blindwrite_int_pipelined(board_writes, window=window)
+            try:
+                self.fpga_jobs(dict([(fpga.host, w) for fpga, w in zip(fpgas, writes) if len(w) > 0]), load, window)
+            except fbfException:
+                # we no longer know what is loaded
+                self.bf_bulk_cache_clear(destination)
+                raise
+        self._bulk_cache.update(loaded)
+        self.syslogger.debug('Loaded %s values for %i beam/antenna combinations with %i writes' % (destination, len(values), n_writes))
+        return n_writes
+
     def cf_bw2fft_bins(self, centre_frequency, bandwidth):
         """returns fft bins associated with provided centre_frequency and bandwidth
         centre_frequency is assumed to be the centre of the 2^(N-1) fft bin"""
@@ -773,6 +858,8 @@ class fbf:
         else:
             self.syslogger.info('Skipped output configuration of beamformer.')
         if set_cal:
+            # the boards may have been reprogrammed so load everything
+            self.bf_bulk_cache_clear()
             self.cal_set_all(all, spead_issue=False)
         else:
             self.syslogger.info('Skipped calibration config of beamformer.')
@@ -998,16 +1085,28 @@ class fbf:
         """Initialise all antennas for all specified beams' calibration factors to given polynomial.
         If no polynomial or coefficients are given, use defaults from config file."""
         beams = self.beams2beams(beams)
+        keys = []
+        coeffs = []
         # go through all beams specified
         for beam in beams:
             # get all antenna input strings
             ant_strs = self.ants2ants(beam, all)
             # go through all antennas for beams
-            for ant_str in ant_strs:
-                self.cal_spectrum_set(beam=beam, ant_str=ant_str, init_coeffs=init_coeffs,
-                                      init_poly=init_poly, spead_issue=False)
-            # issue spead packet only once all antennas are done, and don't read the values back (we have just set them)
-            if spead_issue:
+            steering = self.cal_steering_get(beam, ant_strs)
+            for ant_n, ant_str in enumerate(ant_strs):
+                keys.append((beam, ant_str))
+                coeffs.append(self.cal_coeffs_select(beam=beam, ant_str=ant_str, init_coeffs=init_coeffs,
+                                                     init_poly=init_poly)*steering[ant_n])
+        # convert everything at once
+        values = {}
+        if len(keys) > 0:
+            fpga_values = self.cal_floats2fpga(data=numpy.concatenate(coeffs)).reshape(len(keys), -1)
+            values = dict(zip(keys, fpga_values))
+        # load all beams and antennas in one go
+        self.bf_bulk_write('calibrate', values)
+        # issue spead packets only once all antennas are done, and don't read the values back (we have just set them)
+        if spead_issue:
+            for beam in beams:
                 self.spead_cal_meta_issue(beam, from_fpga=False)
 
     def cal_default_get(self, beam, ant_str):
@@ -1020,9 +1119,9 @@ class fbf:
             calibration = self.get_beam_param(beam, 'cal_coeffs_input%i' % input_n)
         elif cal_default == 'poly':
             poly = self.get_beam_param(beam, 'cal_poly_input%i' % input_n)
-            calibration = numpy.polyval(poly, list(range(n_coeffs)))
+            calibration = numpy.polyval(poly, numpy.arange(n_coeffs))
             if self.get_param('bf_cal_type') == 'complex':
-                calibration = [cal+0*1j for cal in calibration]
+                calibration = calibration.astype(numpy.complex128)
         else:
             raise fbfException(1, 'Your default beamformer calibration type, %s, is not understood.' % cal_default,
                                'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
@@ -1050,17 +1149,8 @@ class fbf:
                                self.syslogger)
 
     def cal_fpga2floats(self, data):
-        """Converts vector of values in format as from FPGA to float vector"""
-        values = []
-        n_bits = self.get_param('bf_cal_n_bits')
-        bin_pt = self.get_param('bf_cal_bin_pt')
-        for datum in data:
-            val_real = (numpy.int16((datum & 0xFFFF0000) >> 16))
-            val_imag = (numpy.int16(datum & 0x0000FFFF))
-            datum_real = numpy.float(val_real)/(2**bin_pt)
-            datum_imag = numpy.float(val_imag)/(2**bin_pt)
-            values.append(complex(datum_real, datum_imag))
-        return values
+        """Converts vector of values in format as from FPGA to complex float array"""
+        return cal_words2floats(data, self.get_param('bf_cal_bin_pt'))
 
     def cal_spectrum_get(self, beam, ant_str, from_fpga=True):
         """Retrieves the calibration settings currently programmed in all bengines
@@ -1069,50 +1159,31 @@ class fbf:
             # read them directly from fpga
             fpga_values = self.bf_read_int(beam=beam, destination='calibrate', offset=0, antennas=[ant_str],
                                            frequencies=all)
-            # float_values are not assigned here
         else:
-            base_values = self.cal_default_get(beam, ant_str)
+            base_values = numpy.asarray(self.cal_default_get(beam, ant_str))*self.cal_steering_get(beam, [ant_str])[0]
             # calculate values that would be written to fpga
             fpga_values = self.cal_floats2fpga(base_values)
-            float_values = self.cal_fpga2floats(fpga_values)
-        return float_values
+        return self.cal_fpga2floats(fpga_values)
 
     def cal_floats2fpga(self, data):
-        """Convert floating point values to vector for writing to FPGA"""
-        values = []
+        """Convert floating point values to array of values for writing to FPGA"""
         bf_cal_type = self.get_param('bf_cal_type')
         if bf_cal_type == 'scalar':
             data = numpy.real(data)
-        elif bf_cal_type == 'complex':
-            data = numpy.array(data, dtype=numpy.complex128)
-        else:
+        elif bf_cal_type != 'complex':
             raise fbfException(1, 'Sorry, your beamformer calibration type is not supported. Expecting scalar '
                                   'or complex.', 'function %s, line no %s\n'
                                % (__name__, inspect.currentframe().f_lineno), self.syslogger)
-        n_bits = self.get_param('bf_cal_n_bits')
-        bin_pt = self.get_param('bf_cal_bin_pt')
-        whole_bits = n_bits-bin_pt
-        top = 2**(whole_bits-1)-1
-        bottom = -2**(whole_bits-1)
-        if (max(numpy.real(data)) > top or min(numpy.real(data)) < bottom):
-            self.syslogger.info('real calibration values out of range, will saturate')
-        if (max(numpy.imag(data)) > top or min(numpy.imag(data)) < bottom):
-            self.syslogger.info('imaginary calibration values out of range, will saturate')
-        # convert data
-        for datum in data:
-            datum_real = numpy.real(datum)
-            datum_imag = numpy.imag(datum)
-            # shift up for binary point
-            val_real = numpy.int32(datum_real * (2**bin_pt))
-            val_imag = numpy.int32(datum_imag * (2**bin_pt))
-            # pack real and imaginary values into 32 bit value
-            values.append((val_real << 16) | (val_imag & 0x0000FFFF))
+        values, n_real, n_imag = cal_floats2words(data, self.get_param('bf_cal_n_bits'), self.get_param('bf_cal_bin_pt'))
+        if n_real > 0:
+            self.syslogger.warning('%i real calibration values out of range, saturated' % n_real)
+        if n_imag > 0:
+            self.syslogger.warning('%i imaginary calibration values out of range, saturated' % n_imag)
         return values
 
-    def cal_spectrum_set(self, beam, ant_str, init_coeffs=[], init_poly=[], spead_issue=True):
-        """Set given beam and antenna calibration settings to given co-efficients."""
-        if self.config.simulate:
-            print('setting spectrum for beam %s antenna %s' % (beam, ant_str))
+    def cal_coeffs_select(self, beam, ant_str, init_coeffs=[], init_poly=[]):
+        """Returns the calibration coefficients for given beam and antenna from the coefficients or polynomial given,
+        storing them as the new defaults, or the defaults if neither are given."""
         n_coeffs = self.get_param('n_chans')
         if init_coeffs == [] and init_poly == []:
             coeffs = self.cal_default_get(beam=beam, ant_str=ant_str)
@@ -1127,11 +1198,86 @@ class fbf:
         else:
             coeffs = numpy.polyval(init_poly, list(range(n_coeffs)))
             self.cal_default_set(beam, ant_str, init_poly=init_poly)
-            fpga_values = self.cal_floats2fpga(data=coeffs)
-            # write final vector to calibrate block
-            self.bf_write_int('calibrate', fpga_values, offset=0, beams=[beam], antennas=[ant_str], frequencies=all)
+        return coeffs
+
+    def cal_spectrum_set(self, beam, ant_str, init_coeffs=[], init_poly=[], spead_issue=True):
+        """Set given beam and antenna calibration settings to given co-efficients."""
+        if self.config.simulate:
+            print('setting spectrum for beam %s antenna %s' % (beam, ant_str))
+        coeffs = self.cal_coeffs_select(beam=beam, ant_str=ant_str, init_coeffs=init_coeffs, init_poly=init_poly)
+        fpga_values = self.cal_floats2fpga(data=numpy.asarray(coeffs)*self.cal_steering_get(beam, [ant_str])[0])
+        # write final vector to calibrate block, only bins that changed
+        self.bf_bulk_write('calibrate', {(beam, ant_str): fpga_values})
+        if spead_issue:
+            self.spead_cal_meta_issue(beam, from_fpga=False)
+
+# -----------
+#   steering
+# -----------
+
+    def cal_steering_get(self, beam, ant_strs=all):
+        """Returns the steering phasors applied on top of the calibration for the given beam and antennas,
+        an (n_ants x n_chans) complex array"""
+        ant_strs = self.ants2ants(beam, ant_strs)
+        frequencies = self.map_index_get()['frequency']
+        delays = numpy.zeros(len(ant_strs))
+        phases = numpy.zeros(len(ant_strs))
+        offsets = numpy.zeros(len(ant_strs))
+        for ant_n, ant_str in enumerate(ant_strs):
+            delays[ant_n], phases[ant_n], offsets[ant_n] = self._steering.get((beam, ant_str), (0.0, 0.0, 0.0))
+        return numpy.exp(-1j*(phases[:, numpy.newaxis] +
+                              2*numpy.pi*(frequencies[numpy.newaxis, :]+offsets[:, numpy.newaxis])*delays[:, numpy.newaxis]))
+
+    def _steering_values(self, values, ant_strs, name):
+        """Returns delays or phases for beam_steer as an array matching ant_strs: zeros for None, a single value
+        repeated, or exactly one value per antenna"""
+        if values is None:
+            return numpy.zeros(len(ant_strs))
+        values = numpy.asarray(values, dtype=float)
+        if values.ndim == 0:
+            return numpy.repeat(values, len(ant_strs))
+        if values.shape != (len(ant_strs),):
+            raise fbfException(1, 'Got %i %s for %i antennas, need one per antenna or a single value'
+                               % (values.size, name, len(ant_strs)),
+                               'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
+                               self.syslogger)
+        return values
+
+    def beam_steer(self, beam, delays=None, phases=None, ant_strs=all, frequency_offset=0.0, spead_issue=True):
+        """Steers a beam by applying per antenna delays (in seconds, a phase gradient across the band) and phases
+        (in radians) on top of each antenna's calibration: weights are multiplied by exp(-j(phase + 2 pi f delay)).
+        delays and phases are sequences with one value per antenna in ant_strs (any other length raises an fbfException),
+        or single values for all of them; None leaves them at zero.
+        frequency_offset is added to the channel frequencies (eg the centre of the RF band) before applying delays.
+        Only coefficients that change are written, and only calibration meta data is issued.
+        Returns the number of register writes made."""
+        if self.get_param('bf_cal_type') != 'complex':
+            raise fbfException(1, 'Beam steering needs complex calibration weights',
+                               'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno),
+                               self.syslogger)
+        beam = self.beams2beams(beam)[0]
+        ant_strs = self.ants2ants(beam, ant_strs)
+        delays = self._steering_values(delays, ant_strs, 'delays')
+        phases = self._steering_values(phases, ant_strs, 'phases')
+        for ant_n, ant_str in enumerate(ant_strs):
+            self._steering[(beam, ant_str)] = (delays[ant_n], phases[ant_n], frequency_offset)
+        # new weights for all antennas and channels at once
+        coeffs = numpy.array([self.cal_default_get(beam, ant_str) for ant_str in ant_strs], dtype=numpy.complex128)
+        coeffs *= self.cal_steering_get(beam, ant_strs)
+        fpga_values = self.cal_floats2fpga(data=coeffs).reshape(len(ant_strs), -1)
+        n_writes = self.bf_bulk_write('calibrate', dict([((beam, ant_str), fpga_values[ant_n])
+                                                         for ant_n, ant_str in enumerate(ant_strs)]))
         if spead_issue:
             self.spead_cal_meta_issue(beam, from_fpga=False)
+        self.syslogger.info('Steered beam %s with %i register writes' % (beam, n_writes))
+        return n_writes
+
+    def beam_steer_clear(self, beams=all, spead_issue=True):
+        """Removes all steering from the given beams, leaving just the calibration"""
+        n_writes = 0
+        for beam in self.beams2beams(beams):
+            n_writes += self.beam_steer(beam, spead_issue=spead_issue)
+        return n_writes
 
 # -----------
 #   SPEAD
@@ -1357,16 +1503,16 @@ class fbf:
     def spead_cal_meta_issue(self, beams=all, from_fpga=True):
         """Issues a SPEAD heap for the RF gain, EQ settings and calibration settings."""
         beams = self.beams2beams(beams)
-        spead_ig = spead.ItemGroup()
         # override if simulating
         if self.config.simulate:
             from_fpga = False
         for beam in beams:
-            ig = spead_ig
+            # each beam has its own antennas
+            ig = spead.ItemGroup()
             # calibration settings
             for in_n, ant_str in enumerate(self.ants2ants(beam, all)):
-                vals = [[numpy.real(coeff), numpy.imag(coeff)] for coeff in
-                        self.cal_spectrum_get(beam, ant_str, from_fpga)]
+                coeffs = self.cal_spectrum_get(beam, ant_str, from_fpga)
+                vals = numpy.column_stack((coeffs.real, coeffs.imag)).tolist()
                 ig.add_item(name="beamweight_input%s" % ant_str, id=0x2000+in_n, description="The unitless per-channel "
                                                                                              "digital scaling factors "
                                                                                              "implemented prior to "
@@ -1378,8 +1524,8 @@ class fbf:
                             shape=[self.get_param('n_chans'), 2], fmt=spead.mkfmt(('f', 64)), init_val=vals)
             if self.config.simulate:
                 print('Issuing calibration meta data for beam %s' % beam)
-                self.send_spead_heap(beam, ig)
-                self.syslogger.info("Issued SPEAD EQ metadata for beam %s" % beam)
+            self.send_spead_heap(beam, ig)
+            self.syslogger.info("Issued SPEAD calibration metadata for beam %s" % beam)
 
     def spead_issue_all(self, beams=all, from_fpga=True):
         """Issues all SPEAD metadata."""
@@ -46,7 +46,7 @@ class CorrConf:
         self.config_file = config_file
         self.config_file_name = os.path.split(self.config_file)[1]
         self.logger.info('Trying to open log file %s.'%self.config_file)
-        self.cp = iniparse.INIConfig(open(self.config_file, 'rb'))
+        self.cp = iniparse.INIConfig(open(self.config_file, 'r'))
         self.config = dict()
         self.read_mode()
         available_modes = [MODE_WB, MODE_NB, MODE_DDC]
@@ -278,6 +278,11 @@ class CorrConf:
         #get the receiver section:
         self.config['receiver'] = dict()
         self.read_int('receiver','rx_udp_port')
+        # optional; iniparse returns Undefined rather than raising for missing options
+        if 'rx_udp_port_stride' in self.cp['receiver']:
+            self.read_int('receiver','rx_udp_port_stride')
+        else:
+            self.config['rx_udp_port_stride'] = 0
         self.read_str('receiver','out_type')
         self.read_int('receiver','rx_pkt_payload_len')
         #self.read_int('receiver','instance_id')
@@ -250,6 +250,10 @@ class Correlator:
         self.spead_tx = spead.Transmitter(spead.TransportUDPtx(self.config['rx_meta_ip_str'], self.config['rx_udp_port']))
         self.spead_ig = spead.ItemGroup()
 
+        # per-input RF gains and FFT windows used by calibrate_adc_snapshot
+        self._rf_gain_cache = {}
+        self._adc_cal_windows = {}
+
         if connect == True:
             self.connect()
 
@@ -359,6 +363,10 @@ class Correlator:
             rv.append(tuple((self.map_input_to_ant(bl[0]*2+1),self.map_input_to_ant(bl[1]*2))))
         return rv
 
+    def get_bl_reorder(self):
+        """Returns a baselines.BaselineReorder that rearranges the X engine output's baselines into (antenna pair, polarisation product) order."""
+        return corr.baselines.baseline_reorder_get(self.get_bl_order())
+
     def ant_str_to_baseline(self, ant_tuple):
         '''e.g. ('3x', '6y') will return either the baseline (as generated by get_bl_order) or -1, if that pairing doesn't exist.
         '''
@@ -1004,6 +1012,22 @@ class Correlator:
         else: self.syslogger.error('KATCP communication with one or more boards FAILED.')
         return result
 
+    def katcp_stats_enable(self, enable = True):
+        """Starts (from zero) or stops keeping KATCP request statistics on all boards. See katcp_wrapper.RequestStats."""
+        for fpga in self.allfpgas:
+            fpga.stats_enable(enable)
+
+    def katcp_stats_get(self):
+        """KATCP request statistics by request name, for all boards together and for each board: {'all': {...}, host: {...}, ...}."""
+        rv = {'all': corr.katcp_wrapper.stats_merge(self.allfpgas)}
+        for fpga in self.allfpgas:
+            rv[fpga.host] = fpga.stats_get()
+        return rv
+
+    def katcp_stats_report(self, per_board = True):
+        """A text report of the KATCP request statistics, see katcp_wrapper.stats_report."""
+        return corr.katcp_wrapper.stats_report(self.allfpgas, per_board = per_board)
+
     def check_x_miss(self):
         """Returns boolean pass/fail to indicate if any X engine has missed any data, or if the descrambler is stalled."""
         rv = True
@@ -1126,6 +1150,16 @@ class Correlator:
         header['x_eng'] = header['freq_chan'] / (self.config['n_chans'] / self.config['n_xeng'])
         return header
 
+    def decode_10gbe_headers(self, headerdata):
+        """
+        Vectorised decode_10gbe_header: returns a dictionary of arrays of the header fields decoded from an array of 64-bit header words.
+        {mcnt, antbase, timestamp, pcnt, freq_chan, x_eng}
+        Currently only valid for contiguous mode.
+        """
+        if self.config['xeng_format'] != "cont":
+            raise RuntimeError("Only valid for contiguous mode at the moment. Is interleaved mode even valid anymore?!")
+        return decode_10gbe_headers(headerdata, self.config['n_chans'], self.config['n_xeng'])
+
     def check_loopback_mcnt_wait(self,n_retries=40):
         """Waits up to n_retries for loopback muxes to sync before returning false if it is still failing."""
         sys.stdout.flush()
@@ -1757,8 +1791,24 @@ class Correlator:
 #                # Assign an IP address to each XAUI port's associated 10GbE core.
 #                fpga.write_int('gbe_ip%i'%x, ip)
 
-    def config_udp_output(self, dest_ip_str=None, dest_port=None):
-        """Configures the destination IP and port for X engine output. dest_port and dest_ip are optional parameters to override the config file defaults. dest_ip is string in dotted-quad notation."""
+    def _rx_udp_port_stride_check(self, port_stride):
+        """Per-board output ports only work with the inter output format: in cont format all the X engines send parts of the same xeng_raw heap, which would be split across the ports."""
+        if port_stride > 0 and self.config['xeng_format'] != 'inter':
+            raise RuntimeError('rx_udp_port_stride needs the inter X engine output format, but xeng_format is %s.' % self.config['xeng_format'])
+
+    def rx_udp_ports(self):
+        """Returns the list of UDP ports that X engine output goes to: just rx_udp_port, or one port per X engine board if rx_udp_port_stride is set (see config_udp_output)."""
+        self._rx_udp_port_stride_check(self.config['rx_udp_port_stride'])
+        if self.config['rx_udp_port_stride'] > 0:
+            return [self.config['rx_udp_port'] + (xfpga_n * self.config['rx_udp_port_stride']) for xfpga_n in range(len(self.xfpgas))]
+        return [self.config['rx_udp_port']]
+
+    def config_udp_output(self, dest_ip_str=None, dest_port=None, port_stride=None):
+        """Configures the destination IP and port for X engine output. dest_port and dest_ip are optional parameters to override the config file defaults. dest_ip is string in dotted-quad notation.
+           If port_stride (default: rx_udp_port_stride from the config file) is non-zero, X engine board n sends to dest_port + n*port_stride instead,
+           so that the output can be received with one socket and worker per board (see rx.MultiStreamRx). Metadata still goes to dest_port.
+           A port stride needs the inter output format (xeng_format = inter); a RuntimeError is raised otherwise."""
+        self._rx_udp_port_stride_check(port_stride if port_stride!=None else self.config['rx_udp_port_stride'])
         if dest_ip_str==None:
             dest_ip_str=self.config['rx_udp_ip_str']
         else:
@@ -1772,9 +1822,17 @@ class Correlator:
         else:
             self.config['rx_udp_port']=dest_port
 
+        if port_stride!=None:
+            self.config['rx_udp_port_stride']=port_stride
+
         self.xwrite_int_all('gbe_out_ip',struct.unpack('>L',socket.inet_aton(dest_ip_str))[0])
-        self.xwrite_int_all('gbe_out_port',dest_port)
-        self.syslogger.info("Correlator output configured to %s:%i." % (dest_ip_str, dest_port))
+        if self.config['rx_udp_port_stride'] > 0:
+            for xfpga_n,fpga in enumerate(self.xfpgas):
+                fpga.write_int('gbe_out_port',self.rx_udp_ports()[xfpga_n])
+            self.syslogger.info("Correlator output configured to %s, ports %s." % (dest_ip_str, self.rx_udp_ports()))
+        else:
+            self.xwrite_int_all('gbe_out_port',dest_port)
+            self.syslogger.info("Correlator output configured to %s:%i." % (dest_ip_str, dest_port))
 
         # need a new spead transmitter if the port and ip have changed
         self.spead_tx = spead.Transmitter(spead.TransportUDPtx(self.config['rx_meta_ip_str'], self.config['rx_udp_port']))
@@ -1955,22 +2013,40 @@ class Correlator:
         """Retrieves raw ADC samples from the specified antennas. Optionally capture the data at the same time. Optionally set a trigger level."""
         return corr.snap.get_adc_snapshots(self,ant_strs,trig_level=trig_level,sync_to_pps=sync_to_pps)
 
+    def get_adc_snapshots_synced(self, ant_strs = None, wait_period = 3):
+        """Captures raw ADC samples from all the specified antennas (default all) on the same 1PPS edge, in parallel. Returns an (n_inputs x n_samples) array along with per-input timestamps."""
+        return corr.snap.get_adc_snapshots_synced(self, ant_strs = ant_strs, wait_period = wait_period)
+
     def get_quant_snapshot(self, ant_str, n_spectra = 1):
         """Retrieves quantised samples from the output of the FFT for user-specified antennas."""
         return corr.snap.get_quant_snapshot(self, ant_str, n_spectra = n_spectra)
 
-    def calibrate_adc_snapshot(self,ant_str,raw_data,n_chans=256):
-        """Calibrates ADC count raw voltage input in timedomain. Returns samples in mV and a spectrum of n_chans in dBm."""
-        adc_v=raw_data*self.config['adc_v_scale_factor']/(10**((self.rf_status_get(ant_str)[1])/20.))
-        n_accs=len(adc_v)/n_chans/2
-        freqs=numpy.arange(n_chans)*float(self.config['bandwidth'])/n_chans #channel center freqs in Hz. #linspace(0,float(bandwidth),n_chans) returns incorrect numbers
-        window=numpy.hamming(n_chans*2)
-        spectrum=numpy.zeros(n_chans)
-        for acc in range(n_accs):
-            spectrum += numpy.abs((numpy.fft.rfft(adc_v[n_chans*2*acc:n_chans*2*(acc+1)]*window)[0:n_chans]))
-        spectrum  = 20*numpy.log10(spectrum/n_accs/n_chans*4.91)
-        return {'freqs':freqs,'spectrum_dbm':spectrum,'adc_v':adc_v}
-
+    def calibrate_adc_snapshot(self, ant_str, raw_data, n_chans = 256, overlap = 0.0, rf_gain = None):
+        """Calibrates ADC count raw voltage input in timedomain. Returns samples in mV and a spectrum of n_chans in dBm.
+        ant_str can be a list of antennas, in which case raw_data should be an (n_inputs x n_samples) array and the returned adc_v and spectrum_dbm have a row per input.
+        The spectrum is the average of windowed FFTs over segments of 2*n_chans samples, overlapping by the given fraction.
+        RF gains are read from the hardware the first time an input is calibrated and cached thereafter (rf_gain_set updates the cache). Pass rf_gain (one value per input, or a single value for all of them) to override."""
+        ant_strs = [ant_str] if isinstance(ant_str, str) else list(ant_str)
+        if rf_gain is None:
+            rf_gain = [self.rf_gain_cached_get(a) for a in ant_strs]
+        rf_gain = numpy.asarray(rf_gain, dtype = float)
+        if rf_gain.ndim == 0:
+            rf_gain = numpy.repeat(rf_gain, len(ant_strs))
+        elif rf_gain.shape != (len(ant_strs),):
+            raise RuntimeError('Got %i RF gains for %i inputs, need one per input or a single value.' % (rf_gain.size, len(ant_strs)))
+        raw_data = numpy.asarray(raw_data)
+        scale = self.config['adc_v_scale_factor'] / (10**(rf_gain / 20.))
+        if raw_data.ndim == 1:
+            adc_v = raw_data * scale[0]
+        else:
+            adc_v = raw_data * scale[:, numpy.newaxis]
+        freqs = numpy.arange(n_chans) * float(self.config['bandwidth']) / n_chans #channel center freqs in Hz. #linspace(0,float(bandwidth),n_chans) returns incorrect numbers
+        if n_chans not in self._adc_cal_windows:
+            self._adc_cal_windows[n_chans] = numpy.hamming(n_chans * 2)
+        spectrum = adc_spectrum_calc(adc_v, n_chans, window = self._adc_cal_windows[n_chans], overlap = overlap)
+        with numpy.errstate(divide = 'ignore'):
+            spectrum = 20 * numpy.log10(spectrum / n_chans * 4.91)
+        return {'freqs': freqs, 'spectrum_dbm': spectrum, 'adc_v': adc_v}
 
     def check_xaui_sync(self):
         """Checks if all F engines are in sync by examining mcnts at sync of incomming XAUI streams. \n
@@ -2027,9 +2103,16 @@ class Correlator:
         if gain > 20 or gain < -11.5:
             log_runtimeerror(self.floggers[ffpga_n], "Invalid gain setting of %i. Valid range for KATADC is -11.5 to +20")
         self.ffpgas[ffpga_n].write_int('adc_ctrl%i' % feng_input, (1<<31) + int((20 - gain) * 2))
+        self._rf_gain_cache[ant_str] = 20 - int((20 - gain) * 2) * 0.5
         #self.config.write('equalisation','rf_gain_%s'%(ant_str),gain)
         self.floggers[ffpga_n].info("KATADC %i RF gain set to %2.1f." % (feng_input, round(gain * 2) / 2))
 
+    def rf_gain_cached_get(self, ant_str):
+        """Returns the RF gain in dB for the given input, only querying the hardware if it hasn't been read or set before."""
+        if ant_str not in self._rf_gain_cache:
+            self._rf_gain_cache[ant_str] = self.rf_status_get(ant_str)[1]
+        return self._rf_gain_cache[ant_str]
+
     def rf_status_get(self,ant_str):
         """Grabs the current value of the RF attenuators and RF switch state for KATADC boards.
             Returns (enabled,gain in dB)"""
@@ -2471,8 +2554,12 @@ class Correlator:
                     description="Raw data for xengine %i out of %i. Frequency channels are split amongst xengines. Frequencies are distributed to xengines in a round-robin fashion, starting with engine 0. Data from all X engines must thus be combed or interleaved together to get continuous frequencies. Each xengine calculates all baselines (n_bls given by SPEAD ID 0x100B) for a given frequency channel. For a given baseline, -SPEAD ID 0x1040- stokes parameters are calculated (nominally 4 since xengines are natively dual-polarisation; software remapping is required for single-baseline designs). Each stokes parameter consists of a complex number (two real and imaginary unsigned integers)."%(x,self.config['n_xeng']),
                     ndarray=(numpy.dtype(numpy.int32),(self.config['n_chans']/self.config['n_xeng'],self.config['n_bls'],2)))
 
-        self.spead_tx.send_heap(self.spead_ig.get_heap())
-        self.syslogger.info("Issued SPEAD data descriptor to %s:%i."%(self.config['rx_meta_ip_str'],self.config['rx_udp_port']))
+        heap = self.spead_ig.get_heap()
+        self.spead_tx.send_heap(heap)
+        # receivers of the other output ports need the descriptors too
+        for port in self.rx_udp_ports()[1:]:
+            spead.Transmitter(spead.TransportUDPtx(self.config['rx_meta_ip_str'], port)).send_heap(heap)
+        self.syslogger.info("Issued SPEAD data descriptor to %s:%s."%(self.config['rx_meta_ip_str'],','.join([str(port) for port in self.rx_udp_ports()])))
 
     def spead_issue_all(self):
         """Issues all SPEAD metadata."""
@@ -2492,6 +2579,35 @@ class Correlator:
     def is_ddc(self):
         return self.config['mode'] == CORR_MODE_DDC
 
+def adc_spectrum_calc(adc_v, n_chans, window = None, overlap = 0.0):
+    """Averaged magnitude spectrum of time-domain samples, Welch-style.
+    adc_v is a 1-D array of samples or an (n_inputs x n_samples) array. It is split into segments of 2*n_chans samples,
+    each overlapping the previous one by the given fraction (0 <= overlap < 1), which are windowed (default Hamming) and
+    FFT'd in one go. Returns the mean magnitude of the first n_chans bins of each input's segments."""
+    if not (0 <= overlap < 1):
+        raise RuntimeError('Overlap must be in the range [0,1). Got %f.' % overlap)
+    adc_v = numpy.ascontiguousarray(adc_v, dtype = float)
+    seg_len = n_chans * 2
+    step = max(1, int(round(seg_len * (1 - overlap))))
+    n_accs = 0 if adc_v.shape[-1] < seg_len else ((adc_v.shape[-1] - seg_len) // step) + 1
+    if window is None:
+        window = numpy.hamming(seg_len)
+    if n_accs == 0:
+        return numpy.zeros(adc_v.shape[:-1] + (n_chans,))
+    # a strided (n_accs x seg_len) view per input, no copying of the samples
+    segments = numpy.lib.stride_tricks.as_strided(adc_v, shape = adc_v.shape[:-1] + (n_accs, seg_len),
+        strides = adc_v.strides[:-1] + (adc_v.strides[-1] * step, adc_v.strides[-1]))
+    return numpy.abs(numpy.fft.rfft(segments * window, axis = -1)[..., 0:n_chans]).mean(axis = -2)
+
+def decode_10gbe_headers(headerdata, n_chans, n_xeng):
+    """Decodes an array of 64-bit X engine packet header words into a dictionary of arrays {mcnt, antbase, timestamp, pcnt, freq_chan, x_eng}, for contiguous mode."""
+    headerdata = numpy.asarray(headerdata, dtype = numpy.uint64)
+    fbits = numpy.uint64(int(numpy.log2(n_chans)))
+    mcnt = headerdata >> numpy.uint64(16)
+    freq_chan = mcnt % numpy.uint64(n_chans)
+    return {'mcnt': mcnt, 'antbase': headerdata & numpy.uint64((2**16) - 1), 'timestamp': mcnt >> fbits,
+        'pcnt': mcnt & numpy.uint64(n_chans - 1), 'freq_chan': freq_chan, 'x_eng': freq_chan // numpy.uint64(n_chans // n_xeng)}
+
 def dbm_to_dbuv(dbm):
     return dbm+107
 
@@ -0,0 +1,636 @@
+"""
+A fake ROACH for testing and benchmarking control software without hardware.
+
+FakeRoach is a KATCP server that answers the requests FpgaClient makes of a ROACH's tcpborphserver (listdev, listbof,
+progdev, status, watchdog, read, write, wordread, wordwrite, bulkread, upload and the tap-* requests) from an in-memory
+register space. The registers come from a register map: a dictionary of name to size in bytes, or a file with one
+register per line, the size last (eg a core_info.tab from a bof build: name, mode, address, size, in decimal or hex).
+Registers that aren't in the map are created when first written to, unless the server is strict.
+
+The network and the board can be made slower: replies are delayed by latency seconds plus up to jitter seconds (so
+pipelined requests overlap as they would over a real network), every request holds up the ones behind it on the same
+connection for service_time seconds, and programming takes progdev_time seconds.
+
+Registers can be given behaviour by RegisterModels, which are run as their registers are read and written, against a
+VirtualClock: free running counters, F engine arming and master counts, timed loads (delays, VACCs), snap blocks that
+capture synthetic data and the beamformer's indirect registers. correlator_models gives a correlator's set.
+
+fake_roaches_start starts any number of them on consecutive loopback addresses (127.0.0.1, 127.0.0.2, ...) so that a
+correlator config file listing those addresses as its servers runs against them on one machine.
+
+Revs:
+2013-03-28  Initial.
+2013-03-29  Register behaviour models.
+"""
+
+from __future__ import absolute_import
+import socket, threading, time, logging, random, re, math, struct
+import numpy as np
+import six
+from six.moves import queue
+
+KATCP_ESCAPES = {b'\\': b'\\\\', b' ': b'\\_', b'\0': b'\\0', b'\n': b'\\n', b'\r': b'\\r', b'\x1b': b'\\e', b'\t': b'\\t'}
+KATCP_UNESCAPES = dict([(v[1:2], k) for k, v in KATCP_ESCAPES.items()])
+
+def katcp_escape(arg):
+    """Escapes one KATCP message argument (a byte string)."""
+    if len(arg) == 0:
+        return b'\\@'
+    return re.sub(b'[\\\\ \0\n\r\x1b\t]', lambda m: KATCP_ESCAPES[m.group(0)], arg)
+
+def katcp_unescape(arg):
+    if arg == b'\\@':
+        return b''
+    return re.sub(b'\\\\(.)', lambda m: KATCP_UNESCAPES.get(m.group(1), m.group(1)), arg)
+
+def _katcp_bytes(arg):
+    if isinstance(arg, bytes):
+        return arg
+    return str(arg).encode()
+
+def katcp_message(mtype, name, args = [], mid = None):
+    """Formats a KATCP message line. mtype is one of ?, ! or #."""
+    words = [mtype.encode() + name.encode() + (('[%s]' % mid).encode() if mid != None else b'')]
+    return b' '.join(words + [katcp_escape(_katcp_bytes(arg)) for arg in args]) + b'\n'
+
+def katcp_parse(line):
+    """Returns (type, name, message id or None, arguments) for a KATCP message line."""
+    words = [w for w in line.rstrip(b'\r\n').split(b' ') if len(w) > 0]
+    match = re.match(r'^([?!#])([A-Za-z][A-Za-z0-9_-]*)(\[(\d+)\])?$', words[0].decode())
+    if match == None:
+        raise RuntimeError('Badly formed KATCP message: %r' % line)
+    return match.group(1), match.group(2), match.group(4), [katcp_unescape(w) for w in words[1:]]
+
+def register_map_load(filename):
+    """Reads a register map file: one register per line, name first and size (bytes, decimal or 0x hex) last. Blank
+        lines and anything after a # are ignored. Returns a list of (name, size)."""
+    registers = []
+    for line in open(filename):
+        words = line.split('#')[0].split()
+        if len(words) == 0:
+            continue
+        if len(words) < 2:
+            raise RuntimeError('No size for register %s in %s.' % (words[0], filename))
+        registers.append((words[0], int(words[-1], 0)))
+    return registers
+
+class RegisterSpace:
+    """Named byte arrays, shared by all the connections to a FakeRoach."""
+    def __init__(self, registers = [], auto_create = True):
+        self.auto_create = auto_create
+        self._lock = threading.Lock()
+        self.load(registers)
+
+    def load(self, registers):
+        """Replaces the registers with zeroed ones from a list of (name, size) or a dictionary."""
+        if isinstance(registers, dict):
+            registers = list(registers.items())
+        with self._lock:
+            self.registers = dict([(name, bytearray(size)) for name, size in registers])
+            self.names = [name for name, size in registers]
+
+    def size(self, name):
+        return len(self.registers[name])
+
+    def _get(self, name, end):
+        if name not in self.registers:
+            if not self.auto_create:
+                raise RuntimeError('No register %s.' % name)
+            self.registers[name] = bytearray(end)
+            self.names.append(name)
+        reg = self.registers[name]
+        if end > len(reg):
+            if not self.auto_create:
+                raise RuntimeError('Access to byte %i of register %s, which is only %i bytes.' % (end, name, len(reg)))
+            reg.extend(bytearray(end - len(reg)))
+        return reg
+
+    def read(self, name, offset, size):
+        with self._lock:
+            return bytes(self._get(name, offset + size)[offset:offset + size])
+
+    def write(self, name, offset, data):
+        with self._lock:
+            self._get(name, offset + len(data))[offset:offset + len(data)] = data
+
+class VirtualClock:
+    """The time the fake boards see: seconds since the Unix epoch, running rate times faster than real time from when
+        it was made, plus whatever advance() adds. Keep rate at 1 with a Correlator, which times things with time.time().
+        sync_time is the time of the last F engine trigger, shared by all the boards using the clock."""
+    def __init__(self, rate = 1.0):
+        self.rate = rate
+        self._start = time.time()
+        self._offset = 0.0
+        self.sync_time = float(int(self._start))
+
+    def now(self):
+        return self._start + (time.time() - self._start) * self.rate + self._offset
+
+    def advance(self, seconds):
+        self._offset += seconds
+
+class RegisterModel:
+    """Base for register behaviour models. A model is attached to the registers its pattern (a regular expression)
+        matches. FakeRoach calls read(roach, name) before reading such a register, so the model can bring its contents up
+        to date, and write(roach, name) after writing one. Models keep their state in roach.model_state, so a model can
+        be shared by many boards."""
+    pattern = r'^$'
+
+    def read(self, roach, name):
+        pass
+
+    def write(self, roach, name):
+        pass
+
+def _names_pattern(names):
+    return r'^(%s)$' % '|'.join([re.escape(name) for name in names])
+
+class Counter(RegisterModel):
+    """Free running counters: each register matching pattern counts up at rate per second of the board's clock, from
+        zero when first read after programming or from whatever was last written to it, wrapping at bits bits."""
+    def __init__(self, pattern, rate, bits = 32):
+        self.pattern = pattern
+        self.rate = rate
+        self.bits = bits
+
+    def read(self, roach, name):
+        base, value = roach.model_state.setdefault(('counter', name), (roach.clock.now(), 0))
+        roach.write_int(name, (value + int((roach.clock.now() - base) * self.rate)) % (1 << self.bits))
+
+    def write(self, roach, name):
+        roach.model_state[('counter', name)] = (roach.clock.now(), roach.read_uint(name))
+
+class FengineTiming(RegisterModel):
+    """F engine arming and master counter. A rising edge on arm_bit of control arms the board, and it triggers on the
+        sync_delay'th PPS (whole second of the clock) after that, which also becomes the clock's sync_time. pps_count
+        reads bit 31 set while armed and the seconds since the last trigger in the rest; mcount_msw and mcount_lsw the
+        48 bit master count, at mcnt_rate per second since the last trigger."""
+    def __init__(self, mcnt_rate, sync_delay = 2, arm_bit = 2, control = 'control', pps_count = 'pps_count',
+            mcount_msw = 'mcount_msw', mcount_lsw = 'mcount_lsw'):
+        self.mcnt_rate = mcnt_rate
+        self.sync_delay = sync_delay
+        self.arm_bit = arm_bit
+        self.control = control
+        self.pps_count = pps_count
+        self.mcount_msw = mcount_msw
+        self.mcount_lsw = mcount_lsw
+        self.pattern = _names_pattern([control, pps_count, mcount_msw, mcount_lsw])
+
+    def write(self, roach, name):
+        if name != self.control:
+            return
+        value = roach.read_uint(name)
+        if (value >> self.arm_bit) & 1 and not (roach.model_state.get('feng_control', 0) >> self.arm_bit) & 1:
+            roach.model_state['feng_trigger'] = float(math.ceil(roach.clock.now()) + self.sync_delay - 1)
+        roach.model_state['feng_control'] = value
+
+    def read(self, roach, name):
+        now = roach.clock.now()
+        trigger = roach.model_state.get('feng_trigger')
+        if trigger != None and now >= trigger:
+            roach.model_state['sync_time'] = roach.clock.sync_time = trigger
+            roach.model_state['feng_trigger'] = trigger = None
+        since = now - roach.model_state.get('sync_time', roach.clock.sync_time)
+        if name == self.pps_count:
+            roach.write_int(name, ((trigger != None) << 31) | (int(since) & 0x7fffffff))
+        elif name != self.control:
+            mcnt = int(since * self.mcnt_rate) & 0xffffffffffff
+            roach.write_int(self.mcount_msw, mcnt >> 32)
+            roach.write_int(self.mcount_lsw, mcnt & 0xffffffff)
+
+class TimedLoad(RegisterModel):
+    """A load at a given count, as for F engine delays (ld_time_msw/lsw, delay_tr_status) and X engine VACCs
+        (vacc_time_msw/lsw, vacc_ld_statusN). A rising edge on bit 31 of msw arms a load at count (msw & 0x7fffffff) << 32
+        | lsw, incrementing the arm count of each status register; the load count is incremented once the board's count,
+        at rate per second since its sync time, has reached it. Status registers read arm count << 16 | load count. A
+        rising edge on reset_bit of reset_register, if given, clears both counts."""
+    def __init__(self, rate, statuses, msw, lsw, reset_register = None, reset_bit = 0):
+        self.rate = rate
+        self.statuses = statuses
+        self.msw = msw
+        self.lsw = lsw
+        self.reset_register = reset_register
+        self.reset_bit = reset_bit
+        self.pattern = _names_pattern(statuses + [msw, lsw] + ([reset_register] if reset_register != None else []))
+
+    def _state(self, roach):
+        return roach.model_state.setdefault(('load', self.msw), {'arm_cnt': 0, 'ld_cnt': 0, 'target': None, 'msw': 0, 'reset': 0})
+
+    def write(self, roach, name):
+        state = self._state(roach)
+        value = roach.read_uint(name)
+        if name == self.msw:
+            if value >> 31 and not state['msw'] >> 31:
+                state['target'] = ((value & 0x7fffffff) << 32) | roach.read_uint(self.lsw)
+                state['arm_cnt'] = (state['arm_cnt'] + 1) & 0xffff
+            state['msw'] = value
+        elif name == self.reset_register:
+            if (value >> self.reset_bit) & 1 and not (state['reset'] >> self.reset_bit) & 1:
+                state.update(arm_cnt = 0, ld_cnt = 0, target = None)
+            state['reset'] = value
+
+    def read(self, roach, name):
+        if name not in self.statuses:
+            return
+        state = self._state(roach)
+        count = int((roach.clock.now() - roach.model_state.get('sync_time', roach.clock.sync_time)) * self.rate)
+        if state['target'] != None and count >= state['target']:
+            state['ld_cnt'] = (state['ld_cnt'] + 1) & 0xffff
+            state['target'] = None
+        roach.write_int(name, (state['arm_cnt'] << 16) | state['ld_cnt'])
+
+class Snapshot(RegisterModel):
+    """Snap blocks named in names (default: any NAME with NAME_ctrl and NAME_status registers). A rising edge on bit 0
+        of NAME_ctrl starts a capture taking capture_time seconds, during which NAME_status reads bit 31 set, and after
+        which it reads the number of bytes captured with NAME_bram holding them: data(roach, n_bytes) (default random
+        bytes), n_bytes being the size of NAME_bram in the register map or n_bytes if it isn't there."""
+    def __init__(self, names = None, n_bytes = 8192, capture_time = 0.001, data = None):
+        self.n_bytes = n_bytes
+        self.capture_time = capture_time
+        self.data = data if data != None else lambda roach, n: np.random.RandomState(roach._random.randint(0, 2**31 - 1)).randint(0, 256, n).astype(np.uint8).tobytes()
+        self.pattern = r'^(%s)_(ctrl|status)$' % ('.+' if names == None else '|'.join([re.escape(name) for name in names]))
+
+    def write(self, roach, name):
+        if not name.endswith('_ctrl'):
+            return
+        snap = name[:-len('_ctrl')]
+        value = roach.read_uint(name)
+        state = roach.model_state.setdefault(('snapshot', snap), {'ctrl': 0, 'done': None})
+        if value & 1 and not state['ctrl'] & 1:
+            state['done'] = roach.clock.now() + self.capture_time
+            roach.write_int(snap + '_status', 0x80000000)
+        state['ctrl'] = value
+
+    def read(self, roach, name):
+        if not name.endswith('_status'):
+            return
+        snap = name[:-len('_status')]
+        state = roach.model_state.get(('snapshot', snap))
+        if state == None or state['done'] == None or roach.clock.now() < state['done']:
+            return
+        n_bytes = roach.space.size(snap + '_bram') if snap + '_bram' in roach.space.registers else self.n_bytes
+        roach.space.write(snap + '_bram', 0, self.data(roach, n_bytes))
+        roach.write_int(name, n_bytes)
+        state['done'] = None
+
+class IndirectMemory(RegisterModel):
+    """Memories behind control/stream/antenna/frequency/value_in/value_out register sets, as in the beamformer's
+        PREFIX_control etc (prefixes matching the regular expression prefix). While any of the low 8 bits of control is
+        set, value_in is stored for each of those destinations at the location stream, antenna, frequency, whenever one
+        of those registers is written. value_out reads the value at that location for destination (control >> 16) & 255."""
+    REGISTERS = ['control', 'stream', 'antenna', 'frequency', 'value_in', 'value_out']
+
+    def __init__(self, prefix = r'bf\d+'):
+        self.pattern = r'^(%s)_(%s)$' % (prefix, '|'.join(self.REGISTERS))
+
+    def _location(self, roach, prefix):
+        return tuple([roach.read_uint('%s_%s' % (prefix, reg)) for reg in ['stream', 'antenna', 'frequency']])
+
+    def write(self, roach, name):
+        prefix, reg = re.match(self.pattern, name).groups()
+        if reg == 'value_out':
+            return
+        control = roach.read_uint(prefix + '_control')
+        if control & 0xff == 0:
+            return
+        memory = roach.model_state.setdefault(('indirect', prefix), {})
+        location = self._location(roach, prefix)
+        value = roach.read_uint(prefix + '_value_in')
+        for destination in range(8):
+            if (control >> destination) & 1:
+                memory[(destination,) + location] = value
+
+    def read(self, roach, name):
+        if not name.endswith('_value_out'):
+            return
+        prefix = re.match(self.pattern, name).group(1)
+        memory = roach.model_state.get(('indirect', prefix), {})
+        destination = (roach.read_uint(prefix + '_control') >> 16) & 0xff
+        roach.write_int(name, memory.get((destination,) + self._location(roach, prefix), 0))
+
+def correlator_models(config, gbe_rate = 100000.0):
+    """The models for a correlator's boards, given its config (a cn_conf.CorrConf): F engine arming and master counts,
+        delay and VACC loads, 10GbE packet counters (gbe_rate packets per second), VACC dump counters, snap blocks and
+        the beamformer's indirect registers."""
+    models = [FengineTiming(config['mcnt_scale_factor'], config['feng_sync_delay']),
+        TimedLoad(config['pcnt_scale_factor'], ['vacc_ld_status%i' % x for x in range(config['x_per_fpga'])], 'vacc_time_msw',
+            'vacc_time_lsw', reset_register = 'ctrl', reset_bit = 0),
+        Counter(r'^gbe_(tx|rx)_cnt\d+$', gbe_rate),
+        Counter(r'^vacc_cnt\d+$', 1.0 / config['int_time']),
+        Snapshot(),
+        IndirectMemory()]
+    for n in range(int(config['f_inputs_per_fpga'])):
+        models.append(TimedLoad(config['mcnt_scale_factor'], ['delay_tr_status%i' % n], 'ld_time_msw%i' % n, 'ld_time_lsw%i' % n))
+    return models
+
+class FakeRoach:
+    """A KATCP server pretending to be a ROACH's tcpborphserver, see the module description. port 0 picks a free port.
+        registers is a register map (a file name, a list of (name, size) or a dictionary) loaded whenever a bof is
+        programmed; the board starts programmed unless programmed is False. models is a list of RegisterModels giving
+        registers behaviour (see model_add), run on clock (a VirtualClock). Counts of requests and bytes received
+        and sent, by request name, are kept in request_counts, bytes_in and bytes_out."""
+    def __init__(self, host = '127.0.0.1', port = 0, registers = {}, bofs = ['fake.bof'], programmed = True, latency = 0.0,
+            jitter = 0.0, service_time = 0.0, progdev_time = 0.0, auto_create = True, models = [], clock = None, seed = None,
+            logger = None):
+        self.logger = logger if logger != None else logging.getLogger('fake_roach')
+        self.register_map = register_map_load(registers) if isinstance(registers, six.string_types) else registers
+        self.space = RegisterSpace(self.register_map if programmed else [], auto_create = auto_create)
+        self.bofs = list(bofs)
+        self.programmed = programmed
+        self.latency = latency
+        self.jitter = jitter
+        self.service_time = service_time
+        self.progdev_time = progdev_time
+        self.taps = {}
+        self.uploads = []
+        self._random = random.Random(seed)
+        self.clock = clock if clock != None else VirtualClock()
+        self.model_state = {}
+        self._models = []
+        self._model_cache = {}
+        self._model_lock = threading.RLock()
+        for model in models:
+            self.model_add(model)
+        self._counts_lock = threading.Lock()
+        self.reset_counts()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()
+        self._running = False
+        self._connections = []
+        self._thread = None
+
+    def reset_counts(self):
+        with self._counts_lock:
+            self.request_counts = {}
+            self.bytes_in = {}
+            self.bytes_out = {}
+
+    def model_add(self, model, pattern = None):
+        """Attaches a RegisterModel to the registers matching pattern (a regular expression, default the model's own).
+            Where several models match a register, the first added wins."""
+        with self._model_lock:
+            self._models.append((re.compile(pattern if pattern != None else model.pattern), model))
+            self._model_cache = {}
+
+    def _model(self, name):
+        try:
+            return self._model_cache[name]
+        except KeyError:
+            model = None
+            for pattern, m in self._models:
+                if pattern.match(name):
+                    model = m
+                    break
+            self._model_cache[name] = model
+            return model
+
+    def _model_read(self, name):
+        model = self._model(name)
+        if model != None:
+            with self._model_lock:
+                model.read(self, name)
+
+    def _model_write(self, name):
+        model = self._model(name)
+        if model != None:
+            with self._model_lock:
+                model.write(self, name)
+
+    def read_uint(self, name, offset = 0):
+        """Reads a 32 bit word of a register directly, bypassing any model."""
+        return struct.unpack('>I', self.space.read(name, offset * 4, 4))[0]
+
+    def write_int(self, name, value, offset = 0):
+        """Writes a 32 bit word of a register directly, bypassing any model."""
+        self.space.write(name, offset * 4, struct.pack('>I', value & 0xffffffff))
+
+    def start(self):
+        """Starts serving, in a background thread."""
+        self.sock.listen(16)
+        self.sock.settimeout(0.2)
+        self._running = True
+        self._thread = threading.Thread(target = self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        self.logger.info('Fake ROACH listening on %s:%i.' % (self.host, self.port))
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread != None:
+            self._thread.join()
+        for conn in self._connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+        self.sock.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connections.append(conn)
+            replies = queue.Queue()
+            for target, args in [(self._serve, (conn, replies)), (self._send, (conn, replies))]:
+                thread = threading.Thread(target = target, args = args)
+                thread.daemon = True
+                thread.start()
+
+    def _serve(self, conn, replies):
+        """Handles the requests on a connection in order, queueing the replies for _send."""
+        buf = b''
+        try:
+            while self._running:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    if len(line.strip()) == 0:
+                        continue
+                    if self.service_time > 0:
+                        time.sleep(self.service_time)
+                    replies.put((time.time() + self.latency + self._random.uniform(0, self.jitter), self.handle(line + b'\n')))
+        except socket.error:
+            pass
+        replies.put(None)
+
+    def _send(self, conn, replies):
+        """Sends replies in order, each no sooner than its due time."""
+        while True:
+            item = replies.get()
+            if item == None:
+                break
+            due, data = item
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                conn.sendall(data)
+            except socket.error:
+                break
+
+    def handle(self, line):
+        """Handles a single request line, returning the informs and reply to send back."""
+        try:
+            mtype, name, mid, args = katcp_parse(line)
+        except RuntimeError as err:
+            return katcp_message('#', 'log', ['error', '%i' % (time.time() * 1000), 'fake_roach', str(err)])
+        if mtype != '?':
+            return b''
+        handler = getattr(self, 'request_' + name.replace('-', '_'), None)
+        if handler == None:
+            reply, informs = ['invalid', 'Unknown request.'], []
+        else:
+            try:
+                reply, informs = handler(*[a.decode() if n < self._binary_arg(name) else a for n, a in enumerate(args)])
+            except Exception as err:
+                reply, informs = ['fail', str(err)], []
+        out = b''.join([katcp_message('#', name, inform, mid) for inform in informs]) + katcp_message('!', name, reply, mid)
+        with self._counts_lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+            self.bytes_in[name] = self.bytes_in.get(name, 0) + len(line)
+            self.bytes_out[name] = self.bytes_out.get(name, 0) + len(out)
+        return out
+
+    def _binary_arg(self, name):
+        """Index of the first argument of a request left as bytes (the data of a write)."""
+        return 2 if name == 'write' else 1 << 16
+
+    def _program(self, bof):
+        if self.progdev_time > 0:
+            time.sleep(self.progdev_time)
+        self.space.load(self.register_map if bof != None else [])
+        with self._model_lock:
+            self.model_state = {}
+        self.programmed = bof != None
+
+    def _check_programmed(self):
+        if not self.programmed:
+            raise RuntimeError('FPGA not programmed.')
+
+    # requests, named as tcpborphserver's, with '-' as '_'
+
+    def request_watchdog(self):
+        return ['ok'], []
+
+    def request_status(self):
+        return ['ok', 'programmed' if self.programmed else 'not programmed'], []
+
+    def request_listbof(self):
+        return ['ok', len(self.bofs)], [[bof] for bof in self.bofs]
+
+    def request_listdev(self, size = None):
+        self._check_programmed()
+        if size == 'size':
+            return ['ok', len(self.space.names)], [[name, self.space.size(name)] for name in self.space.names]
+        return ['ok', len(self.space.names)], [[name] for name in self.space.names]
+
+    def request_progdev(self, bof = None):
+        if bof != None and bof not in self.bofs:
+            raise RuntimeError('No bof file %s.' % bof)
+        self._program(bof)
+        return ['ok'], []
+
+    def request_read(self, name, offset, size):
+        self._check_programmed()
+        self._model_read(name)
+        return ['ok', self.space.read(name, int(offset, 0), int(size, 0))], []
+
+    def request_bulkread(self, name, offset, size, chunk = 1024):
+        self._check_programmed()
+        self._model_read(name)
+        data = self.space.read(name, int(offset, 0), int(size, 0))
+        return ['ok', len(data)], [[data[n:n + chunk]] for n in range(0, len(data), chunk)]
+
+    def request_write(self, name, offset, data):
+        self._check_programmed()
+        name = name.decode() if isinstance(name, bytes) else name
+        self.space.write(name, int(offset, 0), data)
+        self._model_write(name)
+        return ['ok'], []
+
+    def request_wordread(self, name, offset = '0'):
+        self._check_programmed()
+        self._model_read(name)
+        return ['ok', '0x%08x' % self.read_uint(name, int(offset.split(':')[0], 0))], []
+
+    def request_wordwrite(self, name, offset, value):
+        self._check_programmed()
+        self.write_int(name, int(value, 0), int(offset, 0))
+        self._model_write(name)
+        return ['ok'], []
+
+    def request_upload(self, port):
+        """Receives a bof file on a TCP connection to port and programs it."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, int(port)))
+        listener.listen(1)
+        listener.settimeout(10)
+        try:
+            conn, addr = listener.accept()
+            chunks = []
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            conn.close()
+        finally:
+            listener.close()
+        self.uploads.append(b''.join(chunks))
+        self._program('upload')
+        return ['ok'], []
+
+    def request_tap_start(self, tap_dev, device, ip, port, mac):
+        self.taps[tap_dev] = {'device': device, 'ip': ip, 'port': int(port), 'mac': mac, 'multicast': []}
+        return ['ok'], []
+
+    def request_tap_stop(self, device):
+        for tap_dev in [t for t, tap in self.taps.items() if tap['device'] == device or t == device]:
+            self.taps.pop(tap_dev)
+        return ['ok'], []
+
+    def request_tap_multicast_add(self, tap_dev, mode, ip):
+        self.taps.setdefault(tap_dev, {'multicast': []})['multicast'].append((mode, ip))
+        return ['ok'], []
+
+    def request_tap_multicast_remove(self, tap_dev):
+        self.taps.get(tap_dev, {})['multicast'] = []
+        return ['ok'], []
+
+    def request_tap_arp_config(self, tap_dev, key, value):
+        return ['ok'], []
+
+    def request_tap_arp_reload(self, tap_dev):
+        return ['ok'], []
+
+    def request_help(self):
+        names = sorted([n[len('request_'):].replace('_', '-') for n in dir(self) if n.startswith('request_')])
+        return ['ok', len(names)], [[name] for name in names]
+
+def fake_roaches_start(n_roaches, port = 7147, first_host = '127.0.0.1', **kwargs):
+    """Starts n_roaches FakeRoaches listening on port at consecutive loopback addresses from first_host (eg 127.0.0.1,
+        127.0.0.2, ...), with the FakeRoach arguments given, sharing one VirtualClock unless clock is given. Returns the
+        list of them, running."""
+    base = [int(b) for b in first_host.split('.')]
+    kwargs.setdefault('clock', VirtualClock())
+    roaches = []
+    try:
+        for n in range(n_roaches):
+            host = '%i.%i.%i.%i' % (base[0], base[1], base[2] + (base[3] + n) // 256, (base[3] + n) % 256)
+            roaches.append(FakeRoach(host = host, port = port, **kwargs).start())
+    except:
+        for roach in roaches:
+            roach.stop()
+        raise
+    return roaches
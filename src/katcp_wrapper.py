@@ -6,11 +6,13 @@
    @Revised 2010/06/28 to include qdr stuff
    @Revised 2010/01/07 to include bulkread
    @Revised 2009/12/01 to include print 10gbe core details.
+   @Revised 2013/03/29 to include per request statistics
    """
 
 from __future__ import absolute_import
 from __future__ import print_function
 import struct, threading, socket, logging, time, os
+import corr
 
 from katcp import *
 import six
@@ -60,6 +62,58 @@ class FpgaAsyncRequest:
             return False
         return self.reply.arguments[0] == Message.OK
 
+def _message_bytes(msg):
+    """Size of a KATCP message's name and arguments, unescaped."""
+    return len(msg.name) + sum([len(arg) for arg in msg.arguments])
+
+class RequestStats:
+    """KATCP request statistics for one board, by request name: number of requests, failures (replies other than ok),
+       timeouts, retries, bytes sent and received (message names and arguments, unescaped) and a histogram of the time
+       from sending each request to receiving its reply.
+       """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+
+    def _get(self, name):
+        try:
+            return self.requests[name]
+        except KeyError:
+            entry = {'count': 0, 'failures': 0, 'timeouts': 0, 'retries': 0, 'bytes_tx': 0, 'bytes_rx': 0,
+                'latency': corr.rx_stats.LatencyHistogram()}
+            self.requests[name] = entry
+            return entry
+
+    def request_done(self, name, latency, bytes_tx, bytes_rx, ok = True, timeout = False):
+        with self._lock:
+            entry = self._get(name)
+            entry['count'] += 1
+            entry['failures'] += not ok
+            entry['timeouts'] += timeout
+            entry['bytes_tx'] += bytes_tx
+            entry['bytes_rx'] += bytes_rx
+            entry['latency'].add(latency)
+
+    def retry(self, name):
+        with self._lock:
+            self._get(name)['retries'] += 1
+
+    def get(self):
+        """Dictionary of request name: dictionary of count, failures, timeouts, retries, bytes_tx, bytes_rx, time (the
+           total time waiting for replies) and the latency histogram's mean, max, p50, p90 and p99.
+           """
+        rv = {}
+        with self._lock:
+            for name, entry in six.iteritems(self.requests):
+                rv[name] = dict([(k, v) for k, v in six.iteritems(entry) if k != 'latency'])
+                rv[name].update(entry['latency'].summary())
+                rv[name]['time'] = entry['latency'].total
+        return rv
+
 #class FpgaClient(BlockingClient):
 class FpgaClient(CallbackClient):
     """Client for communicating with a ROACH board.
@@ -96,6 +150,32 @@ class FpgaClient(CallbackClient):
         self._nb_requests = {}
         self._nb_max_requests = 100
 
+        # request statistics, see stats_enable
+        self._stats = None
+
+    """**********************************************************************************"""
+    """**********************************************************************************"""
+
+    def stats_enable(self, enable = True):
+        """Starts (from zero) or stops keeping per request statistics, see RequestStats.
+           """
+        self._stats = RequestStats() if enable else None
+
+    def stats_reset(self):
+        if self._stats != None:
+            self._stats.reset()
+
+    def stats_get(self):
+        """The request statistics (see RequestStats.get), or an empty dictionary if they aren't being kept.
+           """
+        return self._stats.get() if self._stats != None else {}
+
+    def _stats_request_done(self, stats, latency, request, reply, informs):
+        ok = reply.arguments[0] == Message.OK
+        stats.request_done(request.name, latency, _message_bytes(request),
+            _message_bytes(reply) + sum([_message_bytes(inform) for inform in informs]), ok = ok,
+            timeout = (not ok) and len(reply.arguments) > 1 and str(reply.arguments[1]).startswith('Timed out'))
+
     """**********************************************************************************"""
     """**********************************************************************************"""
 
@@ -148,7 +228,11 @@ class FpgaClient(CallbackClient):
         request_id = ''.join(userdata)
         if request_id not in self._nb_requests:
             raise RuntimeError('Recieved reply for request_id(%s), but no such stored request.' % request_id)
-        self._nb_requests[request_id].got_reply(msg.copy())
+        req = self._nb_requests[request_id]
+        req.got_reply(msg.copy())
+        stats = self._stats
+        if stats != None and getattr(req, 'message', None) != None:
+            self._stats_request_done(stats, req.reply_time - req.time_tx, req.message, req.reply, req.informs)
 
     def _nb_informcb(self, msg, *userdata):
         """The callback for request informs. Check that the ID exists and call that request's got_inform function.
@@ -166,13 +250,20 @@ class FpgaClient(CallbackClient):
            @param inform_cb An optional callback function, called upon receipt of the reply to the request.
            @param args      Arguments to the katcp.Message object.
            """
+        stats = self._stats
         if len(self._nb_requests) == self._nb_max_requests:
             oldreq = self._nb_pop_oldest_request()
             self._logger.info("Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id))
             print("Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id))
+            if stats != None and oldreq.reply == None:
+                # never answered
+                stats.request_done(oldreq.request, time.time() - oldreq.time_tx, 0, 0, ok = False, timeout = True)
         request_id = self._nb_get_next_request_id()
         self._nb_add_request(request, request_id, inform_cb, reply_cb)
-        self.callback_request(msg = Message.request(request, *args), reply_cb = self._nb_replycb, inform_cb = self._nb_informcb, user_data = request_id)
+        msg = Message.request(request, *args)
+        if stats != None:
+            self._nb_requests[request_id].message = msg
+        self.callback_request(msg = msg, reply_cb = self._nb_replycb, inform_cb = self._nb_informcb, user_data = request_id)
         return {'host': self.host, 'request': request, 'id': request_id}
 
     """**********************************************************************************"""
@@ -189,8 +280,13 @@ class FpgaClient(CallbackClient):
            @return  Tuple: containing the reply and a list of inform messages.
            """
         request = Message.request(name, *args)
+        stats = self._stats
+        if stats != None:
+            start = time.time()
         reply, informs = self.blocking_request(request, timeout = request_timeout)
         #reply, informs = self.blocking_request(request,keepalive=True)
+        if stats != None:
+            self._stats_request_done(stats, time.time() - start, request, reply, informs)
 
         if reply.arguments[0] != Message.OK:
             self._logger.error("Request %s failed.\n  Request: %s\n  Reply: %s."
@@ -432,6 +528,8 @@ class FpgaClient(CallbackClient):
                     upload_socket.connect((self.host, port))
                     connected = True
                 except:
+                    if self._stats != None:
+                        self._stats.retry('upload')
                     time.sleep(0.1)
             if not connected:
                 result_queue.put('Could not connect to upload port.')
@@ -670,6 +768,113 @@ class FpgaClient(CallbackClient):
             self._logger.debug("Write %8x to register %s at offset %d ok."
                 % (integer, device_name, offset))
 
+    def _pipelined_requests(self, name, requests, window, timeout):
+        """Sends many requests of one type without waiting for each reply, keeping up to window
+           of them in flight. The board handles requests in the order they are sent.
+
+           @param self  This object.
+           @param name  String: name of the requests.
+           @param requests  List of argument lists, one per request.
+           @param window  Integer: maximum number of requests awaiting a reply.
+           @param timeout  Float: seconds to wait for each reply, default is the client timeout.
+           @return  List: the reply messages, in request order.
+           """
+        if timeout == None:
+            timeout = self._timeout
+        stats = self._stats
+        # number of requests awaiting a reply, guarded by done
+        in_flight = [0]
+        done = threading.Condition()
+        replies = [None] * len(requests)
+        sent = []
+        failures = []
+        def reply_cb(msg, *userdata):
+            replies[userdata[0]] = msg
+            if msg.arguments[0] != Message.OK:
+                failures.append(msg)
+            if stats != None:
+                self._stats_request_done(stats, time.time() - sent[userdata[0]][0], sent[userdata[0]][1], msg, [])
+            with done:
+                in_flight[0] -= 1
+                done.notify()
+        def wait_for(limit):
+            # wait until at most limit requests are in flight, giving each reply up to timeout seconds to arrive
+            with done:
+                while in_flight[0] > limit:
+                    waiting = in_flight[0]
+                    deadline = time.time() + timeout
+                    while in_flight[0] == waiting:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        done.wait(remaining)
+            return True
+        def timed_out():
+            if stats != None:
+                for n, (time_tx, msg) in enumerate(sent):
+                    if replies[n] == None:
+                        stats.request_done(name, time.time() - time_tx, _message_bytes(msg), 0, ok = False, timeout = True)
+            raise RuntimeError("Timed out waiting for %s replies from %s." % (name, self.host))
+        for n, args in enumerate(requests):
+            if not wait_for(window - 1):
+                timed_out()
+            msg = Message.request(name, *args)
+            sent.append((time.time(), msg))
+            with done:
+                in_flight[0] += 1
+            self.callback_request(msg = msg, reply_cb = reply_cb, user_data = (n,))
+        # wait for the replies still outstanding
+        if not wait_for(0):
+            timed_out()
+        if len(failures) > 0:
+            self._logger.error("%i of %i pipelined %s requests to %s failed, first: %s" % (len(failures), len(requests), name, self.host, failures[0]))
+            raise RuntimeError("%i of %i pipelined %s requests to %s failed, first: %s" % (len(failures), len(requests), name, self.host, failures[0]))
+        return replies
+
+    def blindwrite_int_pipelined(self, writes, window=64, timeout=None):
+        """Unchecked integer writes, pipelined: up to window write requests are
+           in flight at once instead of waiting for each reply before sending the
+           next. The writes land in order.
+
+           @see write_int
+           @param self  This object.
+           @param writes  List of (device_name, integer) or (device_name, integer, offset) tuples, offsets in 32-bit words.
+           @param window  Integer: maximum number of requests awaiting a reply.
+           @param timeout  Float: seconds to wait for each reply, default is the client timeout.
+           @return  Integer: number of writes made.
+           """
+        requests = []
+        for write in writes:
+            device_name, integer = write[0], write[1]
+            offset = write[2] if len(write) > 2 else 0
+            if integer < 0:
+                data = struct.pack(">i", integer)
+            else:
+                data = struct.pack(">I", integer)
+            requests.append([device_name, str(offset*4), data])
+        self._pipelined_requests("write", requests, window, timeout)
+        self._logger.debug("Pipelined %i writes to %s done." % (len(writes), self.host))
+        return len(writes)
+
+    def read_int_pipelined(self, reads, window=64, timeout=None):
+        """Integer reads, pipelined like blindwrite_int_pipelined.
+
+           @see read_int
+           @param self  This object.
+           @param reads  List of device names or (device_name, offset) tuples, offsets in 32-bit words.
+           @param window  Integer: maximum number of requests awaiting a reply.
+           @param timeout  Float: seconds to wait for each reply, default is the client timeout.
+           @return  List: signed integers read.
+           """
+        requests = []
+        for read in reads:
+            if isinstance(read, str):
+                read = (read,)
+            offset = read[1] if len(read) > 1 else 0
+            requests.append([read[0], str(offset*4), '4'])
+        replies = self._pipelined_requests("read", requests, window, timeout)
+        return [struct.unpack(">i", reply.arguments[1])[0] for reply in replies]
+
     def read_uint(self, device_name,offset=0):
         """As in .read_int(), but unpack into 32 bit unsigned int. Optionally read at an offset 32-bit register.
 
@@ -1094,5 +1299,49 @@ class FpgaClient(CallbackClient):
         self._logger.info("Reloading ARP table on interface %s... %s."%(dev_name,reply.arguments[0]))
         return reply.arguments[0]
 
+def _histograms_merge(histograms):
+    merged = corr.rx_stats.LatencyHistogram()
+    for hist in histograms:
+        merged.counts += hist.counts
+        merged.n += hist.n
+        merged.total += hist.total
+        merged.max = max(merged.max, hist.max)
+    return merged
+
+def stats_merge(fpgas):
+    """The request statistics of FpgaClients fpgas added up across the boards, by request name, as RequestStats.get.
+       """
+    entries = {}
+    for fpga in fpgas:
+        if fpga._stats == None:
+            continue
+        with fpga._stats._lock:
+            for name, entry in six.iteritems(fpga._stats.requests):
+                entries.setdefault(name, []).append(dict(entry, latency = _histograms_merge([entry['latency']])))
+    rv = {}
+    for name, board_entries in six.iteritems(entries):
+        rv[name] = dict([(k, sum([e[k] for e in board_entries])) for k in board_entries[0] if k != 'latency'])
+        latency = _histograms_merge([e['latency'] for e in board_entries])
+        rv[name].update(latency.summary())
+        rv[name]['time'] = latency.total
+    return rv
+
+def stats_report(fpgas, per_board = True):
+    """A text report of the request statistics of FpgaClients fpgas: a line per request name totalled over all the
+       boards, then (if per_board) a line per board and request name, each in order of decreasing total time waiting
+       for replies. Times in milliseconds unless marked.
+       """
+    fields = '%-24s %-20s %9s %6s %6s %6s %10s %10s %8s %8s %8s %8s %9s %9s'
+    lines = [fields % ('board', 'request', 'count', 'fail', 't/o', 'retry', 'kB tx', 'kB rx', 'mean', 'p50', 'p90', 'p99', 'max', 'total (s)')]
+    rows = [('all', stats_merge(fpgas))]
+    if per_board:
+        rows += [(fpga.host, fpga.stats_get()) for fpga in fpgas]
+    for host, stats in rows:
+        for name, s in sorted(stats.items(), key = lambda item: -item[1]['time']):
+            lines.append('%-24s %-20s %9i %6i %6i %6i %10.1f %10.1f %8.3f %8.3f %8.3f %8.3f %9.3f %9.3f' % (host, name, s['count'],
+                s['failures'], s['timeouts'], s['retries'], s['bytes_tx'] / 1024., s['bytes_rx'] / 1024., s['mean'] * 1e3,
+                s['p50'] * 1e3, s['p90'] * 1e3, s['p99'] * 1e3, s['max'] * 1e3, s['time']))
+    return '\n'.join(lines)
+
 def ip_to_a(ip):
     return '%i.%i.%i.%i'%((ip>>24),((ip&(0xff<<16))>>16),((ip&(0xff<<8))>>8),(ip&(0xff)))
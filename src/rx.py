@@ -5,19 +5,556 @@
                 min/max value logging (was not scaling back).
                 Loggin: SPEAD and RX levels.
                 Timestamps to SD.
+2013-03-12      HDF5 output through rx_store.H5Writer: chunked, preallocated and buffered, with optional compression.
+2013-03-13      Separate network and storage threads, joined by a HeapRing of preallocated heap slots.
+2013-03-14      Pluggable receive backends: spead2 (C++ decoder, memory pool) with the spead64_48 path as a fallback.
+2013-03-15      SdPublisher: reusable, rate-limited signal display sender with baseline selection and channel decimation.
+2013-03-16      Received heaps go to a list of rx_store.DumpSinks (HDF5 by default).
+2013-03-17      Heap loss, latency and throughput counters in rx_stats.RxStats (CorrRx.stats).
+2013-03-18      MultiStreamRx: one receive stream and worker per X engine board, merged into shared dump buffers.
+2013-03-19      Optionally store dumps in canonical baseline order (rx_store.ReorderSink).
+2013-03-20      Online time/channel averaging and baseline selection into a second file (rx_store.ReduceSink).
 """
 
 from __future__ import absolute_import
 from __future__ import print_function
 import threading
+import abc
+import six
+import six.moves.queue
 import numpy as np
 import spead64_48 as spead
 import logging
 import sys
 import time
-import h5py
 import corr
 
+# changed values up to this size are copied out of the heap slots for use after the slot is released (metadata, timestamps)
+META_COPY_BYTES = 65536
+
+class HeapSlot:
+    """One received heap: the names and values of the items that changed in it, plus the descriptors of any items seen for the first time.
+        Array values are copied into buffers owned by the slot, which are allocated on first use and reused for later heaps."""
+    def __init__(self):
+        self.heap_cnt = -1
+        self.rx_time = 0
+        self.names = []
+        self.values = {}
+        self.new_items = []
+
+    def fill(self, heap_cnt, new_items, changed, copy = True):
+        """Puts a heap into this slot. changed is a list of (name, value) tuples.
+            Array values are copied into the slot's buffers unless copy is False, in which case the slot just references them."""
+        self.heap_cnt = heap_cnt
+        self.rx_time = time.time()
+        self.new_items = new_items
+        self.names = []
+        for name, value in changed:
+            buf = self.values.get(name)
+            if not copy:
+                self.values[name] = value
+            elif isinstance(value, np.ndarray) and isinstance(buf, np.ndarray) and buf.shape == value.shape and buf.dtype == value.dtype:
+                np.copyto(buf, value)
+            elif isinstance(value, np.ndarray):
+                self.values[name] = value.copy()
+            else:
+                self.values[name] = value
+            self.names.append(name)
+
+    def nbytes(self):
+        return sum([self.values[name].nbytes for name in self.names if isinstance(self.values[name], np.ndarray)])
+
+class HeapRing:
+    """Bounded ring of HeapSlots between one producer (the network stage) and one consumer (the storage stage).
+        The producer reserve()s a slot, fills it and commit()s it; the consumer get()s the oldest slot and release()s it when done.
+        When the ring is full, reserve() returns None (and counts a dropped heap) unless asked to block.
+        Counters: n_heaps (heaps committed), n_dropped, max_depth (largest number of heaps queued)."""
+    def __init__(self, n_slots = 16):
+        if n_slots < 1:
+            raise RuntimeError('Need at least one slot in the heap ring.')
+        self.n_slots = n_slots
+        self.slots = [HeapSlot() for i in range(n_slots)]
+        self._cond = threading.Condition()
+        self._head = 0
+        self._tail = 0
+        self._closed = False
+        self.n_heaps = 0
+        self.n_dropped = 0
+        self.max_depth = 0
+
+    def depth(self):
+        """Number of heaps waiting for the consumer."""
+        return self._head - self._tail
+
+    def reserve(self, block = False):
+        """Returns the next free slot for the producer to fill, or None if the ring is full and block is not set."""
+        with self._cond:
+            while (self._head - self._tail) >= self.n_slots:
+                if not block or self._closed:
+                    self.n_dropped += 1
+                    return None
+                self._cond.wait(0.1)
+            return self.slots[self._head % self.n_slots]
+
+    def commit(self):
+        """Passes the reserved slot on to the consumer."""
+        with self._cond:
+            self._head += 1
+            self.n_heaps += 1
+            self.max_depth = max(self.max_depth, self._head - self._tail)
+            self._cond.notify_all()
+
+    def get(self, timeout = None):
+        """Returns the oldest filled slot, waiting for one if necessary. Returns None once the ring is closed and empty, or on timeout."""
+        start_time = time.time()
+        with self._cond:
+            while self._head == self._tail:
+                if self._closed:
+                    return None
+                if timeout != None and (time.time() - start_time) > timeout:
+                    return None
+                self._cond.wait(0.1)
+            return self.slots[self._tail % self.n_slots]
+
+    def release(self):
+        """Returns the slot last obtained with get() to the producer."""
+        with self._cond:
+            self._tail += 1
+            self._cond.notify_all()
+
+    def close(self):
+        """Called by the producer at the end of the stream, or by the consumer if it stops early. reserve() then no longer blocks."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+@six.add_metaclass(abc.ABCMeta)
+class RxBackend:
+    """Interface of the receivers used by CorrRx's network stage.
+        heaps() yields a (heap_cnt, new_items, changed) tuple for every heap received until the end of the stream, where new_items is
+        a list of descriptor dictionaries {name, id, description, shape, dtype} of the items seen for the first time and changed
+        is a list of (name, value) tuples of the items updated by the heap.
+        If zero_copy is set, the backend never reuses the memory of a value it has yielded, so values can be kept without copying.
+        decode_time is the time taken to unpack the last heap yielded.
+        Subclasses must implement heaps(); incomplete_heaps() and stop() are optional."""
+    zero_copy = False
+    decode_time = 0.0
+
+    def __init__(self, port, logger = None):
+        self.port = port
+        self.logger = logger if logger != None else logging.getLogger('rx')
+
+    @abc.abstractmethod
+    def heaps(self):
+        """Generator of (heap_cnt, new_items, changed) tuples, as described above."""
+
+    def incomplete_heaps(self):
+        """Number of heaps the receiver discarded before all their packets arrived."""
+        return 0
+
+    def stop(self):
+        pass
+
+def _item_desc(name, id, description, shape, dtype):
+    return {'name': name, 'id': id, 'description': description, 'shape': shape, 'dtype': np.dtype(dtype)}
+
+class SpeadPythonRx(RxBackend):
+    """The pure-python spead64_48 receiver."""
+    def __init__(self, port, logger = None, pkt_count = 1024, buffer_size = 51200000):
+        RxBackend.__init__(self, port, logger)
+        self.rx = spead.TransportUDPrx(port, pkt_count=pkt_count, buffer_size=buffer_size)
+
+    def heaps(self):
+        ig = spead.ItemGroup()
+        seen = {}
+        for heap in spead.iterheaps(self.rx):
+            start_time = time.time()
+            ig.update(heap)
+            new_items = []
+            changed = []
+            for name in ig.keys():
+                item = ig.get_item(name)
+                if name not in seen:
+                    # check to see if we have encountered this type before
+                    shape = ig[name].shape if item.shape == -1 else item.shape
+                    dtype = np.dtype(type(ig[name])) if shape == [] else item.dtype
+                    if dtype is None: dtype = ig[name].dtype
+                     # if we can't get a dtype from the descriptor try and get one from the value
+                    seen[name] = True
+                    new_items.append(_item_desc(item.name, item.id, item.description, shape, dtype))
+                if item._changed:
+                    changed.append((name, ig[name]))
+                    item._changed = False
+            self.decode_time = time.time() - start_time
+            yield heap.heap_cnt, new_items, changed
+
+    def stop(self):
+        self.rx.stop()
+
+def _spead2_fmt_dtype(fmt):
+    """numpy dtype that holds values of a (single field) spead2 item format."""
+    kind, bits = fmt[0]
+    n_bytes = 1
+    while n_bytes * 8 < bits:
+        n_bytes *= 2
+    return np.dtype({'u': 'u', 'i': 'i', 'f': 'f', 'c': 'S', 'b': 'b'}[kind] + ('%i' % n_bytes if kind != 'b' else '1'))
+
+class Spead2Rx(RxBackend):
+    """Receiver using the spead2 C++ decoder. Heap payloads are allocated from a memory pool of pool_heaps buffers of heap_bytes
+        (set this to at least the size of a dump heap), and up to max_heaps heaps (eg one per X engine) are reassembled concurrently.
+        Numpy-typed items are delivered as views onto the pool buffers, which go back to the pool once nothing references them."""
+    zero_copy = True
+
+    def __init__(self, port, logger = None, max_heaps = 8, heap_bytes = 16 << 20, pool_heaps = 16, buffer_size = 51200000, ring_heaps = 8):
+        RxBackend.__init__(self, port, logger)
+        try:
+            import spead2, spead2.recv
+        except ImportError:
+            raise RuntimeError('The spead2 receive backend needs the spead2 package.')
+        self.spead2 = spead2
+        self.pool = spead2.MemoryPool(lower = 16384, upper = heap_bytes, max_free = pool_heaps, initial = pool_heaps)
+        self.stream = spead2.recv.Stream(spead2.ThreadPool(), spead2.recv.StreamConfig(max_heaps = max_heaps, memory_allocator = self.pool),
+            spead2.recv.RingStreamConfig(heaps = ring_heaps))
+        self.stream.add_udp_reader(port, buffer_size = buffer_size)
+
+    def heaps(self):
+        ig = self.spead2.ItemGroup()
+        seen = {}
+        for heap in self.stream:
+            start_time = time.time()
+            updated = ig.update(heap)
+            new_items = []
+            for name in ig.keys():
+                item = ig[name]
+                if name in seen:
+                    continue
+                if item.value is not None:
+                    value = np.asarray(item.value)
+                    shape, dtype = list(value.shape), value.dtype
+                elif item.dtype is not None and None not in item.shape:
+                    shape, dtype = list(item.shape), item.dtype
+                elif item.format is not None and len(item.format) == 1 and None not in item.shape:
+                    shape, dtype = list(item.shape), _spead2_fmt_dtype(item.format)
+                else:
+                    # variable-sized item: wait for a value to size it
+                    continue
+                seen[name] = True
+                new_items.append(_item_desc(name, item.id, item.description, shape, dtype))
+            changed = [(name, item.value) for name, item in updated.items() if name in seen]
+            self.decode_time = time.time() - start_time
+            yield heap.cnt, new_items, changed
+
+    def incomplete_heaps(self):
+        stats = self.stream.stats
+        return stats['incomplete_heaps_evicted'] + stats['incomplete_heaps_flushed']
+
+    def stop(self):
+        self.stream.stop()
+
+def _xeng_item(name):
+    """Returns (kind, xeng_n) for the per-X-engine items xeng_raw<n> and timestamp<n>, otherwise (None, None)."""
+    for kind in ['xeng_raw', 'timestamp']:
+        if name.startswith(kind) and name[len(kind):].isdigit():
+            return kind, int(name[len(kind):])
+    return None, None
+
+class DumpAssembler:
+    """Combines the per-X-engine spectra (xeng_raw<n> with timestamp<n>) of several receive streams into full dumps in n_slots
+        shared, preallocated (n_chans x n_bls x 2) buffers. X engine n's channels are n::n_xeng (the round-robin order of the inter output format).
+        Any number of threads can add() spectra at once; each copies into its own channels of the dump's buffer.
+        When a newer dump completes, or a slot is needed for a new timestamp, older incomplete dumps are discarded and counted in n_incomplete."""
+    def __init__(self, n_xeng, xeng_shape, dtype, n_slots = 4):
+        self.n_xeng = n_xeng
+        self.n_slots = n_slots
+        self.bufs = np.zeros((n_slots, xeng_shape[0] * n_xeng) + tuple(xeng_shape[1:]), dtype = dtype)
+        self.timestamps = np.zeros(n_slots, dtype = np.int64)
+        self.in_use = np.zeros(n_slots, dtype = bool)
+        self.received = np.zeros((n_slots, n_xeng), dtype = bool)
+        self.writers = np.zeros(n_slots, dtype = np.int32)
+        self.complete = np.zeros(n_slots, dtype = bool)
+        self.copy_time = np.zeros(n_slots)
+        self._cond = threading.Condition()
+        self.last_timestamp = -1
+        self.n_dumps = 0
+        self.n_incomplete = 0
+        self.n_late = 0
+
+    def _discard(self, slot):
+        self.in_use[slot] = False
+        self.received[slot] = False
+        self.copy_time[slot] = 0
+        self.n_incomplete += 1
+
+    def _slot_get(self, timestamp):
+        """Finds (or allocates) the slot for timestamp. Called with the lock held. Returns None if the dump is too late."""
+        while True:
+            if timestamp <= self.last_timestamp:
+                self.n_late += 1
+                return None
+            match = np.flatnonzero(self.in_use & (self.timestamps == timestamp) & ~self.complete)
+            if len(match) > 0:
+                return match[0]
+            free = np.flatnonzero(~self.in_use)
+            if len(free) == 0:
+                # reuse the oldest incomplete dump that no one is writing to
+                candidates = np.flatnonzero(~self.complete & (self.writers == 0))
+                if len(candidates) == 0:
+                    self._cond.wait(0.1)
+                    continue
+                slot = candidates[np.argmin(self.timestamps[candidates])]
+                self._discard(slot)
+                free = [slot]
+            slot = free[0]
+            self.in_use[slot] = True
+            self.timestamps[slot] = timestamp
+            return slot
+
+    def add(self, xeng_n, timestamp, data):
+        """Stores X engine xeng_n's spectrum for the dump at timestamp. Returns the slot number if this completed the dump, otherwise None."""
+        with self._cond:
+            slot = self._slot_get(timestamp)
+            if slot is None:
+                return None
+            self.writers[slot] += 1
+        start_time = time.time()
+        self.bufs[slot, xeng_n::self.n_xeng] = data
+        copy_time = time.time() - start_time
+        with self._cond:
+            self.writers[slot] -= 1
+            self.received[slot, xeng_n] = True
+            self.copy_time[slot] += copy_time
+            if not self.received[slot].all() or self.writers[slot] > 0 or self.complete[slot]:
+                return None
+            self.complete[slot] = True
+            self.last_timestamp = max(self.last_timestamp, timestamp)
+            self.n_dumps += 1
+            # anything older than this dump will not be completed now
+            for old in np.flatnonzero(self.in_use & ~self.complete & (self.timestamps < timestamp) & (self.writers == 0)):
+                self._discard(old)
+            return slot
+
+    def release(self, slot):
+        """Returns a completed dump's slot once its consumer is done with it."""
+        with self._cond:
+            self.in_use[slot] = False
+            self.complete[slot] = False
+            self.received[slot] = False
+            self.copy_time[slot] = 0
+            self._cond.notify_all()
+
+    def flush(self):
+        """Discards all incomplete dumps, at the end of the stream."""
+        with self._cond:
+            for slot in np.flatnonzero(self.in_use & ~self.complete):
+                self._discard(slot)
+
+class MultiStreamRx(RxBackend):
+    """Receives a correlator's output on n_streams ports (port, port + port_stride, ...), as set up by Correlator.config_udp_output
+        with a port stride: each X engine board sends its engines' xeng_raw<n>/timestamp<n> heaps (inter output format) to its own port.
+        Every stream has its own receive backend (stream_backend, with any extra keyword arguments) and worker thread doing the heap
+        reassembly, and the workers merge the spectra into full dumps in a DumpAssembler of dump_slots shared buffers.
+        The merged dumps are passed on as xeng_raw/timestamp heaps, as in the cont output format, so should be received with CorrRx's cont mode.
+        Metadata is taken from the first stream only (it is ignored on the others), and the end of that stream ends the others."""
+    def __init__(self, port, logger = None, n_streams = 2, port_stride = 1, stream_backend = 'auto', dump_slots = 4, **kwargs):
+        RxBackend.__init__(self, port, logger)
+        if n_streams < 1 or port_stride < 1:
+            raise RuntimeError('Need at least one receive stream and a port stride of at least one.')
+        self.ports = [port + (stream_n * port_stride) for stream_n in range(n_streams)]
+        self.backends = [rx_backend_get(stream_backend, stream_port, logger = logger, **kwargs) for stream_port in self.ports]
+        self.dump_slots = dump_slots
+        self.assembler = None
+        self._lock = threading.Lock()
+        self.logger.info('Receiving %i streams on ports %s.' % (n_streams, self.ports))
+
+    def _assembler_get(self, new_items, out):
+        """Makes the DumpAssembler from the first set of X engine data descriptors seen on any stream."""
+        with self._lock:
+            if self.assembler is None:
+                descs = dict([(_xeng_item(desc['name']), desc) for desc in new_items])
+                n_xeng = len([key for key in descs if key[0] == 'xeng_raw'])
+                first = descs[('xeng_raw', 0)]
+                self.assembler = DumpAssembler(n_xeng, first['shape'], first['dtype'], self.dump_slots)
+                shape = list(self.assembler.bufs.shape[1:])
+                self.logger.info('Assembling dumps of shape %s from %i X engines.' % (shape, n_xeng))
+                ts = descs.get(('timestamp', 0), _item_desc('timestamp0', 0x1600, '', [], np.uint64))
+                out.put(('desc', [_item_desc('timestamp', ts['id'], ts['description'], ts['shape'], ts['dtype']),
+                    _item_desc('xeng_raw', first['id'], first['description'], shape, first['dtype'])]))
+            return self.assembler
+
+    def _worker(self, stream_n, backend, out):
+        """Reassembles one stream's heaps, merging X engine data into the shared dumps. Other descriptors and metadata are passed on to
+            out from the first stream only, as the correlator sends the same descriptors to every port."""
+        try:
+            for heap_cnt, new_items, changed in backend.heaps():
+                descs = [desc for desc in new_items if _xeng_item(desc['name'])[0] is None]
+                if self.assembler is None and ('xeng_raw', 0) in [_xeng_item(desc['name']) for desc in new_items]:
+                    self._assembler_get(new_items, out)
+                spectra = {}
+                timestamps = {}
+                meta = []
+                for name, value in changed:
+                    kind, xeng_n = _xeng_item(name)
+                    if kind == 'xeng_raw':
+                        spectra[xeng_n] = value
+                    elif kind == 'timestamp':
+                        timestamps[xeng_n] = value
+                    elif stream_n == 0:
+                        meta.append((name, value.copy() if isinstance(value, np.ndarray) and not backend.zero_copy else value))
+                if stream_n == 0 and (len(descs) > 0 or len(meta) > 0):
+                    out.put(('meta', heap_cnt, descs, meta))
+                for xeng_n, spectrum in spectra.items():
+                    if self.assembler is None or xeng_n not in timestamps:
+                        self.logger.warning('Stream %i: dropped data from X engine %i without a descriptor or timestamp.' % (stream_n, xeng_n))
+                        continue
+                    slot = self.assembler.add(xeng_n, timestamps[xeng_n], spectrum)
+                    if slot is not None:
+                        out.put(('dump', slot))
+        except Exception as err:
+            self.logger.error('Receive stream %i failed: %s' % (stream_n, err))
+        finally:
+            out.put(('end', stream_n))
+
+    def heaps(self):
+        out = six.moves.queue.Queue()
+        workers = []
+        for stream_n, backend in enumerate(self.backends):
+            worker = threading.Thread(target = self._worker, args = (stream_n, backend, out))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        running = len(workers)
+        heap_cnt = 0
+        while running > 0:
+            event = out.get()
+            if event[0] == 'end':
+                running -= 1
+                if event[1] == 0:
+                    for backend in self.backends[1:]:
+                        backend.stop()
+            elif event[0] == 'desc':
+                self.decode_time = 0.0
+                yield heap_cnt, event[1], []
+            elif event[0] == 'meta':
+                self.decode_time = 0.0
+                yield heap_cnt, event[2], event[3]
+            elif event[0] == 'dump':
+                slot = event[1]
+                self.decode_time = self.assembler.copy_time[slot]
+                yield heap_cnt, [], [('timestamp', self.assembler.timestamps[slot]), ('xeng_raw', self.assembler.bufs[slot])]
+                self.assembler.release(slot)
+            heap_cnt += 1
+        if self.assembler is not None:
+            self.assembler.flush()
+
+    def incomplete_heaps(self):
+        return sum([backend.incomplete_heaps() for backend in self.backends]) + (self.assembler.n_incomplete if self.assembler is not None else 0)
+
+    def stop(self):
+        for backend in self.backends:
+            backend.stop()
+
+RX_BACKENDS = {'python': SpeadPythonRx, 'spead2': Spead2Rx, 'multi': MultiStreamRx}
+
+def rx_backend_get(name, port, logger = None, **kwargs):
+    """Returns a receive backend listening on port. name is one of RX_BACKENDS' keys, or 'auto' to use spead2 if it is available, falling back to the python receiver."""
+    if name == 'auto':
+        try:
+            return Spead2Rx(port, logger = logger, **kwargs)
+        except RuntimeError:
+            (logger if logger != None else logging.getLogger('rx')).warning('spead2 not available, using the python SPEAD receiver.')
+            return SpeadPythonRx(port, logger = logger)
+    if name not in RX_BACKENDS:
+        raise RuntimeError('Unknown receive backend %s. Expecting one of %s or auto.' % (name, list(RX_BACKENDS.keys())))
+    return RX_BACKENDS[name](port, logger = logger, **kwargs)
+
+# metadata needed before dumps can be sent to the signal displays, and forwarded to them
+SD_META = ['n_chans','bandwidth','n_bls','n_xengs','center_freq','bls_ordering']
+
+class SdPublisher:
+    """Sends correlator dumps to a signal display as SPEAD sd_data/sd_timestamp heaps.
+        The item descriptors are declared once (and redeclared every resend_period seconds for displays that start up later),
+        frames are scaled straight into one of two preallocated float32 buffers, and at most frame_rate frames are sent per second:
+        frames offered more often than that are skipped without any processing.
+        baselines optionally selects a subset of baseline indices, and every chan_decimation'th channel is sent."""
+    def __init__(self, sd_ip, sd_port, frame_rate = 1.0, baselines = None, chan_decimation = 1, resend_period = 10.0, logger = None):
+        self.logger = logger if logger != None else logging.getLogger('rx')
+        self.tx = spead.Transmitter(spead.TransportUDPtx(sd_ip, sd_port))
+        self.frame_rate = frame_rate
+        self.baselines = None if baselines is None else np.asarray(baselines, dtype = int)
+        self.chan_decimation = max(1, int(chan_decimation))
+        self.resend_period = resend_period
+        self.n_sent = 0
+        self.n_skipped = 0
+        self._last_sent = 0
+        self._declared = 0
+        self._meta = None
+        self._bufs = None
+        self._gather = None
+        self._buf_idx = 0
+        self.ig = None
+
+    def _out_meta(self, name, value):
+        """Adjusts metadata values for the baseline selection and channel decimation."""
+        if name == 'n_chans':
+            return (value + self.chan_decimation - 1) // self.chan_decimation
+        if self.baselines is not None and name == 'n_bls':
+            return len(self.baselines)
+        if self.baselines is not None and name == 'bls_ordering':
+            return np.asarray(value)[self.baselines]
+        return value
+
+    def meta_send(self, items, values, names = SD_META):
+        """Sends the named metadata items. items holds the item descriptors (as produced by the receive backends), values their values."""
+        ig_sd = spead.ItemGroup()
+        for name in names:
+            ig_sd.add_item(name=items[name]['name'], id=items[name]['id'], description=items[name]['description'],
+                init_val=self._out_meta(name, values[name]))
+        self.tx.send_heap(ig_sd.get_heap())
+        self._meta = (items, values, names)
+
+    def _declare(self, shape):
+        self.ig = spead.ItemGroup()
+        self.ig.add_item(name=('sd_data'), id=(0x3501), description="Combined raw data from all x engines.", ndarray=(np.dtype(np.float32),shape))
+        self.ig.add_item(name=('sd_timestamp'), id=0x3502, description='Timestamp of this sd frame in centiseconds since epoch (40 bit limitation).',
+            shape=[], fmt=spead.mkfmt(('u',spead.ADDRSIZE)))
+        self._declared = time.time()
+        self.logger.info("Declared SD frame with shape %s, dtype float32" % (str(shape)))
+
+    def ready(self):
+        """True if a frame offered now would be sent."""
+        return (time.time() - self._last_sent) >= (1.0 / self.frame_rate)
+
+    def publish(self, frame, timestamp, scale_factor = 1):
+        """Sends an (n_chans x n_bls x 2) frame, divided by scale_factor, if the frame rate allows it. Returns True if it was sent."""
+        if not self.ready():
+            self.n_skipped += 1
+            return False
+        src = frame[::self.chan_decimation]
+        if self.baselines is not None:
+            if self._gather is None or self._gather.dtype != frame.dtype or self._gather.shape[0] != src.shape[0]:
+                self._gather = np.empty((src.shape[0], len(self.baselines)) + src.shape[2:], dtype = frame.dtype)
+            np.take(src, self.baselines, axis = 1, out = self._gather)
+            src = self._gather
+        if self._bufs is None or self._bufs[0].shape != src.shape:
+            self._bufs = [np.empty(src.shape, dtype = np.float32), np.empty(src.shape, dtype = np.float32)]
+            self.ig = None
+        if self.ig is None or (time.time() - self._declared) > self.resend_period:
+            self._declare(src.shape)
+            if self._meta is not None:
+                self.meta_send(*self._meta)
+        # alternate between the buffers so that the one just handed to the transmitter is not overwritten by the next frame
+        buf = self._bufs[self._buf_idx]
+        self._buf_idx = 1 - self._buf_idx
+        np.multiply(src, 1.0 / scale_factor, out = buf, casting = 'unsafe')
+        self.ig['sd_data'] = buf
+        self.ig['sd_timestamp'] = int(timestamp * 100)
+        self.tx.send_heap(self.ig.get_heap())
+        self._last_sent = time.time()
+        self.n_sent += 1
+        self.logger.info("Sent signal display frame with timestamp %i (%s). %s." % (timestamp, time.ctime(timestamp),
+            "Unscaled" if scale_factor == 1 else "Scaled by %i" % (scale_factor)))
+        return True
+
 class CorrRx(threading.Thread):
     def __init__(self, mode = 'cont', port=7148, log_handler = None, log_level = logging.INFO, spead_log_level = logging.WARN, **kwargs):
         if log_handler == None:
@@ -35,6 +572,7 @@ class CorrRx(threading.Thread):
         else:
             raise RuntimeError('Mode not understood. Expecting inter or cont.')
         self._kwargs = kwargs
+        self.stats = corr.rx_stats.RxStats()
         #print kwargs
         threading.Thread.__init__(self)
 
@@ -42,148 +580,173 @@ class CorrRx(threading.Thread):
         #print 'starting target with kwargs ',self._kwargs
         self._target(**self._kwargs)
 
-    def rx_cont(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149,acc_scale=True, filename=None,**kwargs):
+    def _rx_stage(self, backend, ring):
+        """Network stage: receives heaps with the given RxBackend and passes the changed items on through ring slots.
+            Heaps carrying correlator data (xeng_raw) are dropped if the storage stage falls behind; metadata heaps wait for a free slot."""
+        logger = self.logger
+        stats = self.stats
+        try:
+            for heap_cnt, new_items, changed in backend.heaps():
+                start_time = time.time()
+                is_data = len([name for name, value in changed if name.startswith('xeng_raw')]) > 0
+                if is_data:
+                    stats.set_incomplete(backend.incomplete_heaps())
+                slot = ring.reserve(block = not is_data)
+                if slot is None:
+                    stats.heap_dropped(heap_cnt, [(name, value) for name, value in changed if name.startswith('timestamp')])
+                    logger.warning("Storage stage is %i heaps behind. Dropped heap cnt(%i)." % (ring.depth(), heap_cnt))
+                    continue
+                slot.fill(heap_cnt, new_items, changed, copy = not backend.zero_copy)
+                nbytes = slot.nbytes()
+                ring.commit()
+                stats.heap_received(heap_cnt, nbytes, backend.decode_time + (time.time() - start_time), is_data)
+        finally:
+            stats.set_incomplete(backend.incomplete_heaps())
+            ring.close()
+
+    def _start_rx_stage(self, backend, ring_slots):
+        """Starts the network stage in its own thread, returning the ring of heaps it fills."""
+        ring = HeapRing(ring_slots)
+        self.ring = ring
+        self._rx_thread = threading.Thread(target = self._rx_stage, args = (backend, ring))
+        self._rx_thread.daemon = True
+        self._rx_thread.start()
+        return ring
+
+    def _sinks_get(self, sinks, filename, bl_reorder, reduce_time_avg, reduce_chan_avg, reduce_baselines, reduce_filename, reduced_only, **h5_kwargs):
+        """Returns the dump sinks for a capture: the given list of sinks, or an HDF5 file (filename), unless reduced_only is set.
+            If any reduction is asked for, time/channel averaged dumps of the selected baselines go to a second HDF5 file (reduce_filename).
+            With bl_reorder, all of them get the data in canonical baseline order."""
+        logger = self.logger
+        if filename == None:
+            filename=str(int(time.time())) + ".synth.h5"
+        if sinks == None:
+            sinks = []
+            if not reduced_only:
+                logger.info("Starting file %s."%(filename))
+                sinks.append(corr.rx_store.H5Sink(filename, logger=logger, **h5_kwargs))
+        if reduce_time_avg > 1 or reduce_chan_avg > 1 or reduce_baselines is not None or reduced_only:
+            if reduce_filename == None:
+                reduce_filename = (filename[0:-3] if filename.endswith('.h5') else filename) + '.reduced.h5'
+            logger.info("Starting file %s for dumps averaged over %i dumps and %i channels." % (reduce_filename, reduce_time_avg, reduce_chan_avg))
+            sinks.append(corr.rx_store.ReduceSink(corr.rx_store.H5Sink(reduce_filename, logger=logger, **h5_kwargs),
+                time_avg=reduce_time_avg, chan_avg=reduce_chan_avg, baselines=reduce_baselines, logger=logger))
+        if bl_reorder:
+            sinks = [corr.rx_store.ReorderSink(sink, logger=logger) for sink in sinks]
+        return sinks
+
+    def _heap_store(self, heap, values, sinks, get_time):
+        """Passes heap on to the sinks and records its timestamps and latencies in self.stats. get_time is when the storage stage took it off the ring."""
+        stats = self.stats
+        for name in heap.names:
+            if name.startswith('timestamp'):
+                seconds = None
+                if 'sync_time' in values and 'scale_factor_timestamp' in values:
+                    seconds = values['sync_time'] + (values[name] / float(values['scale_factor_timestamp']))
+                stats.timestamp(name, values[name], heap.rx_time, seconds)
+        start_time = time.time()
+        for sink in sinks:
+            sink.heap(heap.heap_cnt, heap.rx_time, heap.names, heap.values)
+        stats.heap_stored(heap.rx_time, get_time - heap.rx_time, time.time() - start_time, self.ring.depth())
+
+    def _heap_values(self, heap, values):
+        """Updates the values dictionary with the items that changed in heap. Large arrays are referenced in the slot, and are only valid until it is released."""
+        for name in heap.names:
+            value = heap.values[name]
+            values[name] = value.copy() if isinstance(value, np.ndarray) and value.nbytes <= META_COPY_BYTES else value
+
+    def _storage_stop(self, ring, backend, sinks):
+        """Ends a capture, whether the storage stage finished or failed: closes the ring (so a network stage waiting for a slot gives up),
+            stops the receive backend and closes all the sinks. Errors closing a sink are logged, so the others still get closed."""
+        ring.close()
+        backend.stop()
+        for sink in sinks:
+            try:
+                sink.close()
+            except Exception as err:
+                self.logger.error("Error closing %s: %s" % (sink.__class__.__name__, err))
+
+    def rx_cont(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149,acc_scale=True, filename=None, h5_buffer_dumps=16, h5_compression=None, h5_shuffle=False, ring_slots=16, rx_backend='auto', rx_backend_kwargs={}, sd_rate=1.0, sd_baselines=None, sd_chan_decimation=1, sinks=None, bl_reorder=False, reduce_time_avg=1, reduce_chan_avg=1, reduce_baselines=None, reduce_filename=None, reduced_only=False, **kwargs):
         logger=self.logger
         logger.info("Data reception on port %i."%data_port)
-        rx = spead.TransportUDPrx(data_port, pkt_count=1024, buffer_size=51200000)
+        backend = rx_backend_get(rx_backend, data_port, logger=logger, **rx_backend_kwargs)
+        logger.info("Using %s receive backend." % backend.__class__.__name__)
         logger.info("Sending Signal Display data to %s:%i."%(sd_ip,sd_port))
-        tx_sd = spead.Transmitter(spead.TransportUDPtx(sd_ip, sd_port))
-        ig = spead.ItemGroup()
-        ig_sd = spead.ItemGroup()
-        if filename == None:
-            filename=str(int(time.time())) + ".synth.h5"
-        logger.info("Starting file %s."%(filename))
-        f = h5py.File(filename, mode="w")
-        data_ds = None
-        ts_ds = None
+        sd = SdPublisher(sd_ip, sd_port, frame_rate=sd_rate, baselines=sd_baselines, chan_decimation=sd_chan_decimation, logger=logger)
+        sinks = self._sinks_get(sinks, filename, bl_reorder, reduce_time_avg, reduce_chan_avg, reduce_baselines, reduce_filename, reduced_only,
+            buffer_dumps=h5_buffer_dumps, compression=h5_compression, shuffle=h5_shuffle)
         idx = 0
         dump_size = 0
-        datasets = {}
-        datasets_index = {}
-        meta_required = ['n_chans','bandwidth','n_bls','n_xengs','center_freq','bls_ordering']
+        meta_required = list(SD_META)
          # we need these bits of meta data before being able to assemble and transmit signal display data
         meta_desired = ['n_accs']
         meta = {}
-        for heap in spead.iterheaps(rx):
-            ig.update(heap)
-            logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
-            for name in ig.keys():
-                item = ig.get_item(name)
-                if not item._changed and name in datasets: continue # the item is not marked as changed, and we have a record for it
-                if name in meta_desired:
-                    meta[name] = ig[name]
-                if name in meta_required:
-                    meta[name] = ig[name]
-                    meta_required.pop(meta_required.index(name))
-                    if len(meta_required) == 0:
-                        #sd_frame = np.zeros((meta['n_chans'],meta['n_bls'],2),dtype=np.float32)
-                        logger.info("Got all required metadata. Expecting data frame shape of %i %i %i"%(meta['n_chans'],meta['n_bls'],2))
-                        meta_required = ['n_chans','bandwidth','n_bls','n_xengs','center_freq','bls_ordering']
-                        ig_sd = spead.ItemGroup()
-                        for meta_item in meta_required:
-                          ig_sd.add_item(
-                            name=ig.get_item(meta_item).name,
-                            id=ig.get_item(meta_item).id,
-                            description=ig.get_item(meta_item).description,
-                            #shape=ig.get_item(meta_item).shape,
-                            #fmt=ig.get_item(meta_item).format,
-                            init_val=ig.get_item(meta_item).get_value())
-                        tx_sd.send_heap(ig_sd.get_heap())
-
-                if name not in datasets:
-                 # check to see if we have encountered this type before
-                    shape = ig[name].shape if item.shape == -1 else item.shape
-                    dtype = np.dtype(type(ig[name])) if shape == [] else item.dtype
-                    if dtype is None: dtype = ig[name].dtype
-                     # if we can't get a dtype from the descriptor try and get one from the value
-                    logger.info("Creating dataset for %s (%s,%s)."%(str(name),str(shape),str(dtype)))
-                    f.create_dataset(name,[1] + ([] if list(shape) == [1] else list(shape)), maxshape=[None] + ([] if list(shape) == [1] else list(shape)), dtype=dtype)
-                    dump_size += np.multiply.reduce(shape) * dtype.itemsize
-                    datasets[name] = f[name]
-                    datasets_index[name] = 0
-                    if not item._changed: continue
-                     # if we built from and empty descriptor
-                else:
-                    logger.info("Adding %s to dataset. New size is %i."%(name,datasets_index[name]+1))
-                    f[name].resize(datasets_index[name]+1, axis=0)
-                if name.startswith("xeng_raw"):
-                    sd_timestamp = ig['sync_time'] + (ig['timestamp'] / float(ig['scale_factor_timestamp']))
-                    #logger.info("SD Timestamp: %f (%s)."%(sd_timestamp,time.ctime(sd_timestamp)))
-
-                    scale_factor=float(meta['n_accs'] if ('n_accs' in meta and acc_scale) else 1)
-                    scaled_data = (ig[name]/scale_factor).astype(np.float32)
-
-                     # reinit the group to force meta data resend
-                    ig_sd = spead.ItemGroup()
-                    ig_sd.add_item(name=('sd_data'),
-                                    id=(0x3501),
-                                    description="Combined raw data from all x engines.",
-                                    ndarray=(scaled_data.dtype,scaled_data.shape))
-                    ig_sd.add_item(name=('sd_timestamp'),
-                                    id=0x3502,
-                                    description='Timestamp of this sd frame in centiseconds since epoch (40 bit limitation).',
-                                    init_val=sd_timestamp)
-                                    #shape=[],
-                                    #fmt=spead.mkfmt(('u',spead.ADDRSIZE)))
-                    t_it = ig_sd.get_item('sd_data')
-                    logger.debug("Added SD frame with shape %s, dtype %s"%(str(t_it.shape),str(t_it.dtype)))
-                    tx_sd.send_heap(ig_sd.get_heap())
-
-                    logger.info("Sending signal display frame with timestamp %i (%s). %s. Max: %i, Mean: %i"%(
-                        sd_timestamp,
-                        time.ctime(sd_timestamp),
-                        "Unscaled" if not acc_scale else "Scaled by %i" % (scale_factor),
-                        np.max(scaled_data),
-                        np.mean(scaled_data)))
-                    ig_sd['sd_data'] = scaled_data
-                    ig_sd['sd_timestamp'] = sd_timestamp * 100
-                    #ig_sd['sd_timestamp'] = sd_timestamp
-                    tx_sd.send_heap(ig_sd.get_heap())
-
-                f[name][datasets_index[name]] = ig[name]
-                datasets_index[name] += 1
-                item._changed = False
-                  # we have dealt with this item so continue...
-            idx+=1
+        items = {}
+        values = {}
+        ring = self._start_rx_stage(backend, ring_slots)
+        try:
+            while True:
+                heap = ring.get()
+                if heap is None: break
+                get_time = time.time()
+                logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
+                self._heap_values(heap, values)
+                for desc in heap.new_items:
+                    # check to see if we have encountered this type before
+                    items[desc['name']] = desc
+                    for sink in sinks:
+                        sink.add_item(desc)
+                    dump_size += np.multiply.reduce(desc['shape']) * desc['dtype'].itemsize
+                for name in heap.names:
+                    if name in meta_desired:
+                        meta[name] = values[name]
+                    if name in meta_required:
+                        meta[name] = values[name]
+                        meta_required.pop(meta_required.index(name))
+                        if len(meta_required) == 0:
+                            #sd_frame = np.zeros((meta['n_chans'],meta['n_bls'],2),dtype=np.float32)
+                            logger.info("Got all required metadata. Expecting data frame shape of %i %i %i"%(meta['n_chans'],meta['n_bls'],2))
+                            meta_required = list(SD_META)
+                            sd.meta_send(items, values, SD_META)
+
+                    if name.startswith("xeng_raw") and sd.ready():
+                        sd_timestamp = values['sync_time'] + (values['timestamp'] / float(values['scale_factor_timestamp']))
+                        scale_factor=float(meta['n_accs'] if ('n_accs' in meta and acc_scale) else 1)
+                        sd.publish(values[name], sd_timestamp, scale_factor)
+
+                self._heap_store(heap, values, sinks, get_time)
+                ring.release()
+                idx+=1
 
 #        for (name,idx) in datasets_index.iteritems():
 #            if idx == 1:
 #                self.logger.info("Repacking dataset %s as an attribute as it is singular."%name)
 #                f['/'].attrs[name] = f[name].value[0]
 #                f.__delitem__(name)
-        logger.info("Got a SPEAD end-of-stream marker. Closing File.")
-        f.flush()
-        f.close()
-        rx.stop()
-        ig_sd = None
-        sd_timestamp = None
-        logger.info("Files and sockets closed.")
+            logger.info("Got a SPEAD end-of-stream marker. Closing File. %i heaps received, %i dropped, at most %i queued." % (ring.n_heaps, ring.n_dropped, ring.max_depth))
+            logger.info("Receiver statistics: %s" % self.stats.summary())
+        finally:
+            self._storage_stop(ring, backend, sinks)
+        logger.info("Files and sockets closed. Sent %i signal display frames, skipped %i." % (sd.n_sent, sd.n_skipped))
 
 
-    def rx_inter(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149, acc_scale=True, filename=None, **kwargs):
+    def rx_inter(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149, acc_scale=True, filename=None, h5_buffer_dumps=16, h5_compression=None, h5_shuffle=False, ring_slots=16, rx_backend='auto', rx_backend_kwargs={}, sd_rate=1.0, sd_baselines=None, sd_chan_decimation=1, sinks=None, bl_reorder=False, reduce_time_avg=1, reduce_chan_avg=1, reduce_baselines=None, reduce_filename=None, reduced_only=False, **kwargs):
         '''
         Process SPEAD data from X engines and forward it to the SD.
         '''
         print('WARNING: This function is not yet tested. YMMV.')
         logger=self.logger
         logger.info("Data reception on port %i."%data_port)
-        rx = spead.TransportUDPrx(data_port, pkt_count=1024, buffer_size=51200000)
+        backend = rx_backend_get(rx_backend, data_port, logger=logger, **rx_backend_kwargs)
+        logger.info("Using %s receive backend." % backend.__class__.__name__)
         logger.info("Sending Signal Display data to %s:%i."%(sd_ip,sd_port))
-        tx_sd = spead.Transmitter(spead.TransportUDPtx(sd_ip, sd_port))
-        ig = spead.ItemGroup()
-        ig_sd = spead.ItemGroup()
-        if filename == None:
-          filename=str(int(time.time())) + ".synth.h5"
-        logger.info("Starting file %s."%(filename))
-        f = h5py.File(filename, mode="w")
-        data_ds = None
-        ts_ds = None
+        sd = SdPublisher(sd_ip, sd_port, frame_rate=sd_rate, baselines=sd_baselines, chan_decimation=sd_chan_decimation, logger=logger)
+        sinks = self._sinks_get(sinks, filename, bl_reorder, reduce_time_avg, reduce_chan_avg, reduce_baselines, reduce_filename, reduced_only,
+            buffer_dumps=h5_buffer_dumps, compression=h5_compression, shuffle=h5_shuffle)
         idx = 0
         dump_size = 0
-        datasets = {}
-        datasets_index = {}
         # we need these bits of meta data before being able to assemble and transmit signal display data
-        meta_required = ['n_chans','n_bls','n_xengs','center_freq','bls_ordering','bandwidth']
+        meta_required = list(SD_META)
         meta_desired = ['n_accs']
         meta = {}
         sd_frame = None
@@ -193,123 +756,96 @@ class CorrRx(threading.Thread):
         # log the latest timestamp for which we've stored data
         currentTimestamp = -1
 
-        # iterate through SPEAD heaps returned by the SPEAD receiver.
-        for heap in spead.iterheaps(rx):
-            ig.update(heap)
-            logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
-            for name in ig.keys():
-                item = ig.get_item(name)
+        items = {}
+        values = {}
+        ring = self._start_rx_stage(backend, ring_slots)
+        try:
 
-                # the item is not marked as changed and we already have a record for it, continue
-                if not item._changed and name in datasets:
-                  continue
-                logger.debug("PROCESSING KEY %s @ %.4f" % (name, time.time()))
-
-                if name in meta_desired:
-                    meta[name] = ig[name]
-
-                if name in meta_required:
-                  meta[name] = ig[name]
-                  meta_required.pop(meta_required.index(name))
-                  if len(meta_required) == 0:
-                    sd_frame = np.zeros((meta['n_chans'],meta['n_bls'],2),dtype=np.float32)
-                    logger.info("Got all required metadata. Initialised sd frame to shape %s"%(str(sd_frame.shape)))
-                    meta_required = ['n_chans','bandwidth','n_bls','n_xengs','center_freq','bls_ordering']
-                    ig_sd = spead.ItemGroup()
-                    for meta_item in meta_required:
-                      ig_sd.add_item(
-                        name=ig.get_item(meta_item).name,
-                        id=ig.get_item(meta_item).id,
-                        description=ig.get_item(meta_item).description,
-                        #shape=ig.get_item(meta_item).shape,
-                        #fmt=ig.get_item(meta_item).format,
-                        init_val=ig.get_item(meta_item).get_value())
-                    tx_sd.send_heap(ig_sd.get_heap())
-                    sd_slots = np.zeros(meta['n_xengs'])
-                if name not in datasets:
-                 # check to see if we have encountered this type before
-                  shape = ig[name].shape if item.shape == -1 else item.shape
-                  dtype = np.dtype(type(ig[name])) if shape == [] else item.dtype
-                  if dtype is None: dtype = ig[name].dtype
-                   # if we can't get a dtype from the descriptor, try and get one from the value
-                  logger.info("Creating dataset for %s (%s,%s)."%(str(name),str(shape),str(dtype)))
-                  f.create_dataset(name,[1] + ([] if list(shape) == [1] else list(shape)), maxshape=[None] + ([] if list(shape) == [1] else list(shape)), dtype=dtype)
-                  dump_size += np.multiply.reduce(shape) * dtype.itemsize
-                  datasets[name] = f[name]
-                  datasets_index[name] = 0
-                  # if we built from an empty descriptor
-                  if not item._changed:
-                    continue
-                else:
-                  logger.info("Adding %s to dataset. New size is %i."%(name,datasets_index[name]+1))
-                  f[name].resize(datasets_index[name]+1, axis=0)
-
-                # now we store this x engine's data for sending sd data.
-                if sd_frame is not None and name.startswith("xeng_raw"):
-                  xeng_id = int(name[8:])
-                  sd_frame[xeng_id::meta['n_xengs']] = ig[name]
-                  logger.debug('Received data for Xeng %i @ %.4f' % (xeng_id, time.time()))
-
-                # we got a timestamp.
-                if sd_frame is not None and name.startswith("timestamp"):
-                  xeng_id = int(name[9:])
-                  timestamp = ig['sync_time'] + (ig[name] / ig['scale_factor_timestamp']) #in seconds since unix epoch
-                  localTime = time.time()
-                  print("Decoded timestamp for Xeng", xeng_id, ":", timestamp, " (", time.ctime(timestamp),") @ %.4f" % localTime, " ", time.ctime(localTime), "diff(", localTime-timestamp, ")")
-
-                  # is this timestamp in the past?
-                  if currentTimestamp > timestamp:
-                    errorString = "Timestamp %.2f (%s) is earlier than the current timestamp %.2f (%s). Ignoring..." % (timestamp, time.ctime(timestamp), currentTimestamp, time.ctime(currentTimestamp))
-                    logger.warning(errorString)
-                    continue
+            # iterate through SPEAD heaps passed on by the network stage.
+            while True:
+                heap = ring.get()
+                if heap is None: break
+                get_time = time.time()
+                logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
+                self._heap_values(heap, values)
+                for desc in heap.new_items:
+                    # check to see if we have encountered this type before
+                    items[desc['name']] = desc
+                    for sink in sinks:
+                        sink.add_item(desc)
+                    dump_size += np.multiply.reduce(desc['shape']) * desc['dtype'].itemsize
+                for name in heap.names:
+                    logger.debug("PROCESSING KEY %s @ %.4f" % (name, time.time()))
 
-                  # is this a new timestamp before a complete set?
-                  if (timestamp > currentTimestamp) and sd_slots.any():
-                    errorString = "New timestamp %.2f from Xeng%i before previous set %.2f sent" % (timestamp, xeng_id, currentTimestamp)
-                    logger.warning(errorString)
-                    sd_slots = np.zeros(meta['n_xengs'])
-                    sd_frame = np.zeros((ig['n_chans'],ig['n_bls'],2),dtype=sd_frame.dtype)
-                    currentTimestamp = -1
-                    continue
+                    if name in meta_desired:
+                        meta[name] = values[name]
+
+                    if name in meta_required:
+                      meta[name] = values[name]
+                      meta_required.pop(meta_required.index(name))
+                      if len(meta_required) == 0:
+                        sd_frame = np.zeros((meta['n_chans'],meta['n_bls'],2),dtype=np.float32)
+                        logger.info("Got all required metadata. Initialised sd frame to shape %s"%(str(sd_frame.shape)))
+                        meta_required = list(SD_META)
+                        sd.meta_send(items, values, SD_META)
+                        sd_slots = np.zeros(meta['n_xengs'])
+
+                    # now we store this x engine's data for sending sd data.
+                    if sd_frame is not None and name.startswith("xeng_raw"):
+                      xeng_id = int(name[8:])
+                      sd_frame[xeng_id::meta['n_xengs']] = values[name]
+                      logger.debug('Received data for Xeng %i @ %.4f' % (xeng_id, time.time()))
+
+                    # we got a timestamp.
+                    if sd_frame is not None and name.startswith("timestamp"):
+                      xeng_id = int(name[9:])
+                      timestamp = values['sync_time'] + (values[name] / values['scale_factor_timestamp']) #in seconds since unix epoch
+                      localTime = time.time()
+                      print("Decoded timestamp for Xeng", xeng_id, ":", timestamp, " (", time.ctime(timestamp),") @ %.4f" % localTime, " ", time.ctime(localTime), "diff(", localTime-timestamp, ")")
+
+                      # is this timestamp in the past?
+                      if currentTimestamp > timestamp:
+                        errorString = "Timestamp %.2f (%s) is earlier than the current timestamp %.2f (%s). Ignoring..." % (timestamp, time.ctime(timestamp), currentTimestamp, time.ctime(currentTimestamp))
+                        logger.warning(errorString)
+                        continue
+
+                      # is this a new timestamp before a complete set?
+                      if (timestamp > currentTimestamp) and sd_slots.any():
+                        errorString = "New timestamp %.2f from Xeng%i before previous set %.2f sent" % (timestamp, xeng_id, currentTimestamp)
+                        logger.warning(errorString)
+                        sd_slots = np.zeros(meta['n_xengs'])
+                        sd_frame[:] = 0
+                        currentTimestamp = -1
+                        continue
+
+                      # is this new timestamp in the past for this X engine?
+                      if timestamp <= sd_slots[xeng_id]:
+                        errorString = 'Xeng%i already on timestamp %.2f but got %.2f now, THIS SHOULD NOT HAPPEN' % (xeng_id, sd_slots[xeng_id], timestamp)
+                        logger.error(errorString)
+                        raise RuntimeError(errorString)
+
+                      # update our info on which integrations we have
+                      sd_slots[xeng_id] = timestamp
+                      currentTimestamp = timestamp
+
+                    # do we have integration data and timestamps for all the xengines? If so, send the SD frame.
+                    if timestamp is not None and sd_frame is not None and sd_slots is not None and sd_slots.all():
+                        scale_factor=(meta['n_accs'] if ('n_accs' in meta and acc_scale) else 1)
+                        sd.publish(sd_frame, timestamp, scale_factor)
+                        # reset the arrays that hold integration data
+                        sd_slots = np.zeros(meta['n_xengs'])
+                        sd_frame[:] = 0
+                        timestamp = None
+
+                self._heap_store(heap, values, sinks, get_time)
+                ring.release()
+                idx+=1
 
-                  # is this new timestamp in the past for this X engine?
-                  if timestamp <= sd_slots[xeng_id]:
-                    errorString = 'Xeng%i already on timestamp %.2f but got %.2f now, THIS SHOULD NOT HAPPEN' % (xeng_id, sd_slots[xeng_id], timestamp)
-                    logger.error(errorString)
-                    raise RuntimeError(errorString)
-
-                  # update our info on which integrations we have
-                  sd_slots[xeng_id] = timestamp
-                  currentTimestamp = timestamp
-
-                # do we have integration data and timestamps for all the xengines? If so, send the SD frame.
-                if timestamp is not None and sd_frame is not None and sd_slots is not None and sd_slots.all():
-                    ig_sd = spead.ItemGroup()
-                    # make sure we have the right dtype for the sd data
-                    ig_sd.add_item(name=('sd_data'), id=(0x3501), description="Combined raw data from all x engines.", ndarray=(sd_frame.dtype,sd_frame.shape))
-                    ig_sd.add_item(name=('sd_timestamp'), id=0x3502, description='Timestamp of this sd frame in centiseconds since epoch (40 bit limitation).', shape=[], fmt=spead.mkfmt(('u',spead.ADDRSIZE)))
-                    t_it = ig_sd.get_item('sd_data')
-                    logger.info("Added SD frame with shape %s, dtype %s" % (str(t_it.shape),str(t_it.dtype)))
-                    scale_factor=(meta['n_accs'] if 'n_accs' in meta else 1)
-                    logger.info("Sending signal display frame with timestamp %i (%s). %s. @ %.4f" % (timestamp, time.ctime(timestamp), "Unscaled" if not acc_scale else "Scaled by %i" % (scale_factor), time.time()))
-                    ig_sd['sd_data'] = sd_frame.astype(np.float32) if not acc_scale else (sd_frame / float(scale_factor)).astype(np.float32)
-                    ig_sd['sd_timestamp'] = int(timestamp * 100)
-                    tx_sd.send_heap(ig_sd.get_heap())
-                    # reset the arrays that hold integration data
-                    sd_slots = np.zeros(meta['n_xengs'])
-                    sd_frame = np.zeros((ig['n_chans'],ig['n_bls'],2),dtype=sd_frame.dtype)
-                    timestamp = None
-
-                f[name][datasets_index[name]] = ig[name]
-                datasets_index[name] += 1
-                item._changed = False
-            idx+=1
-
-        logger.info("Got a SPEAD end-of-stream marker. Closing File.")
-        f.flush()
-        f.close()
-        rx.stop()
+            logger.info("Got a SPEAD end-of-stream marker. Closing File. %i heaps received, %i dropped, at most %i queued." % (ring.n_heaps, ring.n_dropped, ring.max_depth))
+            logger.info("Receiver statistics: %s" % self.stats.summary())
+        finally:
+            self._storage_stop(ring, backend, sinks)
+        logger.info("Sent %i signal display frames, skipped %i." % (sd.n_sent, sd.n_skipped))
         sd_frame = None
         sd_slots = None
-        ig_sd = None
 
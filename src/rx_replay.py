@@ -0,0 +1,186 @@
+"""
+Capture and replay of correlator output streams, for testing and benchmarking receivers without hardware.
+
+PacketRecorder records the raw UDP packets arriving on a port (eg a correlator's SPEAD output) to a packet capture: the
+packet payloads back to back in basename.pkts and one PACKET_INDEX_DTYPE record (arrival time, offset, length) per packet
+in basename.pidx. replay_packets sends such a capture back out to a UDP address, either with the original packet timing,
+with the timing sped up by a factor, or as fast as possible, to find the point at which a receiver starts losing data.
+
+replay_heaps does the same for captures of decoded heaps made with rx_store.RawSink, re-encoding them as SPEAD heaps with spead2.
+
+Revs:
+2013-03-21  Initial.
+2013-03-30  Heap replay sends fixed width string arrays (eg bls_ordering) with their own dtype and shape.
+"""
+
+from __future__ import absolute_import
+import socket, time, logging
+import numpy as np
+import corr
+
+# one index record per captured packet
+PACKET_INDEX_DTYPE = np.dtype([('time', '<f8'), ('offset', '<u8'), ('length', '<u4'), ('pad', '<u4')])
+
+MAX_PACKET_BYTES = 65536
+
+class PacketRecorder:
+    """Records the UDP packets received on port to basename.pkts/.pidx until stop() is called, or max_packets have been
+        received, or nothing arrives for idle_timeout seconds (once the first packet is in). Index records are written
+        index_block at a time. Use with a thread to record in the background."""
+    def __init__(self, port, basename, buffer_size = 51200000, idle_timeout = 2.0, max_packets = None, index_block = 65536, logger = None):
+        self.logger = logger if logger != None else logging.getLogger('rx')
+        self.port = port
+        self.basename = basename
+        self.idle_timeout = idle_timeout
+        self.max_packets = max_packets
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        self.sock.bind(('', port))
+        self.sock.settimeout(0.1)
+        self.index = np.zeros(index_block, dtype = PACKET_INDEX_DTYPE)
+        self.n_packets = 0
+        self.n_bytes = 0
+        self._running = False
+
+    def record(self):
+        """Records packets until one of the stop conditions is met. Returns the number of packets recorded."""
+        buf = bytearray(MAX_PACKET_BYTES)
+        view = memoryview(buf)
+        data_fh = open(self.basename + '.pkts', 'wb')
+        index_fh = open(self.basename + '.pidx', 'wb')
+        n_index = 0
+        last_time = None
+        self._running = True
+        self.logger.info('Recording packets from port %i to %s.pkts.' % (self.port, self.basename))
+        try:
+            while self._running and (self.max_packets == None or self.n_packets < self.max_packets):
+                try:
+                    length = self.sock.recv_into(buf)
+                except socket.timeout:
+                    if last_time != None and (time.time() - last_time) > self.idle_timeout:
+                        break
+                    continue
+                last_time = time.time()
+                data_fh.write(view[0:length])
+                self.index[n_index] = (last_time, self.n_bytes, length, 0)
+                n_index += 1
+                self.n_packets += 1
+                self.n_bytes += length
+                if n_index == len(self.index):
+                    index_fh.write(self.index.tobytes())
+                    n_index = 0
+        finally:
+            index_fh.write(self.index[0:n_index].tobytes())
+            index_fh.close()
+            data_fh.close()
+            self.sock.close()
+            self._running = False
+        self.logger.info('Recorded %i packets (%i bytes) to %s.pkts.' % (self.n_packets, self.n_bytes, self.basename))
+        return self.n_packets
+
+    def stop(self):
+        self._running = False
+
+class PacketCapture:
+    """Reads back a capture made by PacketRecorder."""
+    def __init__(self, basename):
+        self.index = np.fromfile(basename + '.pidx', dtype = PACKET_INDEX_DTYPE)
+        self.data = np.memmap(basename + '.pkts', dtype = np.uint8, mode = 'r') if len(self.index) > 0 else np.zeros(0, dtype = np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def duration(self):
+        """Time between the first and last packets, in seconds."""
+        return float(self.index['time'][-1] - self.index['time'][0]) if len(self.index) > 1 else 0.0
+
+    def packet(self, n):
+        """The n'th packet's payload, as a read-only view onto the capture file."""
+        offset = int(self.index['offset'][n])
+        return self.data[offset:offset + int(self.index['length'][n])]
+
+def _replay_times(times, speedup):
+    """Send times (relative to the start of the replay) for records received at times. None, or a speedup of zero or less: as fast as possible."""
+    if speedup == None or speedup <= 0 or len(times) == 0:
+        return None
+    return (times - times[0]) / float(speedup)
+
+def _pace(start_time, target):
+    """Waits until target seconds after start_time. Short waits spin rather than sleep, for accurate timing at high rates."""
+    ahead = target - (time.time() - start_time)
+    if ahead > 0.002:
+        time.sleep(ahead - 0.001)
+    while (time.time() - start_time) < target:
+        pass
+
+def _replay_stats(n, n_bytes, elapsed, speedup, source_duration):
+    elapsed = max(elapsed, 1e-9)
+    return {'count': n, 'bytes': n_bytes, 'elapsed': elapsed, 'rate': n / elapsed, 'bits_per_second': n_bytes * 8.0 / elapsed,
+        'speedup_achieved': (source_duration / elapsed) if source_duration > 0 else 0.0}
+
+def replay_packets(basename, ip = '127.0.0.1', port = 7148, speedup = 1.0, loops = 1, logger = None):
+    """Sends the packets of a PacketRecorder capture to ip:port. With speedup 1 the original packet spacing is kept, with
+        speedup N it is reduced N times, and with speedup 0 (or None) packets are sent as fast as possible. The capture is
+        sent loops times (including any end-of-stream packets it holds). Returns a dictionary of count (packets sent), bytes, elapsed, rate (packets/s), bits_per_second
+        and speedup_achieved (capture duration over replay time)."""
+    logger = logger if logger != None else logging.getLogger('rx')
+    cap = PacketCapture(basename)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dest = (ip, port)
+    offsets = cap.index['offset'].astype(np.int64)
+    ends = offsets + cap.index['length']
+    targets = _replay_times(cap.index['time'], speedup)
+    view = memoryview(cap.data)
+    logger.info('Replaying %i packets from %s.pkts to %s:%i, %i times.' % (len(cap), basename, ip, port, loops))
+    start_time = time.time()
+    n_bytes = 0
+    for loop in range(loops):
+        loop_start = time.time()
+        for n in range(len(cap)):
+            if targets is not None:
+                _pace(loop_start, targets[n])
+            n_bytes += sock.sendto(view[offsets[n]:ends[n]], dest)
+    elapsed = time.time() - start_time
+    sock.close()
+    return _replay_stats(len(cap) * loops, n_bytes, elapsed, speedup, cap.duration() * loops)
+
+def replay_heaps(basename, ip = '127.0.0.1', port = 7148, speedup = 1.0, flavour = (4, 64, 48), max_packet_size = 9000, logger = None):
+    """Re-encodes the heaps of an rx_store.RawSink capture as SPEAD heaps (using spead2) and sends them to ip:port,
+        at the original heap spacing divided by speedup (as fast as possible if speedup is 0 or None), followed by an
+        end-of-stream heap. All items are declared in the first heap. Returns the same dictionary as
+        replay_packets, counting heaps."""
+    try:
+        import spead2, spead2.send
+    except ImportError:
+        raise RuntimeError('Heap replay needs the spead2 package.')
+    logger = logger if logger != None else logging.getLogger('rx')
+    reader = corr.rx_store.RawReader(basename)
+    stream = spead2.send.UdpStream(spead2.ThreadPool(), [(ip, port)], spead2.send.StreamConfig(max_packet_size = max_packet_size, rate = 0))
+    ig = spead2.send.ItemGroup(flavour = spead2.Flavour(*flavour))
+    for desc in reader.items:
+        dtype = desc['dtype']
+        item_id = desc['id'] if desc['id'] > 0 else None
+        if dtype.itemsize == 0 or dtype.kind == 'O':
+            # values without a fixed size (python objects) go as variable length byte strings
+            ig.add_item(item_id, desc['name'], desc['description'], shape = (None,), format = [('u', 8)])
+        else:
+            ig.add_item(item_id, desc['name'], desc['description'], shape = tuple(desc['shape']), dtype = dtype)
+    heaps = list(reader.heaps())
+    targets = _replay_times(np.array([rx_time for heap_cnt, rx_time, names, values in heaps]), speedup)
+    logger.info('Replaying %i heaps from %s.raw to %s:%i.' % (len(heaps), basename, ip, port))
+    start_time = time.time()
+    n_bytes = 0
+    for n, (heap_cnt, rx_time, names, values) in enumerate(heaps):
+        for name in names:
+            item = ig[name]
+            value = values[name]
+            if item.dtype is None:
+                value = np.frombuffer(value if isinstance(value, bytes) else np.ascontiguousarray(value).tobytes(), dtype = np.uint8)
+            item.value = value
+            n_bytes += np.asarray(value).nbytes
+        if targets is not None:
+            _pace(start_time, targets[n])
+        stream.send_heap(ig.get_heap())
+    stream.send_heap(ig.get_end())
+    elapsed = time.time() - start_time
+    return _replay_stats(len(heaps), n_bytes, elapsed, speedup, (heaps[-1][1] - heaps[0][1]) if len(heaps) > 1 else 0.0)
@@ -0,0 +1,218 @@
+"""
+Receiver statistics for rx.CorrRx.
+
+RxStats counts what the receiver's network and storage stages do with every heap: heaps and bytes received (with rates over
+a sliding window), heaps dropped because the storage stage fell behind, incomplete heaps reported by the receive backend,
+dumps missing from the stream (gaps in the timestamp items), the depth of the heap ring, and histograms of the per-heap
+decode time (network stage), queueing time (ring), write time (dump sinks) and lateness (arrival time against the dump's
+timestamp). Together these show whether a capture problem lies with the network, the decoder or the disk.
+
+The statistics can be queried at any time with RxStats.get(), and can optionally be published as KATCP sensors.
+
+Revs:
+2013-03-17  Initial.
+2013-03-30  Dumps of dropped heaps are no longer counted as missing too.
+"""
+
+from __future__ import absolute_import
+import threading, time, collections
+import numpy
+
+class LatencyHistogram:
+    """Histogram of latencies (in seconds) with logarithmically spaced bins, bins_per_decade bins per factor of ten from
+        min_s to max_s. Values outside this range go into the first or last bin. Percentiles are estimated from the bin edges."""
+    def __init__(self, min_s = 1e-6, max_s = 100.0, bins_per_decade = 10):
+        n_bins = int(numpy.ceil(numpy.log10(max_s / min_s) * bins_per_decade))
+        self.edges = numpy.logspace(numpy.log10(min_s), numpy.log10(max_s), n_bins + 1)
+        self.reset()
+
+    def reset(self):
+        """Clear the histogram."""
+        self.counts = numpy.zeros(len(self.edges) + 1, dtype = numpy.int64)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Add a single latency (or an array of them)."""
+        values = numpy.atleast_1d(numpy.asarray(value, dtype = float))
+        if values.size == 0:
+            return
+        if values.size == 1:
+            self.counts[numpy.searchsorted(self.edges, values[0], side = 'right')] += 1
+        else:
+            self.counts += numpy.bincount(numpy.searchsorted(self.edges, values, side = 'right'), minlength = len(self.counts))
+        self.n += values.size
+        self.total += float(values.sum())
+        self.max = max(self.max, float(values.max()))
+
+    def mean(self):
+        return self.total / self.n if self.n > 0 else 0.0
+
+    def percentile(self, pct):
+        """Upper edge of the bin holding the pct'th percentile value."""
+        if self.n == 0:
+            return 0.0
+        idx = numpy.searchsorted(numpy.cumsum(self.counts), numpy.ceil(self.n * pct / 100.0))
+        if idx >= len(self.edges):
+            return self.max
+        return float(self.edges[idx])
+
+    def summary(self):
+        """Dictionary of count, mean, max and 50/90/99th percentiles."""
+        return {'count': self.n, 'mean': self.mean(), 'max': self.max,
+            'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+# latency histograms kept by RxStats
+RX_LATENCIES = ['decode', 'queue', 'write', 'lateness']
+
+class RxStats:
+    """Thread-safe receiver counters. The network stage calls heap_received() or heap_dropped() for every heap, the storage
+        stage calls heap_stored() once the heap has been written and timestamp() for every timestamp item it sees.
+        Rates are averaged over the last window seconds."""
+    def __init__(self, window = 10.0):
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zero all counters and histograms."""
+        with self._lock:
+            self.start_time = time.time()
+            self.n_heaps = 0
+            self.n_bytes = 0
+            self.n_data_heaps = 0
+            self.n_dropped = 0
+            self.n_stored = 0
+            self.n_incomplete = 0
+            self.n_missing = 0
+            self.n_out_of_order = 0
+            self.last_heap_cnt = -1
+            self.queue_depth = 0
+            self.max_queue_depth = 0
+            self.latencies = dict([(name, LatencyHistogram()) for name in RX_LATENCIES])
+            self._ts_last = {}
+            self._ts_step = {}
+            self._ts_dropped = {}
+            self._samples = collections.deque()
+
+    def heap_received(self, heap_cnt, nbytes, decode_s, is_data = False):
+        """Network stage: a heap of nbytes of item data was received, taking decode_s seconds to unpack."""
+        now = time.time()
+        with self._lock:
+            self.n_heaps += 1
+            self.n_bytes += nbytes
+            if is_data:
+                self.n_data_heaps += 1
+            self.last_heap_cnt = heap_cnt
+            self.latencies['decode'].add(decode_s)
+            self._samples.append((now, self.n_heaps, self.n_bytes))
+            while len(self._samples) > 2 and (now - self._samples[1][0]) > self.window:
+                self._samples.popleft()
+
+    def heap_dropped(self, heap_cnt, timestamps = []):
+        """Network stage: a heap was discarded because the ring was full. timestamps is a list of the (name, value) of the
+            timestamp items in the heap, so that the dumps they belong to are not counted as missing as well."""
+        with self._lock:
+            self.n_dropped += 1
+            self.last_heap_cnt = heap_cnt
+            for name, ts in timestamps:
+                self._ts_dropped.setdefault(name, set()).add(int(ts))
+
+    def set_incomplete(self, n_incomplete):
+        """The receive backend's running count of heaps that were never completed."""
+        with self._lock:
+            self.n_incomplete = n_incomplete
+
+    def heap_stored(self, rx_time, queue_s, write_s, depth):
+        """Storage stage: a heap received at rx_time waited queue_s seconds in the ring and took write_s seconds to store. depth is the number of heaps queued behind it."""
+        with self._lock:
+            self.n_stored += 1
+            self.latencies['queue'].add(queue_s)
+            self.latencies['write'].add(write_s)
+            self.queue_depth = depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def timestamp(self, name, ts, rx_time = None, seconds = None):
+        """Storage stage: timestamp item name has the value ts (in ADC sample counts). Gaps bigger than the usual step between
+            consecutive timestamps count as missing dumps, apart from the dumps of heaps already counted as dropped, and
+            timestamps going backwards are counted as out of order.
+            If seconds (the timestamp as a unix time) and rx_time are given, the heap's lateness is also recorded."""
+        ts = int(ts)
+        with self._lock:
+            if seconds != None and rx_time != None:
+                self.latencies['lateness'].add(max(0.0, rx_time - seconds))
+            last = self._ts_last.get(name)
+            if last == None:
+                self._ts_last[name] = ts
+                return
+            diff = ts - last
+            if diff <= 0:
+                self.n_out_of_order += 1
+                return
+            step = self._ts_step.get(name)
+            if step == None or diff < step:
+                # the smallest step seen is taken to be one dump
+                self._ts_step[name] = step = diff
+            gap = int(round(float(diff) / step)) - 1
+            dropped = self._ts_dropped.get(name)
+            if dropped:
+                gap -= len([t for t in dropped if last < t < ts])
+                self._ts_dropped[name] = set([t for t in dropped if t > ts])
+            self.n_missing += max(0, gap)
+            self._ts_last[name] = ts
+
+    def rates(self):
+        """(heaps/s, bytes/s) over the last window seconds."""
+        with self._lock:
+            if len(self._samples) < 2:
+                return (0.0, 0.0)
+            (t0, h0, b0), (t1, h1, b1) = self._samples[0], self._samples[-1]
+        if t1 <= t0:
+            return (0.0, 0.0)
+        return ((h1 - h0) / (t1 - t0), (b1 - b0) / (t1 - t0))
+
+    def get(self):
+        """Returns a snapshot of all statistics as a dictionary."""
+        heap_rate, byte_rate = self.rates()
+        with self._lock:
+            rv = {'uptime': time.time() - self.start_time, 'heaps': self.n_heaps, 'bytes': self.n_bytes, 'data_heaps': self.n_data_heaps,
+                'dropped': self.n_dropped, 'stored': self.n_stored, 'incomplete': self.n_incomplete, 'missing_dumps': self.n_missing,
+                'out_of_order': self.n_out_of_order, 'last_heap_cnt': self.last_heap_cnt, 'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth, 'heap_rate': heap_rate, 'byte_rate': byte_rate}
+            for name in RX_LATENCIES:
+                rv[name + '_latency'] = self.latencies[name].summary()
+        return rv
+
+    def summary(self):
+        """One line summary, for logging."""
+        s = self.get()
+        return ('%i heaps (%i data), %i bytes, %i dropped, %i incomplete, %i dumps missing, %i out of order, at most %i queued. '
+            'Latency p99: decode %.1fms, queue %.1fms, write %.1fms.' % (s['heaps'], s['data_heaps'], s['bytes'], s['dropped'],
+            s['incomplete'], s['missing_dumps'], s['out_of_order'], s['max_queue_depth'], s['decode_latency']['p99'] * 1e3,
+            s['queue_latency']['p99'] * 1e3, s['write_latency']['p99'] * 1e3))
+
+    def katcp_sensors(self, prefix = 'rx'):
+        """Returns a list of KATCP sensors for these statistics (named prefix-...), for adding to a katcp.DeviceServer.
+            Call update_sensors() periodically to refresh them."""
+        import katcp
+        self._sensors = {}
+        counters = [('heaps', 'heaps received'), ('bytes', 'bytes received'), ('dropped', 'heaps dropped by the network stage'),
+            ('incomplete', 'incomplete heaps'), ('missing_dumps', 'dumps missing from the timestamp sequence'),
+            ('out_of_order', 'timestamps out of order'), ('queue_depth', 'heaps queued for storage')]
+        for key, desc in counters:
+            self._sensors[key] = katcp.Sensor(katcp.Sensor.INTEGER, '%s-%s' % (prefix, key.replace('_', '-')), 'Number of %s.' % desc, '', [0, 2**62])
+        for key, desc, units in [('heap_rate', 'Heaps received per second.', 'Hz'), ('byte_rate', 'Bytes received per second.', 'B/s')]:
+            self._sensors[key] = katcp.Sensor(katcp.Sensor.FLOAT, '%s-%s' % (prefix, key.replace('_', '-')), desc, units, [0, 1e12])
+        for name in RX_LATENCIES:
+            key = name + '_latency'
+            self._sensors[key] = katcp.Sensor(katcp.Sensor.FLOAT, '%s-%s-latency-p99' % (prefix, name),
+                '99th percentile of the per-heap %s time.' % name, 's', [0, 1e6])
+        self.update_sensors()
+        return list(self._sensors.values())
+
+    def update_sensors(self):
+        """Sets the sensors made by katcp_sensors() to the current values."""
+        s = self.get()
+        for key, sensor in self._sensors.items():
+            sensor.set_value(s[key]['p99'] if key.endswith('_latency') else s[key])
@@ -0,0 +1,488 @@
+"""
+Storage of received correlator dumps.
+
+H5Writer appends a stream of dumps (one array per item per heap) to HDF5 datasets. Rather than growing each dataset by
+one entry for every heap, it buffers a number of dumps in memory and writes them as a block, and preallocates the
+datasets in chunk-aligned steps, so that HDF5 metadata is only touched every few hundred dumps. Datasets are chunked
+with a time x channel x baseline chunk shape sized from the dump size, and can optionally be compressed.
+
+The dump sinks below are what CorrRx hands its received heaps to: H5Sink (the H5Writer above), RawSink (the fastest
+option: an append-only binary file plus a small index, which RawReader/raw_to_h5 convert to HDF5 offline) and
+CallbackSink (for processing in the same process). ReorderSink wraps any of these to store dumps with their baselines in
+canonical order, and ReduceSink to store time and channel averaged dumps of a subset of the baselines.
+
+Revs:
+2013-03-12  Initial. Chunked, preallocated and buffered HDF5 writer.
+2013-03-16  Dump sinks: HDF5, raw memmap with index and callback. Offline raw to HDF5 conversion.
+2013-03-19  ReorderSink: canonical baseline order, using baselines.BaselineReorder.
+2013-03-20  ReduceSink: online time averaging, channel averaging and baseline selection.
+"""
+
+from __future__ import absolute_import
+import time, logging, json, re, abc
+import six
+import numpy as np
+import h5py
+import corr
+
+# target size of a single HDF5 chunk, in bytes
+CHUNK_BYTES = 1 << 20
+# upper limit on the memory used to buffer the dumps of a single dataset, in bytes
+BUFFER_BYTES = 64 << 20
+
+def chunk_shape(dump_shape, itemsize, chunk_bytes = CHUNK_BYTES, max_dumps = None):
+    """Chunk shape for a dataset of dumps of dump_shape. Small dumps are grouped along the time axis (up to max_dumps per chunk),
+    dumps larger than chunk_bytes are split along their first (channel) axis."""
+    dump_shape = list(dump_shape)
+    dump_bytes = int(np.prod(dump_shape)) * itemsize
+    if dump_bytes <= chunk_bytes or len(dump_shape) == 0:
+        n_dumps = max(1, chunk_bytes // max(dump_bytes, 1))
+        if max_dumps != None:
+            n_dumps = min(n_dumps, max_dumps)
+        return tuple([n_dumps] + dump_shape)
+    n_first = max(1, (dump_shape[0] * chunk_bytes) // dump_bytes)
+    return tuple([1, n_first] + dump_shape[1:])
+
+def _h5_filter(compression, compression_opts):
+    """Returns the h5py create_dataset keyword arguments for the named compression filter."""
+    if compression == None:
+        return {}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if compression_opts == None else compression_opts}
+    if compression == 'lzf':
+        return {'compression': 'lzf'}
+    if compression == 'lz4':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise RuntimeError('lz4 compression needs the hdf5plugin package.')
+        return dict(hdf5plugin.LZ4())
+    raise RuntimeError('Unknown compression %s. Expecting gzip, lzf or lz4.' % compression)
+
+class _BufferedDataset:
+    def __init__(self, ds, shape, dtype, buffer_dumps, prealloc):
+        self.ds = ds
+        self.prealloc = prealloc
+        self.buf = np.zeros([buffer_dumps] + list(shape), dtype = dtype)
+        self.n_buf = 0
+        self.n_written = 0
+        self.allocated = ds.shape[0]
+
+class H5Writer:
+    """Buffered writer of dumps to an HDF5 file.
+        Each dataset holds one entry per dump along its first axis. Entries are collected in memory blocks of buffer_dumps
+        (fewer for dumps so large that the block would exceed buffer_bytes) and the datasets are grown prealloc_dumps at a time (both rounded up to whole chunks). The datasets are trimmed to
+        the number of dumps actually written on close.
+        compression is None, 'gzip', 'lzf' or 'lz4' (needs hdf5plugin). shuffle enables the HDF5 byte shuffle filter.
+        Buffered dumps are written out at least every flush_period seconds."""
+    def __init__(self, filename, buffer_dumps = 16, prealloc_dumps = 256, chunk_bytes = CHUNK_BYTES, buffer_bytes = BUFFER_BYTES,
+                 compression = None, compression_opts = None, shuffle = False, flush_period = 10.0, logger = None):
+        self.filename = filename
+        self.buffer_dumps = max(1, buffer_dumps)
+        self.buffer_bytes = buffer_bytes
+        self.prealloc_dumps = max(self.buffer_dumps, prealloc_dumps)
+        self.chunk_bytes = chunk_bytes
+        self.filter_kwargs = _h5_filter(compression, compression_opts)
+        if shuffle:
+            self.filter_kwargs['shuffle'] = True
+        self.flush_period = flush_period
+        self.logger = logger if logger != None else logging.getLogger('rx')
+        self.f = h5py.File(filename, mode = 'w')
+        self.datasets = {}
+        self.bytes_written = 0
+        self._last_flush = time.time()
+
+    def __contains__(self, name):
+        return name in self.datasets
+
+    def add_dataset(self, name, shape, dtype):
+        """Creates the dataset for item name, whose values have the given shape and dtype. Scalar items are stored as one value per dump."""
+        shape = [] if list(shape) in [[], [1]] else list(shape)
+        dtype = np.dtype(dtype)
+        buffer_dumps = max(1, min(self.buffer_dumps, self.buffer_bytes // max(int(np.prod(shape)) * dtype.itemsize, 1)))
+        chunks = chunk_shape(shape, dtype.itemsize, self.chunk_bytes, max_dumps = buffer_dumps)
+        # keep the write blocks and allocation steps aligned with whole chunks in time
+        t_chunk = chunks[0]
+        buffer_dumps = ((buffer_dumps + t_chunk - 1) // t_chunk) * t_chunk
+        prealloc = ((self.prealloc_dumps + buffer_dumps - 1) // buffer_dumps) * buffer_dumps
+        self.logger.info("Creating dataset for %s (%s,%s). Chunks %s, writing every %i dumps." % (name, str(shape), str(dtype), str(chunks), buffer_dumps))
+        ds = self.f.create_dataset(name, [prealloc] + shape, maxshape = [None] + shape, dtype = dtype, chunks = chunks, **self.filter_kwargs)
+        self.datasets[name] = _BufferedDataset(ds, shape, dtype, buffer_dumps, prealloc)
+
+    def append(self, name, value):
+        """Adds a dump of item name to its dataset."""
+        d = self.datasets[name]
+        d.buf[d.n_buf] = value
+        d.n_buf += 1
+        if d.n_buf == len(d.buf):
+            self._write(d)
+        if (time.time() - self._last_flush) > self.flush_period:
+            self.flush()
+
+    def dumps(self, name):
+        """Number of dumps of item name received so far (written or buffered)."""
+        d = self.datasets[name]
+        return d.n_written + d.n_buf
+
+    def _write(self, d):
+        if d.n_buf == 0:
+            return
+        end = d.n_written + d.n_buf
+        if end > d.allocated:
+            d.allocated = ((end + d.prealloc - 1) // d.prealloc) * d.prealloc
+            d.ds.resize(d.allocated, axis = 0)
+        d.ds[d.n_written:end] = d.buf[0:d.n_buf]
+        self.bytes_written += d.buf[0:d.n_buf].nbytes
+        d.n_written = end
+        d.n_buf = 0
+
+    def flush(self):
+        """Writes all buffered dumps to the file."""
+        for d in self.datasets.values():
+            self._write(d)
+        self.f.flush()
+        self._last_flush = time.time()
+
+    def close(self):
+        """Writes out any buffered dumps, trims the datasets to the number of dumps received and closes the file."""
+        for name, d in self.datasets.items():
+            self._write(d)
+            d.ds.resize(d.n_written, axis = 0)
+        self.f.flush()
+        self.f.close()
+        self.logger.info("Closed %s after writing %i bytes." % (self.filename, self.bytes_written))
+
+@six.add_metaclass(abc.ABCMeta)
+class DumpSink:
+    """Interface of the consumers of received heaps.
+        add_item is called once for every item descriptor {name, id, description, shape, dtype}, before the item's first value.
+        heap is called for every received heap with the names of the items it updated and a dictionary holding their values.
+        Array values may be views into the receiver's buffers, only valid for the duration of the call: sinks must copy anything they keep.
+        Subclasses must implement heap(); add_item() and close() do nothing unless overridden."""
+    def add_item(self, desc):
+        pass
+
+    @abc.abstractmethod
+    def heap(self, heap_cnt, rx_time, names, values):
+        """Stores or processes one heap, as described above."""
+
+    def close(self):
+        pass
+
+class H5Sink(DumpSink):
+    """Writes every item to its own HDF5 dataset, one entry per update. Keyword arguments are passed on to H5Writer."""
+    def __init__(self, filename, **kwargs):
+        self.writer = H5Writer(filename, **kwargs)
+
+    def add_item(self, desc):
+        self.writer.add_dataset(desc['name'], desc['shape'], desc['dtype'])
+
+    def heap(self, heap_cnt, rx_time, names, values):
+        for name in names:
+            self.writer.append(name, values[name])
+
+    def close(self):
+        self.writer.close()
+
+class CallbackSink(DumpSink):
+    """Calls callback(heap_cnt, rx_time, names, values) for every heap, and item_callback(desc) (if given) for every new item."""
+    def __init__(self, callback, item_callback = None):
+        self.callback = callback
+        self.item_callback = item_callback
+
+    def add_item(self, desc):
+        if self.item_callback != None:
+            self.item_callback(desc)
+
+    def heap(self, heap_cnt, rx_time, names, values):
+        self.callback(heap_cnt, rx_time, names, values)
+
+class ReorderSink(DumpSink):
+    """Passes heaps on to sink with the X engine data items (xeng_raw*) replaced by vis* items holding the same dumps in canonical
+        (n_chans x n_ant_pairs x n_pol_products x 2) order (see baselines.BaselineReorder), worked out from the bls_ordering metadata.
+        The labels of the new axes are stored as the vis_ants, vis_ant_pairs and vis_pol_products items.
+        Dumps received before bls_ordering are dropped, unless keep_raw is set, in which case the original items are stored as well."""
+    def __init__(self, sink, keep_raw = False, logger = None):
+        self.sink = sink
+        self.keep_raw = keep_raw
+        self.logger = logger if logger != None else logging.getLogger('rx')
+        self.reorder = None
+        self.raw_descs = {}
+        self.bufs = {}
+        self.n_unordered = 0
+
+    def add_item(self, desc):
+        if desc['name'].startswith('xeng_raw'):
+            self.raw_descs[desc['name']] = desc
+            if self.reorder is not None:
+                self._add_vis_item(desc)
+            if not self.keep_raw:
+                return
+        self.sink.add_item(desc)
+
+    def _add_vis_item(self, desc):
+        name = desc['name'].replace('xeng_raw', 'vis', 1)
+        shape = self.reorder.shape(desc['shape'])
+        self.bufs[desc['name']] = np.zeros(shape, dtype = desc['dtype'])
+        self.sink.add_item({'name': name, 'id': desc['id'], 'description': desc['description'] + ' Reordered to (channel, antenna pair, polarisation product, real/imaginary).',
+            'shape': list(shape), 'dtype': np.dtype(desc['dtype'])})
+
+    def _reorder_set(self, heap_cnt, rx_time, bls_ordering):
+        reorder = corr.baselines.baseline_reorder_get(bls_ordering)
+        if reorder is self.reorder:
+            return
+        if self.reorder is not None:
+            raise RuntimeError('Baseline ordering changed during the capture.')
+        self.reorder = reorder
+        labels = {'vis_ants': np.array(reorder.ants, dtype = 'S'), 'vis_ant_pairs': reorder.ant_pairs,
+            'vis_pol_products': np.array(reorder.pol_labels(), dtype = 'S')}
+        for name, value in labels.items():
+            self.sink.add_item({'name': name, 'id': 0, 'description': 'Labels of the reordered X engine data.', 'shape': list(value.shape), 'dtype': value.dtype})
+        self.sink.heap(heap_cnt, rx_time, list(labels.keys()), labels)
+        for desc in self.raw_descs.values():
+            self._add_vis_item(desc)
+        self.logger.info('Reordering %i baselines into %i antenna pairs of %i polarisation products.' % (reorder.n_bls, len(reorder.ant_pairs), len(reorder.pol_products)))
+
+    def heap(self, heap_cnt, rx_time, names, values):
+        if 'bls_ordering' in names:
+            self._reorder_set(heap_cnt, rx_time, values['bls_ordering'])
+        out_names = []
+        out_values = dict(values)
+        for name in names:
+            if not name.startswith('xeng_raw'):
+                out_names.append(name)
+                continue
+            if self.keep_raw:
+                out_names.append(name)
+            if self.reorder is None:
+                self.n_unordered += 1
+                continue
+            vis_name = name.replace('xeng_raw', 'vis', 1)
+            out_values[vis_name] = self.reorder.apply(values[name], out = self.bufs[name])
+            out_names.append(vis_name)
+        if len(out_names) > 0:
+            self.sink.heap(heap_cnt, rx_time, out_names, out_values)
+
+    def close(self):
+        if self.n_unordered > 0:
+            self.logger.warning('Dropped %i dumps received before the baseline ordering.' % self.n_unordered)
+        self.sink.close()
+
+# the correlator data items reduced by ReduceSink, and the timestamp items that go with them
+_DATA_ITEM = re.compile(r'^(xeng_raw|vis)(\d*)$')
+
+class ReduceSink(DumpSink):
+    """Passes heaps on to sink with the correlator data items (xeng_raw*, or vis* from a ReorderSink) reduced: only the baselines
+        (indices along the second axis, which is the antenna pair axis for vis items) in baselines are kept (default all), each
+        chan_avg adjacent channels are averaged, and time_avg successive dumps are averaged. The reduced dumps are float32, and go
+        out once every time_avg dumps along with the timestamp of the first dump averaged.
+        Reduced items are renamed with suffix; if data_only is set, only these are passed on. Use this to add reduced datasets
+        to a sink that also gets the full rate data; otherwise give this its own sink (eg another H5Sink).
+        The reduction parameters are stored as the reduce_time_avg, reduce_chan_avg and reduce_baselines items."""
+    def __init__(self, sink, time_avg = 1, chan_avg = 1, baselines = None, suffix = '', data_only = False, logger = None):
+        if time_avg < 1 or chan_avg < 1:
+            raise RuntimeError('Averaging lengths must be at least one.')
+        self.sink = sink
+        self.time_avg = time_avg
+        self.chan_avg = chan_avg
+        self.baselines = None if baselines is None else np.asarray(baselines, dtype = np.intp)
+        self.suffix = suffix
+        self.data_only = data_only
+        self.logger = logger if logger != None else logging.getLogger('rx')
+        self.items = {}
+        self.timestamps = {}
+        self.n_dumps = 0
+        self._declared = False
+
+    def _timestamp_name(self, name):
+        return 'timestamp' + _DATA_ITEM.match(name).group(2)
+
+    def add_item(self, desc):
+        name = desc['name']
+        if _DATA_ITEM.match(name) and len(desc['shape']) >= 3:
+            shape = list(desc['shape'])
+            if shape[0] % self.chan_avg != 0:
+                raise RuntimeError('Cannot average %s\'s %i channels in groups of %i.' % (name, shape[0], self.chan_avg))
+            baselines = np.arange(shape[1]) if self.baselines is None else self.baselines
+            if len(baselines) > 0 and (baselines.min() < 0 or baselines.max() >= shape[1]):
+                raise RuntimeError('Baseline selection out of range for %s, which has %i.' % (name, shape[1]))
+            sel_shape = [shape[0], len(baselines)] + shape[2:]
+            out_shape = [shape[0] // self.chan_avg, len(baselines)] + shape[2:]
+            self.items[name] = {'baselines': baselines, 'sel': np.zeros(sel_shape, dtype = desc['dtype']), 'chan_sum': np.zeros(out_shape),
+                'acc': np.zeros(out_shape), 'out': np.zeros(out_shape, dtype = np.float32), 'count': 0, 'timestamp': None}
+            self.sink.add_item(dict(desc, name = name + self.suffix, shape = out_shape, dtype = np.dtype(np.float32),
+                description = desc['description'] + ' Averaged over %i dumps and %i channels.' % (self.time_avg, self.chan_avg)))
+        elif name.startswith('timestamp'):
+            self.timestamps[name] = desc
+            self.sink.add_item(dict(desc, name = name + self.suffix))
+        elif not self.data_only:
+            self.sink.add_item(desc)
+
+    def _declare(self, heap_cnt, rx_time):
+        values = {'reduce_time_avg': np.array(self.time_avg), 'reduce_chan_avg': np.array(self.chan_avg),
+            'reduce_baselines': np.array([-1] if self.baselines is None else self.baselines)}
+        names = [name + self.suffix for name in values]
+        for name, value in values.items():
+            self.sink.add_item({'name': name + self.suffix, 'id': 0, 'description': 'Online reduction parameters (baselines -1: all).',
+                'shape': list(value.shape), 'dtype': value.dtype})
+        self.sink.heap(heap_cnt, rx_time, names, dict([(name + self.suffix, value) for name, value in values.items()]))
+        self._declared = True
+
+    def _reduce(self, item, value):
+        """Adds one dump to item's time accumulator. Returns True once time_avg dumps have been added."""
+        np.take(value, item['baselines'], axis = 1, out = item['sel'])
+        sel = item['sel']
+        np.sum(sel.reshape((sel.shape[0] // self.chan_avg, self.chan_avg) + sel.shape[1:]), axis = 1, out = item['chan_sum'])
+        if item['count'] == 0:
+            item['acc'][...] = item['chan_sum']
+        else:
+            item['acc'] += item['chan_sum']
+        item['count'] += 1
+        if item['count'] < self.time_avg:
+            return False
+        np.multiply(item['acc'], 1.0 / (self.time_avg * self.chan_avg), out = item['out'], casting = 'unsafe')
+        item['count'] = 0
+        return True
+
+    def heap(self, heap_cnt, rx_time, names, values):
+        out_names = []
+        out_values = {}
+        for name in names:
+            if name in self.items:
+                item = self.items[name]
+                if item['count'] == 0:
+                    ts_name = self._timestamp_name(name)
+                    item['timestamp'] = values[ts_name] if ts_name in names else None
+                if self._reduce(item, values[name]):
+                    out_names.append(name + self.suffix)
+                    out_values[name + self.suffix] = item['out']
+                    if item['timestamp'] is not None:
+                        out_names.append(self._timestamp_name(name) + self.suffix)
+                        out_values[self._timestamp_name(name) + self.suffix] = item['timestamp']
+                    self.n_dumps += 1
+            elif name in self.timestamps:
+                # sent along with the reduced dump
+                continue
+            elif not self.data_only:
+                out_names.append(name)
+                out_values[name] = values[name]
+        if len(out_names) > 0:
+            if not self._declared:
+                self._declare(heap_cnt, rx_time)
+            self.sink.heap(heap_cnt, rx_time, out_names, out_values)
+
+    def close(self):
+        self.logger.info('Stored %i reduced dumps (%i dumps and %i channels averaged).' % (self.n_dumps, self.time_avg, self.chan_avg))
+        self.sink.close()
+
+# one index record per item update in a raw capture
+RAW_INDEX_DTYPE = np.dtype([('heap_cnt', '<i8'), ('rx_time', '<f8'), ('item', '<u4'), ('pad', '<u4'), ('offset', '<u8'), ('nbytes', '<u8')])
+
+class RawSink(DumpSink):
+    """Appends the raw bytes of every item update to basename.raw, through a memory map that is grown grow_bytes at a time.
+        Each update gets a RAW_INDEX_DTYPE record in basename.idx, and the item descriptors are kept in basename.items (JSON).
+        Use RawReader or raw_to_h5 to read the capture back."""
+    def __init__(self, basename, grow_bytes = 256 << 20, logger = None):
+        self.logger = logger if logger != None else logging.getLogger('rx')
+        self.data_fn = basename + '.raw'
+        self.index_fn = basename + '.idx'
+        self.items_fn = basename + '.items'
+        self.grow_bytes = grow_bytes
+        open(self.data_fn, 'wb').close()
+        self.index_fh = open(self.index_fn, 'wb')
+        self.items = []
+        self.item_nos = {}
+        self.offset = 0
+        self.size = 0
+        self._mm = None
+        self._write_items()
+
+    def _write_items(self):
+        fh = open(self.items_fn, 'w')
+        json.dump([{'name': d['name'], 'id': d['id'], 'description': d['description'], 'shape': list(d['shape']), 'dtype': d['dtype'].str} for d in self.items], fh)
+        fh.close()
+
+    def _grow(self, need):
+        size = ((need + self.grow_bytes - 1) // self.grow_bytes) * self.grow_bytes
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        fh = open(self.data_fn, 'r+b')
+        fh.truncate(size)
+        fh.close()
+        self._mm = np.memmap(self.data_fn, dtype = np.uint8, mode = 'r+', shape = (size,))
+        self.size = size
+
+    def add_item(self, desc):
+        self.item_nos[desc['name']] = len(self.items)
+        self.items.append(dict(desc, dtype = np.dtype(desc['dtype'])))
+        self._write_items()
+
+    def heap(self, heap_cnt, rx_time, names, values):
+        records = np.zeros(len(names), dtype = RAW_INDEX_DTYPE)
+        for n, name in enumerate(names):
+            item_no = self.item_nos[name]
+            dtype = self.items[item_no]['dtype']
+            value = np.asarray(values[name]) if dtype.itemsize == 0 else np.asarray(values[name], dtype = dtype)
+            raw = np.ascontiguousarray(value).reshape(-1).view(np.uint8)
+            if self.offset + raw.nbytes > self.size:
+                self._grow(self.offset + raw.nbytes)
+            self._mm[self.offset:self.offset + raw.nbytes] = raw
+            records[n] = (heap_cnt, rx_time, item_no, 0, self.offset, raw.nbytes)
+            self.offset += raw.nbytes
+        self.index_fh.write(records.tobytes())
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        fh = open(self.data_fn, 'r+b')
+        fh.truncate(self.offset)
+        fh.close()
+        self.index_fh.close()
+        self._write_items()
+        self.logger.info("Closed raw capture %s after writing %i bytes." % (self.data_fn, self.offset))
+
+class RawReader:
+    """Reads back a capture made by RawSink."""
+    def __init__(self, basename):
+        fh = open(basename + '.items')
+        self.items = [dict(d, dtype = np.dtype(str(d['dtype']))) for d in json.load(fh)]
+        fh.close()
+        self.index = np.fromfile(basename + '.idx', dtype = RAW_INDEX_DTYPE)
+        self.data = np.memmap(basename + '.raw', dtype = np.uint8, mode = 'r') if self.index['nbytes'].sum() > 0 else np.zeros(0, dtype = np.uint8)
+
+    def value(self, record):
+        """The value of the item update described by an index record, as a read-only view onto the capture file."""
+        item = self.items[record['item']]
+        raw = self.data[int(record['offset']):int(record['offset']) + int(record['nbytes'])]
+        if item['dtype'].itemsize == 0 or (raw.nbytes % item['dtype'].itemsize) != 0:
+            return raw.tobytes()
+        value = raw.view(item['dtype'])
+        if value.size == int(np.prod(item['shape'])):
+            return value.reshape(item['shape'])
+        return value
+
+    def heaps(self):
+        """Yields (heap_cnt, rx_time, names, values) for every heap in the capture, in the form DumpSink.heap takes them."""
+        if len(self.index) == 0:
+            return
+        # index records of the same heap are consecutive
+        new_heap = np.ones(len(self.index), dtype = bool)
+        new_heap[1:] = (self.index['heap_cnt'][1:] != self.index['heap_cnt'][:-1]) | (self.index['rx_time'][1:] != self.index['rx_time'][:-1])
+        starts = np.append(np.flatnonzero(new_heap), len(self.index))
+        for h in range(len(starts) - 1):
+            records = self.index[starts[h]:starts[h + 1]]
+            names = [self.items[r['item']]['name'] for r in records]
+            yield int(records[0]['heap_cnt']), float(records[0]['rx_time']), names, dict([(name, self.value(r)) for name, r in zip(names, records)])
+
+def raw_to_h5(basename, filename, **kwargs):
+    """Converts a RawSink capture to an HDF5 file, as H5Sink would have written it. Keyword arguments are passed on to H5Writer."""
+    reader = RawReader(basename)
+    sink = H5Sink(filename, **kwargs)
+    for desc in reader.items:
+        sink.add_item(desc)
+    for heap_cnt, rx_time, names, values in reader.heaps():
+        sink.heap(heap_cnt, rx_time, names, values)
+    sink.close()
+    return len(reader.index)
@@ -4,6 +4,8 @@ is used to verify the data-flow through the packetization and readout system.
 Author: Aaron Parsons
 Modified: Jason Manley
 Revisions:
+2013-03-30  CorrSimulator sends center_freq, so that receivers get all the metadata they need
+2013-03-27  CorrSimulator: vectorised X engine dumps streamed as SPEAD heaps
 2010-07-30  JRM Merged with casper-correlator-0.1.1
 2008-02-08  JRM Neatening, removing redundant interfaces
 2007-10-29  JRM added addr_decode and addr_encode functions
@@ -12,7 +14,8 @@ Revisions:
 
 from __future__ import absolute_import
 from __future__ import print_function
-import struct, time, math
+import struct, time, math, socket
+import numpy
 from six.moves import range
 
 def xeng_encode(freq,n_xeng=8, n_chans=2048,adc_clk=600,ddc_decimation=4,ddc_mix_freq=0.25):
@@ -137,6 +140,11 @@ def decode_32bit(data):
     r_i = (data >> 31) & 1
     return i, j , stokes, r_i, freq
 
+def encode_32bit_array(i, j, stokes, r_i, chan):
+    """encode_32bit for numpy arrays (broadcast against each other)."""
+    i, j, stokes, r_i, chan = [numpy.asarray(x, dtype=numpy.uint32) for x in (i, j, stokes, r_i, chan)]
+    return (r_i << 31) | (stokes << 29) | (chan << 16) | ((i+1) << 8) | (j+1)
+
 class XEngine:
     def __init__(self, nant=8, nchan=2048, npol=4, id=0, pktlen=2048,
             engine_id=0, instance_id=0, instrument_id=3, start_t=0, intlen=1):
@@ -146,14 +154,13 @@ class XEngine:
         self.instrument_id = instrument_id
         self.t = start_t
         self.intlen = intlen
-        self.data = []
-        data = [encode_32bit(i,j,p, r_i, ch) \
-            for ch in range(engine_id,nchan,nant) \
-            for (i,j) in get_bl_order(nant) \
-            for p in range(npol) \
-            for r_i in [0,1] \
-        ]
-        self.data = struct.pack('%dI' % len(data), *data)
+        # (chan, baseline, pol, real/imag), built in one go
+        bls = numpy.array(get_bl_order(nant), dtype=numpy.uint32).reshape(1, -1, 1, 1, 2)
+        chans = numpy.arange(engine_id, nchan, nant, dtype=numpy.uint32).reshape(-1, 1, 1, 1)
+        pols = numpy.arange(npol, dtype=numpy.uint32).reshape(1, 1, -1, 1)
+        r_i = numpy.arange(2, dtype=numpy.uint32).reshape(1, 1, 1, -1)
+        data = encode_32bit_array(bls[..., 0], bls[..., 1], pols, r_i, chans)
+        self.data = data.astype(numpy.uint32).tobytes()
     def init_pkt(self):
         pkt = CorrPacket()
         pkt.packet_len = self.pktlen
@@ -179,45 +186,249 @@ class XEngine:
                 self.t += self.intlen
             else: c += 1
 
-#class CorrSimulator:
-#    def __init__(self, xengines=None, nant=8, nchan=2048, npol=4):
-#        if xengines is None: xengines = range(nant)
-#        self.xeng = xengines
-#        self.bls = get_bl_order(nant)
-#        self.nchan = nchan
-#        self.npol = npol
-#        data = n.zeros((len(self.bls), nchan/nant, npol, 2), dtype=n.uint32)
-#        for c,(i,j) in enumerate(self.bls): data[c,...] = ij2bl(i,j)
-#        ch = n.arange(0, nchan, nant, dtype=n.uint32)
-#        ch = n.left_shift(ch, 16)
-#        ch.shape = (1,nchan/nant,1,1)
-#        for c,pol in enumerate(range(npol)):
-#            data[:,:,c,...] = n.bitwise_or(data[:,:,c,...], (pol << 29))
-#        data[...,1] = n.bitwise_or(data[...,1], (1 << 31))
-#        self.data = data
-#    def get_pkt(self):
-#        """Generate data for a casper_n correlator.  Each data
-#        sample is encoded with the baseline, stokes, real/imag, frequency
-#        that it represents."""
-#        #while True:
-#        #    data = self.data.copy()
-#        #    for c in range(self.nchan/nant
-#        data = []
-#        # Loop through channels in X engine (spaced every n_ants channels)
-#        for coarse_chan in range(n_chans/n_ants):
-#            c = coarse_chan * n_ants + x_num
-#            # Loop through baseline order out of X engine
-#            for bl in bls:
-#                # Loop through stokes parameters
-#                for s in range(n_stokes):
-#                    # Real and imaginary components
-#                    for ri in (0, 1):
-#                        data.append(encode_32bit(bl, s, ri, c))
-#        fmt = '%s%dI' % (endian, len(data))
-#        return struct.pack(fmt, *data)
-#
-#        
-#
-##class PacketSimulator:
-##   def __init__(self, nant, nchan, npol):
+# SPEAD-64-48, as sent by the X engines: 16 bit item ids (with the immediate flag), 48 bit values/addresses
+SPEAD_HEADER = 0x5304020600000000
+SPEAD_ADDR_BYTES = 6
+SPEAD_IMMEDIATE = 1 << 63
+SPEAD_HEAP_CNT, SPEAD_HEAP_SIZE, SPEAD_HEAP_OFFSET, SPEAD_PAYLOAD_LENGTH, SPEAD_DESCRIPTOR, SPEAD_STREAM_CTRL = 0x1, 0x2, 0x3, 0x4, 0x5, 0x6
+SPEAD_NAME, SPEAD_DESCRIPTION, SPEAD_SHAPE, SPEAD_FORMAT, SPEAD_ID, SPEAD_DTYPE = 0x10, 0x11, 0x12, 0x13, 0x14, 0x15
+SPEAD_STREAM_STOP = 2
+
+def _spead_pointer(item_id, value, immediate):
+    return (SPEAD_IMMEDIATE if immediate else 0) | (item_id << 48) | (int(value) & ((1 << 48) - 1))
+
+def _spead_bytes(value):
+    if isinstance(value, bytes):
+        return numpy.frombuffer(value, dtype=numpy.uint8)
+    return numpy.ascontiguousarray(value).reshape(-1).view(numpy.uint8)
+
+class SpeadHeap:
+    """The packets of one SPEAD heap, built in a single buffer. immediates is a list of (id, value) and addressed a list
+        of (id, bytes or numpy array). Each packet carries at most max_payload bytes of the heap's payload and the item
+        pointers go in the first packet. set_heap_cnt() and set_immediate() change a built heap in place, so the same
+        buffer can be sent again as the next heap."""
+    def __init__(self, heap_cnt, immediates = [], addressed = [], max_payload = 8192):
+        payloads = [_spead_bytes(value) for item_id, value in addressed]
+        offsets = numpy.cumsum([0] + [len(p) for p in payloads])
+        payload = numpy.concatenate(payloads) if len(payloads) > 0 else numpy.zeros(0, dtype=numpy.uint8)
+        heap_size = len(payload)
+        item_pointers = [_spead_pointer(item_id, value, True) for item_id, value in immediates]
+        item_pointers += [_spead_pointer(item_id, offset, False) for (item_id, value), offset in zip(addressed, offsets)]
+        n_packets = max(1, int(math.ceil(float(heap_size) / max_payload)))
+        packet_offsets = numpy.arange(n_packets, dtype=numpy.uint64) * max_payload
+        lengths = numpy.minimum(heap_size - packet_offsets.astype(numpy.int64), max_payload).astype(numpy.uint64)
+        # header and the four standard item pointers of every packet
+        headers = numpy.zeros((n_packets, 5), dtype=numpy.uint64)
+        headers[:, 0] = SPEAD_HEADER | 4
+        headers[0, 0] = SPEAD_HEADER | (4 + len(item_pointers))
+        headers[:, 1] = _spead_pointer(SPEAD_HEAP_CNT, heap_cnt, True)
+        headers[:, 2] = _spead_pointer(SPEAD_HEAP_SIZE, heap_size, True)
+        headers[:, 3] = numpy.uint64(_spead_pointer(SPEAD_HEAP_OFFSET, 0, True)) | packet_offsets
+        headers[:, 4] = numpy.uint64(_spead_pointer(SPEAD_PAYLOAD_LENGTH, 0, True)) | lengths
+        first_len = 8 * (5 + len(item_pointers)) + int(lengths[0])
+        ends = numpy.cumsum(40 + lengths.astype(numpy.int64)) + 8 * len(item_pointers)
+        self.starts = numpy.concatenate(([0], ends[:-1]))
+        self.ends = ends
+        self.buffer = numpy.zeros(int(ends[-1]), dtype=numpy.uint8)
+        big = headers.astype('>u8').view(numpy.uint8).reshape(n_packets, 40)
+        # first packet: header, standard and item pointers, payload
+        self.buffer[0:40] = big[0]
+        self.buffer[40:40 + 8 * len(item_pointers)] = numpy.array(item_pointers, dtype='>u8').view(numpy.uint8)
+        self.buffer[40 + 8 * len(item_pointers):first_len] = payload[0:int(lengths[0])]
+        # the rest, all full size but maybe the last
+        n_full = (heap_size - int(lengths[0])) // max_payload if n_packets > 1 else 0
+        if n_full > 0:
+            rows = self.buffer[first_len:first_len + n_full * (40 + max_payload)].reshape(n_full, 40 + max_payload)
+            rows[:, 0:40] = big[1:1 + n_full]
+            rows[:, 40:] = payload[int(lengths[0]):int(lengths[0]) + n_full * max_payload].reshape(n_full, max_payload)
+        if n_packets > 1 + n_full:
+            start = int(self.starts[-1])
+            self.buffer[start:start + 40] = big[-1]
+            self.buffer[start + 40:] = payload[int(packet_offsets[-1]):]
+        self.n_bytes = heap_size
+        self._heap_cnt_at = self.starts + 8
+        self._immediate_at = dict([(item_id, 40 + 8 * n) for n, (item_id, value) in enumerate(immediates)])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def tobytes(self):
+        """The first packet, for single packet heaps such as descriptors."""
+        return self.buffer[self.starts[0]:self.ends[0]].tobytes()
+
+    def _set_pointer(self, positions, item_id, value):
+        word = numpy.array([_spead_pointer(item_id, value, True)], dtype='>u8').view(numpy.uint8)
+        index = numpy.asarray(positions).reshape(-1, 1) + numpy.arange(8)
+        self.buffer[index] = word
+
+    def set_heap_cnt(self, heap_cnt):
+        self._set_pointer(self._heap_cnt_at, SPEAD_HEAP_CNT, heap_cnt)
+
+    def set_immediate(self, item_id, value):
+        self._set_pointer(self._immediate_at[item_id], item_id, value)
+
+    def packets(self):
+        """Memory views of the packets, in order."""
+        view = memoryview(self.buffer)
+        return [view[int(start):int(end)] for start, end in zip(self.starts, self.ends)]
+
+def spead_descriptor(item_id, name, description, shape = [], dtype = None, fmt = None):
+    """Encodes a SPEAD item descriptor, for items of a numpy dtype or of a SPEAD format (a list of (type, bits))."""
+    shape_bytes = b''.join([b'\x00' + struct.pack('>Q', dim)[8 - SPEAD_ADDR_BYTES:] for dim in shape])
+    addressed = [(SPEAD_NAME, name.encode()), (SPEAD_DESCRIPTION, description.encode()), (SPEAD_SHAPE, shape_bytes)]
+    if dtype is not None:
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r}" % (numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), tuple(shape))
+        addressed.append((SPEAD_DTYPE, header.encode()))
+    else:
+        addressed.append((SPEAD_FORMAT, b''.join([t.encode() + struct.pack('>H', bits) for t, bits in fmt])))
+    return SpeadHeap(1, [(SPEAD_ID, item_id)], addressed, max_payload = 1 << 20).tobytes()
+
+class CorrSimulator:
+    """Simulates the output of a dual polarisation CASPER correlator's X engines.
+
+        Every input sees its own noise (noise_power per channel), a common noise signal (correlation times noise_power)
+        and any tones (a list of (channel, power)), the common parts delayed by the input's entry in delays (seconds).
+        The visibilities, accumulated over n_accs spectra and with the matching radiometer noise, are computed for all
+        channels and baselines at once in the X engines' baseline order (see corr_functions.Correlator.get_bl_order) and
+        scaled to 32 bit integers. n_noise dumps with independent noise are made up front and cycled through.
+
+        stream() sends them as SPEAD heaps laid out like the X engine output: per X engine xeng_raw<n>/timestamp<n> heaps
+        holding channels n::n_xeng for xeng_format 'inter', or a single xeng_raw/timestamp heap per dump for 'cont'."""
+    def __init__(self, n_ants = 8, n_chans = 1024, n_xeng = 8, xeng_format = 'inter', adc_clk = 800e6, n_accs = 4096,
+            noise_power = 1.0, correlation = 0.1, tones = [], delays = None, scale = None, n_noise = 4, seed = None, center_freq = None):
+        if n_chans % n_xeng != 0:
+            raise RuntimeError('%i channels cannot be split over %i X engines.' % (n_chans, n_xeng))
+        if xeng_format not in ['inter', 'cont']:
+            raise RuntimeError('Unknown X engine output format %s.' % xeng_format)
+        self.n_ants = n_ants
+        self.n_chans = n_chans
+        self.n_xeng = n_xeng
+        self.xeng_format = xeng_format
+        self.adc_clk = adc_clk
+        self.bandwidth = adc_clk / 2.0
+        # as for a wideband correlator
+        self.center_freq = float(center_freq) if center_freq != None else self.bandwidth / 2.0
+        self.n_accs = n_accs
+        self.int_time = n_accs * 2.0 * n_chans / adc_clk
+        # inputs are 2*ant (x) and 2*ant+1 (y); each antenna pair gives xx, yy, xy and yx
+        pairs = numpy.array(get_bl_order(n_ants), dtype=numpy.int64)
+        self.input_a = numpy.column_stack((2*pairs[:, 0], 2*pairs[:, 0]+1, 2*pairs[:, 0], 2*pairs[:, 0]+1)).reshape(-1)
+        self.input_b = numpy.column_stack((2*pairs[:, 1], 2*pairs[:, 1]+1, 2*pairs[:, 1]+1, 2*pairs[:, 1])).reshape(-1)
+        self.input_labels = ['%i%s' % (n // 2, 'xy'[n % 2]) for n in range(2 * n_ants)]
+        self.bls_ordering = [(self.input_labels[a], self.input_labels[b]) for a, b in zip(self.input_a, self.input_b)]
+        self.n_bls = len(self.input_a)
+        delays = numpy.zeros(2 * n_ants) if delays is None else numpy.asarray(delays, dtype=float)
+        # expected visibilities: common signal and tones with the baseline's delay, own noise on the autos
+        freqs = numpy.arange(n_chans) * (self.bandwidth / n_chans)
+        phase = numpy.exp(-2j * numpy.pi * freqs[:, numpy.newaxis] * (delays[self.input_a] - delays[self.input_b])[numpy.newaxis, :])
+        common = numpy.zeros(n_chans) + correlation * noise_power
+        for chan, power in tones:
+            common[chan] += power
+        auto = (self.input_a == self.input_b).astype(float)
+        self.model = common[:, numpy.newaxis] * phase + (1 - correlation) * noise_power * auto[numpy.newaxis, :]
+        # radiometer noise: sigma = sqrt(P_a P_b / n_accs) per complex sample
+        power = common + (1 - correlation) * noise_power
+        sigma = power[:, numpy.newaxis] * numpy.ones(self.n_bls) / numpy.sqrt(2.0 * n_accs)
+        self.scale = float(scale) if scale != None else float(n_accs)
+        rng = numpy.random.RandomState(seed)
+        self.dumps = numpy.zeros((n_noise, n_chans, self.n_bls, 2), dtype='>i4')
+        for n in range(n_noise):
+            noise = rng.standard_normal((2, n_chans, self.n_bls)) * sigma
+            # autos are real
+            noise[1][:, auto > 0] = 0
+            self.dumps[n, ..., 0] = numpy.round((self.model.real + noise[0]) * self.scale)
+            self.dumps[n, ..., 1] = numpy.round((self.model.imag + noise[1]) * self.scale)
+
+    def dump(self, n = 0):
+        """The n'th dump, an (n_chans x n_bls x 2) array of big endian int32 real/imaginary pairs."""
+        return self.dumps[n % len(self.dumps)]
+
+    def timestamp(self, n):
+        """Timestamp (ADC samples since sync) of the n'th dump."""
+        return int(round(n * self.int_time * self.adc_clk))
+
+    def descriptors(self, sync_time = 0):
+        """SpeadHeap describing all items, with the meta data values, as sent before the data."""
+        descs, immediates, addressed = [], [], []
+        u48, f64 = [('u', 48)], [('f', 64)]
+        for item_id, name, desc, value in [(0x1008, 'n_bls', 'Number of baselines.', self.n_bls),
+                (0x1009, 'n_chans', 'Number of frequency channels.', self.n_chans),
+                (0x100A, 'n_ants', 'Number of antennas.', self.n_ants),
+                (0x100B, 'n_xengs', 'Number of X engines.', self.n_xeng),
+                (0x1015, 'n_accs', 'Number of spectra accumulated per integration.', self.n_accs),
+                (0x1027, 'sync_time', 'Time of the last sync, in seconds since the Unix Epoch.', sync_time)]:
+            descs.append(spead_descriptor(item_id, name, desc, fmt = u48))
+            immediates.append((item_id, value))
+        for item_id, name, desc, value in [(0x1007, 'adc_clk', 'ADC sample rate in Hz.', self.adc_clk),
+                (0x1011, 'center_freq', 'Center frequency in Hz.', self.center_freq),
+                (0x1013, 'bandwidth', 'Bandwidth in Hz.', self.bandwidth),
+                (0x1016, 'int_time', 'Integration time in seconds.', self.int_time),
+                (0x1046, 'scale_factor_timestamp', 'Timestamp scaling factor.', self.adc_clk)]:
+            descs.append(spead_descriptor(item_id, name, desc, fmt = f64))
+            addressed.append((item_id, numpy.array([value], dtype='>f8')))
+        bls = numpy.array(self.bls_ordering, dtype='S%i' % max([len(l) for l in self.input_labels]))
+        descs.append(spead_descriptor(0x100C, 'bls_ordering', 'The X engine baseline output order.', bls.shape, dtype = bls.dtype))
+        addressed.append((0x100C, bls))
+        for name, item_id, shape in self._data_items():
+            descs.append(spead_descriptor(0x1600 + item_id, 'timestamp' + name, 'Timestamp of start of this integration, in ADC samples since sync.', fmt = u48))
+            descs.append(spead_descriptor(0x1800 + item_id, 'xeng_raw' + name, 'Raw X engine output.', shape, dtype = '>i4'))
+        return SpeadHeap(1, immediates, [(SPEAD_DESCRIPTOR, d) for d in descs] + addressed)
+
+    def _data_items(self):
+        """(name suffix, id offset, shape) of the data items."""
+        if self.xeng_format == 'cont':
+            return [('', 0, (self.n_chans, self.n_bls, 2))]
+        return [('%i' % x, x, (self.n_chans // self.n_xeng, self.n_bls, 2)) for x in range(self.n_xeng)]
+
+    def data_heaps(self, n = 0, max_payload = 8192):
+        """SpeadHeaps of the n'th noise dump, one per X engine (or one in all for 'cont')."""
+        dump = self.dump(n)
+        heaps = []
+        for name, x, shape in self._data_items():
+            data = dump if self.xeng_format == 'cont' else numpy.ascontiguousarray(dump[x::self.n_xeng])
+            heaps.append(SpeadHeap(2, [(0x1600 + x, 0)], [(0x1800 + x, data)], max_payload = max_payload))
+        return heaps
 
+    def stream(self, ip = '127.0.0.1', port = 7148, n_dumps = 10, speedup = 1.0, n_streams = 1, port_stride = 1,
+            max_payload = 8192, sync_time = None):
+        """Sends the descriptors, n_dumps dumps and an end of stream heap to ip:port. For n_streams > 1, X engine
+            heaps are spread over n_streams ports port_stride apart, as with one port per X engine board, and the
+            descriptors and end of stream go to all of them. Dumps are sent every int_time / speedup seconds, or as
+            fast as possible if speedup is 0 or None. Returns a dictionary of dumps, heaps, packets, bytes (of data),
+            elapsed time, bits_per_second and realtime (the achieved rate over the correlator's own)."""
+        sync_time = int(time.time()) if sync_time == None else sync_time
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        ports = [port + n * port_stride for n in range(n_streams)]
+        items = self._data_items()
+        # ring of prebuilt heaps, only the heap counter and timestamp change from dump to dump
+        ring = [self.data_heaps(n, max_payload) for n in range(len(self.dumps))]
+        dests = [(ip, ports[(x * n_streams) // len(items)]) for x in range(len(items))]
+        for dest in ports:
+            for packet in self.descriptors(sync_time).packets():
+                sock.sendto(packet, (ip, dest))
+        # give receivers a moment to size their buffers from the descriptors
+        time.sleep(0.1)
+        n_heaps, n_packets, n_bytes = 0, 0, 0
+        heap_cnt = 2
+        start = time.time()
+        for n in range(n_dumps):
+            if speedup:
+                ahead = start + n * self.int_time / speedup - time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+            for (name, x, shape), heap, dest in zip(items, ring[n % len(ring)], dests):
+                heap.set_heap_cnt(heap_cnt)
+                heap.set_immediate(0x1600 + x, self.timestamp(n))
+                for packet in heap.packets():
+                    sock.sendto(packet, dest)
+                heap_cnt += 1
+                n_heaps += 1
+                n_packets += len(heap)
+                n_bytes += heap.n_bytes
+        elapsed = max(time.time() - start, 1e-9)
+        stop = SpeadHeap(heap_cnt, [(SPEAD_STREAM_CTRL, SPEAD_STREAM_STOP)])
+        for dest in ports:
+            sock.sendto(stop.tobytes(), (ip, dest))
+        sock.close()
+        return {'dumps': n_dumps, 'heaps': n_heaps, 'packets': n_packets, 'bytes': n_bytes, 'elapsed': elapsed,
+            'bits_per_second': n_bytes * 8.0 / elapsed, 'realtime': n_dumps * self.int_time / elapsed}
@@ -4,11 +4,15 @@ Author: Paul Prozesky
 
 Revs:
 2012-01-09: JRM rx_snap now accepts fpga_ids instead of xeng core ids.
+2013-03-06:     get_adc_snapshots_synced captures all ADCs on the same PPS, in parallel.
+2013-03-08:     Vectorised 4-bit unpacking and F engine TX packet decoding.
+2013-03-11:     Vectorised X engine 10GbE RX and descramble snapshot decoding.
 
 """
 
 from __future__ import absolute_import
 import corr, numpy, time, construct, logging
+import six
 
 def snapshots_arm(fpgas, dev_names, man_trig, man_valid, offset, circular_capture):
     if offset >=0:
@@ -93,6 +97,126 @@ def snapshots_get(fpgas, dev_names, man_trig=False, man_valid=False, wait_period
 #   INCOMPLETE. use construct instead.
 
 
+def fields_to_arrays(parsed, names, dtype = numpy.uint64):
+    """Collects the named fields from a list of parsed snapshot entries (construct Containers) into numpy arrays, keyed on name."""
+    return dict([(name, numpy.array([entry[name] for entry in parsed], dtype = (numpy.bool_ if isinstance(parsed[0][name], bool) else dtype)) if len(parsed) > 0 else numpy.zeros(0, dtype = dtype)) for name in names])
+
+def unpack_fix4(words, bin_pt = 0):
+    """Unpacks an array of unsigned words (any width from uint8 to uint64) into signed 4-bit values, most significant nibble first.
+    Returns an array with an extra trailing axis of length (word bits / 4), as floats scaled by 2**-bin_pt if bin_pt is non-zero, or as int8 otherwise."""
+    words = numpy.asarray(words)
+    n_bytes = words.dtype.itemsize
+    as_bytes = words.astype(words.dtype.newbyteorder('>')).view(numpy.uint8).reshape(words.shape + (n_bytes,))
+    nibbles = numpy.empty(words.shape + (n_bytes, 2), dtype = numpy.uint8)
+    nibbles[..., 0] = as_bytes & 0xf0
+    nibbles[..., 1] = as_bytes << 4
+    # the nibble now sits in the top of a byte, so an arithmetic shift sign-extends it
+    rv = (nibbles.view(numpy.int8) >> 4).reshape(words.shape + (n_bytes * 2,))
+    if bin_pt != 0:
+        return rv / float(2**bin_pt)
+    return rv
+
+def bits_used(level, n_bits = 4):
+    """Number of bits used by signed n_bits values of the given (fractional, array) level. Levels below one LSb count as zero bits."""
+    level = numpy.asarray(level, dtype = float)
+    with numpy.errstate(divide = 'ignore'):
+        return numpy.where(level < 1.0 / (2**n_bits), 0, numpy.log2(level * (2**n_bits)))
+
+def feng_tx_packets_decode(words, eof, n_chans, bin_pt = 3, n_bits = 4):
+    """Splits a stream of 64-bit F engine XAUI/10GbE TX snapshot words into packets and computes per-packet statistics, using array operations only.
+    words and eof are equal-length arrays of the 64-bit data words and end-of-frame flags. The word following an EOF is taken as the next packet's header;
+    anything before the first EOF is discarded. Each data word holds four samples of {pol0 real, pol0 imag, pol1 real, pol1 imag} 4-bit values.
+    Returns a dictionary of per-packet arrays:
+        hdr_index, n_words, mcnt, ant, freq,
+        level (n_pkts x 4, RMS of each of pol0_r, pol0_i, pol1_r, pol1_i), rms (n_pkts x 2, per pol), pk (n_pkts x 2, peak per pol),
+        ave_bits_used (n_pkts x 4), pk_bits_used (n_pkts x 2)"""
+    words = numpy.asarray(words, dtype = numpy.uint64)
+    eof = numpy.asarray(eof, dtype = bool)
+    eof_idx = numpy.flatnonzero(eof)
+    hdr_idx = eof_idx[:-1] + 1
+    n_pkts = len(hdr_idx)
+    # packet k covers (eof_idx[k], eof_idx[k+1]]
+    pkt = numpy.cumsum(eof) - eof - 1
+    data_mask = (pkt >= 0) & (pkt < n_pkts)
+    data_mask[hdr_idx[hdr_idx < len(words)]] = False
+    pkt = pkt[data_mask]
+    n_words = numpy.bincount(pkt, minlength = n_pkts)
+
+    hdrs = words[hdr_idx]
+    mcnt = hdrs >> numpy.uint64(16)
+    ant = hdrs & numpy.uint64(0xffff)
+
+    vals = unpack_fix4(words[data_mask], bin_pt = bin_pt).reshape(-1, 4, 4)
+    sample_pkt = numpy.repeat(pkt, 4)
+    vals = vals.reshape(-1, 4)
+    n_samples = numpy.maximum(n_words * 4, 1)
+    level = numpy.sqrt(numpy.array([numpy.bincount(sample_pkt, weights = vals[:, v]**2, minlength = n_pkts) for v in range(4)]).T / n_samples[:, numpy.newaxis])
+    pk = numpy.zeros((n_pkts, 2))
+    numpy.maximum.at(pk[:, 0], sample_pkt, vals[:, 0:2].max(axis = 1))
+    numpy.maximum.at(pk[:, 1], sample_pkt, vals[:, 2:4].max(axis = 1))
+    return {'hdr_index': hdr_idx, 'n_words': n_words, 'mcnt': mcnt, 'ant': ant, 'freq': mcnt % numpy.uint64(n_chans),
+        'level': level, 'rms': numpy.sqrt(level[:, 0::2]**2 + level[:, 1::2]**2), 'pk': pk,
+        'ave_bits_used': bits_used(level, n_bits), 'pk_bits_used': bits_used(pk, n_bits)}
+
+def gbe_rx_words_unpack(raw):
+    """Unpacks raw snap_gbe_rx snapshot data (128-bit words, as described by snap_xengine_gbe_rx) straight into numpy arrays.
+    Returns a dictionary of arrays: data, ip_addr, led_up, led_rx, eof, bad_frame, overflow, valid, ack."""
+    words = numpy.frombuffer(raw, dtype = '>u8', count = (len(raw) // 16) * 2).reshape(-1, 2)
+    ctrl = words[:, 0].astype(numpy.uint64)
+    rv = {'data': words[:, 1].astype(numpy.uint64), 'ip_addr': ctrl & numpy.uint64(0xffffffff)}
+    for bit, name in enumerate(['ack', 'valid', 'overflow', 'bad_frame', 'eof', 'led_rx', 'led_up']):
+        rv[name] = ((ctrl >> numpy.uint64(32 + bit)) & numpy.uint64(1)).astype(bool)
+    return rv
+
+def xeng_rx_packets_decode(unpacked, n_chans, n_xeng, pkt_len = None, bin_pt = 3, n_bits = 4):
+    """Splits X engine 10GbE RX snapshot data (as returned by gbe_rx_words_unpack) into packets and computes per-packet statistics.
+    The capture is assumed to start on a packet boundary: the first word, and every word following an EOF, is a header.
+    Returns the per-packet arrays of feng_tx_packets_decode (pol0 is Q, pol1 is I), plus:
+        the header fields from corr_functions.decode_10gbe_headers (mcnt, antbase, timestamp, pcnt, freq_chan, x_eng),
+        eof_index, ip_addr (at the EOF), bad_frame, overflow and link_down (number of flagged words in each packet)
+        and bad_len (if pkt_len, the expected number of data words per packet, is given)."""
+    # prepend a dummy EOF so that the first word is taken as a header
+    words = numpy.concatenate((numpy.zeros(1, dtype = numpy.uint64), numpy.asarray(unpacked['data'], dtype = numpy.uint64)))
+    eof = numpy.concatenate(([True], unpacked['eof']))
+    rv = feng_tx_packets_decode(words, eof, n_chans, bin_pt = bin_pt, n_bits = n_bits)
+    rv['hdr_index'] = rv['hdr_index'] - 1
+    n_pkts = len(rv['hdr_index'])
+    eof_idx = numpy.flatnonzero(unpacked['eof'])[0:n_pkts]
+    rv['eof_index'] = eof_idx
+    rv['ip_addr'] = unpacked['ip_addr'][eof_idx]
+    rv.update(corr.corr_functions.decode_10gbe_headers(unpacked['data'][rv['hdr_index']], n_chans, n_xeng))
+    # packet number of every captured word, including headers and EOFs
+    pkt = numpy.cumsum(unpacked['eof']) - unpacked['eof']
+    in_pkt = pkt < n_pkts
+    for name, flags in [('bad_frame', unpacked['bad_frame']), ('overflow', unpacked['overflow']), ('link_down', ~unpacked['led_up'])]:
+        rv[name] = numpy.bincount(pkt[in_pkt], weights = flags[in_pkt], minlength = n_pkts).astype(int)
+    if pkt_len != None:
+        rv['bad_len'] = rv['n_words'] != pkt_len
+    return rv
+
+def descramble_words_unpack(raw):
+    """Unpacks raw snap_descramble snapshot data (32-bit words of 16 data bits, 13 mcnt bits and the valid, flag and received OOB bits) into numpy arrays.
+    Returns a dictionary of arrays: data, mcnt, valid, flag, received."""
+    words = numpy.frombuffer(raw, dtype = '>u4', count = len(raw) // 4).astype(numpy.uint32)
+    return {'data': (words >> 16).astype(numpy.uint16), 'mcnt': (words >> 3) & 0x1fff,
+        'valid': (words & 4) > 0, 'flag': (words & 2) > 0, 'received': (words & 1) > 0}
+
+def xeng_descramble_decode(unpacked, acc_len, n_ants, bin_pt = 3, n_bits = 4):
+    """Computes per-block statistics of X engine descramble snapshot data (as returned by descramble_words_unpack).
+    The data comes in blocks of acc_len 16-bit words, each holding one {polQ_r, polQ_i, polI_r, polI_i} 4-bit sample, with the antenna
+    incrementing every block. Incomplete blocks at the end of the capture are ignored. Returns a dictionary of per-block arrays:
+        index (of the block's first word), ant, mcnt (of the first word), level (n_blocks x 4), rms (n_blocks x 2, Q and I),
+        ave_bits_used (n_blocks x 4), rcvd_errs and flag_errs (number of words not received or flagged)."""
+    n_blocks = len(unpacked['data']) // acc_len
+    n_words = n_blocks * acc_len
+    vals = unpack_fix4(unpacked['data'][0:n_words], bin_pt = bin_pt).reshape(n_blocks, acc_len, 4)
+    level = numpy.sqrt((vals**2).mean(axis = 1)) if acc_len > 0 else numpy.zeros((0, 4))
+    index = numpy.arange(n_blocks) * acc_len
+    return {'index': index, 'ant': numpy.arange(n_blocks) % n_ants, 'mcnt': unpacked['mcnt'][index],
+        'level': level, 'rms': numpy.sqrt(level[:, 0::2]**2 + level[:, 1::2]**2), 'ave_bits_used': bits_used(level, n_bits),
+        'rcvd_errs': (~unpacked['received'][0:n_words]).reshape(n_blocks, acc_len).sum(axis = 1),
+        'flag_errs': unpacked['flag'][0:n_words].reshape(n_blocks, acc_len).sum(axis = 1)}
+
 def get_adc_snapshots(correlator, ant_strs = [], trig_level = -1, sync_to_pps = True):
     """Fetches multiple ADC snapshots from hardware. Set trig_level to negative value to disable triggered captures. Timestamps only valid if system is correctly sync'd!"""
     if correlator.config['adc_n_bits'] !=8:
@@ -133,6 +257,79 @@ def get_adc_snapshots(correlator, ant_strs = [], trig_level = -1, sync_to_pps =
 
     #return numpy.fromstring(self.ffpgas[ffpga_n].snapshot_get('adc_snap%i'%feng_input,man_trig=False,circular_capture=True,wait_period=-1)['data'],dtype=numpy.int8)
 
+def get_adc_snapshots_synced(correlator, ant_strs = None, wait_period = 3):
+    """Captures ADC snapshots from all the given antennas (default all inputs) on the same 1PPS edge.
+    All ADC snap blocks are armed in parallel half a second before the next PPS, and are read back in parallel once they've triggered.
+    Returns a dictionary with keys:
+        ant_strs: the list of antennas, in row order.
+        data: (n_inputs x n_samples) int8 array of samples, truncated to the shortest capture.
+        lengths: numpy array of the number of samples captured on each input.
+        mcnts: numpy array of the mcnt of the first sample on each input.
+        timestamps: numpy array of the unix time of the first sample on each input. Only valid if the system is correctly sync'd!"""
+    if correlator.config['adc_n_bits'] != 8:
+        raise RuntimeError('This function is hardcoded to work with 8 bit ADCs. According to your config file, yours is %i bits.' % correlator.config['adc_n_bits'])
+    if ant_strs == None:
+        ant_strs = correlator.config._get_ant_mapping_list()
+
+    fpgas = []
+    dev_names = {}
+    locations = []
+    for ant_str in ant_strs:
+        (ffpga_n, xfpga_n, fxaui_n, xxaui_n, feng_input) = correlator.get_ant_str_location(ant_str)
+        fpga = correlator.ffpgas[ffpga_n]
+        if fpga not in fpgas:
+            fpgas.append(fpga)
+            dev_names[fpga.host] = []
+        dev_names[fpga.host].append('adc_snap%i' % feng_input)
+        locations.append((fpga.host, 'adc_snap%i' % feng_input))
+
+    def arm_fpga(fpga):
+        for dev_name in dev_names[fpga.host]:
+            fpga.snapshot_arm(dev_name, man_trig = False, man_valid = False, offset = -1, circular_capture = False)
+        return True
+
+    def read_fpga(fpga):
+        rv = {}
+        for dev_name in dev_names[fpga.host]:
+            start_time = time.time()
+            while True:
+                addr = fpga.read_uint(dev_name + '_status')
+                if not bool(addr & 0x80000000):
+                    break
+                if (time.time() - start_time) > wait_period:
+                    raise RuntimeError('%s on %s did not trigger within %2.2f seconds. Check 1PPS.' % (dev_name, fpga.host, wait_period))
+                time.sleep(0.01)
+            length = addr & 0x7fffffff
+            if length == 0:
+                raise RuntimeError('%s on %s captured 0 bytes.' % (dev_name, fpga.host))
+            rv[dev_name] = {'length': length, 'data': fpga.read(dev_name + '_bram', length), 'val': fpga.read_uint(dev_name + '_val')}
+        return rv
+
+    # arm everything half a second before the next PPS so that all boards trigger on the same edge
+    time.sleep((1.5 - (time.time() % 1)) % 1)
+    init_mcnt = correlator.mcnt_current_get(ant_str = ant_strs[0])
+    for host, res in six.iteritems(corr.threaded.fpga_operation(fpgas, -1, arm_fpga)):
+        if isinstance(res, Exception):
+            raise res
+    results = corr.threaded.fpga_operation(fpgas, -1, read_fpga)
+    for host, res in six.iteritems(results):
+        if isinstance(res, Exception):
+            raise res
+
+    captures = [results[host][dev_name] for host, dev_name in locations]
+    lengths = numpy.array([cap['length'] for cap in captures])
+    data = numpy.empty((len(captures), lengths.min()), dtype = numpy.int8)
+    for n, cap in enumerate(captures):
+        data[n] = numpy.frombuffer(cap['data'], dtype = numpy.int8, count = data.shape[1])
+
+    # the _val registers hold the 32 LSbs of the trigger mcnt. They must be later than init_mcnt, so account for a single wrap.
+    vals = numpy.array([cap['val'] for cap in captures], dtype = numpy.uint64)
+    mcnts = (init_mcnt & 0xffffffff00000000) + vals + numpy.where(vals < (init_mcnt & 0xffffffff), numpy.uint64(0x100000000), numpy.uint64(0))
+    timestamps = correlator.config['sync_time'] + mcnts / float(correlator.config['mcnt_scale_factor'])
+    if mcnts.max() != mcnts.min():
+        logging.warning('get_adc_snapshots_synced: inputs triggered on different mcnts (spread of %i).' % (mcnts.max() - mcnts.min()))
+    return {'ant_strs': list(ant_strs), 'data': data, 'lengths': lengths, 'mcnts': mcnts, 'timestamps': timestamps}
+
 def get_quant_snapshot(correlator, ant_str, n_spectra = 1, man_trig = False, man_valid = False, wait_period = 2):
     """
     Fetches a quantiser snapshot from hardware for a single given antenna.
@@ -147,13 +344,9 @@ def get_quant_snapshot(correlator, ant_str, n_spectra = 1, man_trig = False, man
     while ns < n_spectra:
         if correlator.is_wideband():
             bram_dmp = fpga.snapshot_get('quant_snap%i' % feng_input, man_trig = man_trig, man_valid = man_valid, wait_period = wait_period)
-            pckd_8bit = numpy.fromstring(bram_dmp['data'], dtype = numpy.uint8)
-            for val in pckd_8bit:
-                # get the right 4 bit values:
-                r_bits = (val & ((2**8) - (2**4))) >> 4
-                i_bits = (val & ((2**4) - (2**0)))
-                # cast up to signed numbers:
-                unpacked_vals.append(float(((numpy.int8(r_bits << 4) >> 4))) + (1j * float(((numpy.int8(i_bits << 4) >> 4)))))
+            # each byte is a 4-bit real and 4-bit imaginary value
+            vals = unpack_fix4(numpy.frombuffer(bram_dmp['data'], dtype = numpy.uint8)).astype(float)
+            unpacked_vals.extend(vals[:, 0] + (1j * vals[:, 1]))
         elif correlator.is_narrowband():
             # the narrowband snap block may be shorter than one spectrum, so make sure we get enough data
             tempdata = []
@@ -209,14 +402,16 @@ def get_rx_snapshot(correlator, xfpgas = [], snapname = 'snap_rx0'):
         rv.append(v)
     return rv
 
-def get_gbe_rx_snapshot(correlator, xfpgas = [], snapname = 'snap_gbe_rx0'):
+def get_gbe_rx_snapshot(correlator, xfpgas = [], snapname = 'snap_gbe_rx0', as_arrays = False):
     """
     Takes a list of X-ENGINE fpgas and returns the contents of the snap_gbe_rx0 block for each of them in a list.
-    The list contents is a dictionary of the decoded data.
+    The list contents is a dictionary of the decoded data. If as_arrays is set, the data is a dictionary of numpy arrays from gbe_rx_words_unpack instead.
     """
     if xfpgas == []:
        xfpgas = correlator.xfpgas
     raw = snapshots_get(xfpgas, snapname, wait_period = 3, circular_capture = False, man_trig = False)
+    if as_arrays:
+        return [{'fpga_index': index, 'data': gbe_rx_words_unpack(d)} for index, d in enumerate(raw['data'])]
     if correlator.is_wideband():
         rx_bf = corr.corr_wb.snap_xengine_gbe_rx
     elif correlator.is_narrowband():
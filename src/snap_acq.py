@@ -0,0 +1,260 @@
+"""
+Continuous snapshot acquisition with a shared-memory history.
+
+A SnapAcquirer thread keeps re-arming a chosen set of snap blocks on one or more FPGAs at a fixed rate and stores every
+capture in a SnapRing: a fixed-size ring buffer of timestamped slots backed by a file (in /dev/shm by default), so that
+any number of other processes (plotting scripts, histogram tools, the katcp interface) can read the most recent captures
+without triggering the hardware again.
+
+Revs:
+2013-03-04  Initial. Ring buffer and acquisition thread.
+2013-03-30  Reuse existing ring files instead of truncating them under their readers. Log failures to store captures.
+2013-03-31  Rings with a new layout replace the old file by renaming. Rings opened for reading are cached.
+"""
+
+from __future__ import absolute_import
+import os, time, threading, logging, numpy
+import corr
+
+RING_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp'
+RING_MAGIC = b'CORRSNAP'
+
+_header_dtype = numpy.dtype([('magic', 'S8'), ('n_slots', '<u4'), ('slot_bytes', '<u4'), ('write_cnt', '<u8')])
+
+def _slot_dtype(slot_bytes):
+    return numpy.dtype([('seq', '<u8'), ('timestamp', '<f8'), ('length', '<u4'), ('offset', '<i4'), ('val', '<u4'), ('pad', '<u4'), ('data', 'u1', (slot_bytes,))])
+
+def ring_filename(host, dev_name, ring_dir = RING_DIR):
+    """Returns the path of the ring buffer file used for snap block dev_name on FPGA host."""
+    return os.path.join(ring_dir, 'corr_snap_%s_%s' % (host, dev_name))
+
+class SnapRing:
+    """A fixed-size ring of the last n_slots captures from a single snap block.
+        Slots hold the raw captured bytes along with the capture time, length, offset and (optional) _val register contents.
+        Only one process should write to a ring; any number of processes may open it for reading."""
+    def __init__(self, filename, n_slots = None, slot_bytes = None, create = False):
+        """Open an existing ring buffer, or make a new one if create is set (n_slots and slot_bytes are then required).
+            An existing ring file of the same layout is reused as it is, carrying on from its last capture. Otherwise the new ring is
+            made in a temporary file and renamed over the old one, so that readers that still have the old file mapped are not
+            disturbed (see replaced)."""
+        self.filename = filename
+        if create:
+            if n_slots == None or slot_bytes == None:
+                raise RuntimeError('Need n_slots and slot_bytes to create ring buffer %s.' % filename)
+            total = _header_dtype.itemsize + n_slots * _slot_dtype(slot_bytes).itemsize
+            if not self._layout_matches(filename, total, n_slots, slot_bytes):
+                tmp_filename = '%s.%i.tmp' % (filename, os.getpid())
+                fh = open(tmp_filename, 'w+b')
+                fh.truncate(total)
+                fh.close()
+                header = numpy.memmap(tmp_filename, dtype = _header_dtype, mode = 'r+', shape = (1,))
+                header['magic'] = RING_MAGIC
+                header['n_slots'] = n_slots
+                header['slot_bytes'] = slot_bytes
+                header['write_cnt'] = 0
+                header.flush()
+                del header
+                os.rename(tmp_filename, filename)
+            self._header = numpy.memmap(filename, dtype = _header_dtype, mode = 'r+', shape = (1,))
+            mode = 'r+'
+        else:
+            if not os.path.exists(filename):
+                raise RuntimeError('Ring buffer %s does not exist. Is the acquisition daemon running?' % filename)
+            self._header = numpy.memmap(filename, dtype = _header_dtype, mode = 'r', shape = (1,))
+            if self._header['magic'][0] != RING_MAGIC:
+                raise RuntimeError('%s is not a snapshot ring buffer.' % filename)
+            mode = 'r'
+        self._inode = os.stat(filename).st_ino
+        self.n_slots = int(self._header['n_slots'][0])
+        self.slot_bytes = int(self._header['slot_bytes'][0])
+        self._slots = numpy.memmap(filename, dtype = _slot_dtype(self.slot_bytes), mode = mode, offset = _header_dtype.itemsize, shape = (self.n_slots,))
+
+    @staticmethod
+    def _layout_matches(filename, total, n_slots, slot_bytes):
+        """Whether filename is already a ring of n_slots slots of slot_bytes (total bytes in all)."""
+        if not os.path.exists(filename) or os.path.getsize(filename) != total:
+            return False
+        header = numpy.fromfile(filename, dtype = _header_dtype, count = 1)
+        return len(header) == 1 and header['magic'][0] == RING_MAGIC and header['n_slots'][0] == n_slots and header['slot_bytes'][0] == slot_bytes
+
+    def replaced(self):
+        """True if the ring file has been replaced (by a writer starting with a different layout) since this ring was opened.
+            The old file stays readable, but gets no new captures: open the ring again to follow the new one."""
+        try:
+            return os.stat(self.filename).st_ino != self._inode
+        except OSError:
+            return True
+
+    def write_count(self):
+        """The total number of captures ever written to this ring."""
+        return int(self._header['write_cnt'][0])
+
+    def put(self, data, timestamp = None, offset = 0, val = 0):
+        """Store a capture (binary string) in the next slot, overwriting the oldest one."""
+        if len(data) > self.slot_bytes:
+            raise RuntimeError('Capture of %i bytes does not fit in ring slots of %i bytes.' % (len(data), self.slot_bytes))
+        cnt = self.write_count()
+        slot = self._slots[cnt % self.n_slots:(cnt % self.n_slots) + 1]
+        # seq of zero marks the slot as being rewritten so that readers can discard it
+        slot['seq'] = 0
+        slot['timestamp'] = time.time() if timestamp == None else timestamp
+        slot['length'] = len(data)
+        slot['offset'] = offset
+        slot['val'] = val
+        slot['data'][0, 0:len(data)] = numpy.frombuffer(data, dtype = numpy.uint8)
+        slot['seq'] = cnt + 1
+        self._header['write_cnt'] = cnt + 1
+
+    def get(self, n = 1):
+        """Returns up to the last n captures, newest first, as a list of dictionaries with keys seq, timestamp, length, offset, val and data."""
+        rv = []
+        cnt = self.write_count()
+        for seq in range(cnt, max(0, cnt - min(n, self.n_slots)), -1):
+            slot = self._slots[(seq - 1) % self.n_slots]
+            if slot['seq'] != seq:
+                # overwritten or being written while we looked
+                continue
+            length = int(slot['length'])
+            entry = {'seq': seq, 'timestamp': float(slot['timestamp']), 'length': length, 'offset': int(slot['offset']), 'val': int(slot['val']),
+                'data': slot['data'][0:length].tobytes()}
+            if self._slots[(seq - 1) % self.n_slots]['seq'] != seq:
+                continue
+            rv.append(entry)
+        return rv
+
+    def get_latest(self, newer_than = 0, timeout = -1):
+        """Returns the newest capture. If newer_than is given, wait up to timeout seconds (forever if negative) for a capture with a higher sequence number."""
+        start_time = time.time()
+        while self.write_count() <= newer_than:
+            if timeout >= 0 and (time.time() - start_time) > timeout:
+                raise RuntimeError('No new capture in %s after %2.2f seconds.' % (self.filename, timeout))
+            time.sleep(0.01)
+        rv = self.get(1)
+        if rv == []:
+            raise RuntimeError('Ring buffer %s is empty.' % self.filename)
+        return rv[0]
+
+    def close(self):
+        self._slots = None
+        self._header = None
+
+class SnapAcquirer(threading.Thread):
+    """Background thread that re-arms snap blocks every period seconds and stores the captures in per-device SnapRings.
+        devices is a list of (FpgaClient, snap_dev_name) tuples. Snap blocks on different FPGAs are captured in parallel.
+        Ring buffers are created on the first capture from each device, with slots the size of that first capture."""
+    def __init__(self, devices, period = 1.0, n_slots = 64, ring_dir = RING_DIR, man_trig = False, man_valid = False, circular_capture = False,
+                 get_extra_val = False, wait_period = 2, log_handler = None, log_level = logging.INFO):
+        if log_handler == None:
+            log_handler = corr.log_handlers.DebugLogHandler(100)
+        self.log_handler = log_handler
+        self.logger = logging.getLogger('snap_acq')
+        self.logger.addHandler(self.log_handler)
+        self.logger.setLevel(log_level)
+
+        self.period = period
+        self.n_slots = n_slots
+        self.ring_dir = ring_dir
+        self.snap_kwargs = {'man_trig': man_trig, 'man_valid': man_valid, 'circular_capture': circular_capture,
+            'get_extra_val': get_extra_val, 'wait_period': wait_period}
+        self.fpgas = []
+        self.dev_names = {}
+        for fpga, dev_name in devices:
+            if fpga not in self.fpgas:
+                self.fpgas.append(fpga)
+                self.dev_names[fpga.host] = []
+            self.dev_names[fpga.host].append(dev_name)
+        self.rings = {}
+        self.n_captures = 0
+        self.n_errors = 0
+        self._stop_event = threading.Event()
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def _get_ring(self, host, dev_name, slot_bytes):
+        key = (host, dev_name)
+        if key not in self.rings:
+            filename = ring_filename(host, dev_name, self.ring_dir)
+            self.logger.info('Creating %i slot ring buffer %s for %i byte captures.' % (self.n_slots, filename, slot_bytes))
+            self.rings[key] = SnapRing(filename, n_slots = self.n_slots, slot_bytes = slot_bytes, create = True)
+        return self.rings[key]
+
+    def capture(self):
+        """Triggers and reads back every configured snap block once, storing the results. Returns the number of failed captures."""
+        snap_kwargs = self.snap_kwargs
+        dev_names = self.dev_names
+        def capture_fpga(fpga):
+            rv = []
+            for dev_name in dev_names[fpga.host]:
+                try:
+                    snap = fpga.snapshot_get(dev_name, **snap_kwargs)
+                    snap['timestamp'] = time.time()
+                except Exception as exc:
+                    snap = RuntimeError('%s on %s: %s' % (dev_name, fpga.host, exc))
+                rv.append(snap)
+            return rv
+        results = corr.threaded.fpga_operation(self.fpgas, -1, capture_fpga)
+        errors = 0
+        for fpga in self.fpgas:
+            res = results.get(fpga.host, RuntimeError('No capture result from %s.' % fpga.host))
+            if isinstance(res, Exception):
+                res = [res for d in dev_names[fpga.host]]
+            for dev_name, snap in zip(dev_names[fpga.host], res):
+                if isinstance(snap, Exception):
+                    self.logger.error('Capture failed: %s' % snap)
+                    errors += 1
+                    continue
+                try:
+                    ring = self._get_ring(fpga.host, dev_name, snap['length'])
+                    ring.put(snap['data'], timestamp = snap['timestamp'], offset = snap['offset'], val = snap.get('val', 0))
+                except Exception as exc:
+                    self.logger.error('Storing capture of %s on %s failed: %s' % (dev_name, fpga.host, exc))
+                    errors += 1
+        self.n_captures += 1
+        self.n_errors += errors
+        return errors
+
+    def run(self):
+        self.logger.info('Starting snapshot acquisition on %i FPGAs every %2.2f seconds.' % (len(self.fpgas), self.period))
+        while not self._stop_event.is_set():
+            start_time = time.time()
+            self.capture()
+            self._stop_event.wait(max(0, self.period - (time.time() - start_time)))
+        self.logger.info('Stopped snapshot acquisition after %i captures (%i errors).' % (self.n_captures, self.n_errors))
+
+    def stop(self):
+        """Ask the acquisition thread to stop after the current capture."""
+        self._stop_event.set()
+
+def adc_snap_devices(correlator, ant_strs = None):
+    """Returns the list of (fpga, snap_dev_name) tuples for the ADC snap blocks of the given antennas (default all)."""
+    if ant_strs == None:
+        ant_strs = correlator.config._get_ant_mapping_list()
+    rv = []
+    for ant_str in ant_strs:
+        (ffpga_n, xfpga_n, fxaui_n, xxaui_n, feng_input) = correlator.get_ant_str_location(ant_str)
+        rv.append((correlator.ffpgas[ffpga_n], 'adc_snap%i' % feng_input))
+    return rv
+
+# rings opened for reading by ring_open, by filename
+_rings = {}
+
+def ring_open(filename):
+    """Returns a SnapRing open for reading on filename, reusing the one opened by an earlier call unless the file has been
+        replaced since."""
+    ring = _rings.get(filename)
+    if ring == None or ring.replaced():
+        ring = _rings[filename] = SnapRing(filename)
+    return ring
+
+def get_adc_snapshot_ring(correlator, ant_str, newer_than = 0, timeout = -1, ring_dir = RING_DIR):
+    """Reads the most recent ADC snapshot for ant_str from the acquisition daemon's ring buffer, in the same form as snap.get_adc_snapshots.
+        If the ring has been replaced since the last call, newer_than is ignored, as the new ring's sequence numbers start again."""
+    (ffpga_n, xfpga_n, fxaui_n, xxaui_n, feng_input) = correlator.get_ant_str_location(ant_str)
+    filename = ring_filename(correlator.fsrvs[ffpga_n], 'adc_snap%i' % feng_input, ring_dir)
+    old_ring = _rings.get(filename)
+    ring = ring_open(filename)
+    if old_ring != None and ring is not old_ring:
+        newer_than = 0
+    entry = ring.get_latest(newer_than = newer_than, timeout = timeout)
+    return {'data': numpy.frombuffer(entry['data'], dtype = numpy.int8), 'offset': entry['offset'], 'length': entry['length'],
+        'timestamp': entry['timestamp'], 'seq': entry['seq']}
@@ -0,0 +1,88 @@
+"""
+Rebuilds spectra from decoded snapshot data.
+
+The snap scripts (corr_snap_feng_out_build_spectrum, corr_nb_build_ct_spectrum, corr_snap_quant, corr_snap_fft_output)
+all reduce snapshot captures to a per-channel level and accumulate those over successive captures. SpectrumAccumulator does
+the accumulation for any number of inputs at once, scattering values into channels with numpy.bincount, and the functions
+below turn the different kinds of snapshot data into (input, channel, value) arrays for it.
+
+Revs:
+2013-03-08  Initial.
+"""
+
+from __future__ import absolute_import
+import numpy
+import corr
+
+class SpectrumAccumulator:
+    """Accumulates values into an (n_inputs x n_chans) spectrum, keeping a count of the values added to each channel so that
+    partial captures (eg snap blocks shorter than a spectrum) can be averaged correctly."""
+    def __init__(self, n_chans, n_inputs = 1):
+        self.n_chans = n_chans
+        self.n_inputs = n_inputs
+        self.reset()
+
+    def reset(self):
+        """Clear all accumulated data."""
+        self.sums = numpy.zeros((self.n_inputs, self.n_chans))
+        self.counts = numpy.zeros((self.n_inputs, self.n_chans), dtype = numpy.int64)
+
+    def add(self, values, chans, inputs = 0):
+        """Add values (any shape) to the channels given by the matching chans array, for the input(s) given by inputs (scalar or matching array)."""
+        values = numpy.asarray(values, dtype = float).ravel()
+        chans = numpy.asarray(chans, dtype = numpy.int64)
+        inputs = numpy.broadcast_to(numpy.asarray(inputs, dtype = numpy.int64), chans.shape).ravel()
+        chans = chans.ravel()
+        if values.shape != chans.shape:
+            raise RuntimeError('Got %i values but %i channel indices.' % (values.size, chans.size))
+        if chans.size > 0 and ((chans.min() < 0) or (chans.max() >= self.n_chans) or (inputs.min() < 0) or (inputs.max() >= self.n_inputs)):
+            raise RuntimeError('Channel or input index out of range for a %i input, %i channel spectrum.' % (self.n_inputs, self.n_chans))
+        flat = inputs * self.n_chans + chans
+        size = self.n_inputs * self.n_chans
+        self.sums += numpy.bincount(flat, weights = values, minlength = size).reshape(self.sums.shape)
+        self.counts += numpy.bincount(flat, minlength = size).reshape(self.counts.shape)
+
+    def add_spectra(self, spectra, inputs = 0):
+        """Add whole spectra: an (..., n_chans) array, where all leading axes are summed. inputs selects the row(s) to add to,
+        either a scalar or an array matching the leading axes."""
+        spectra = numpy.asarray(spectra, dtype = float)
+        if spectra.shape[-1] != self.n_chans:
+            raise RuntimeError('Expected spectra of %i channels, got %i.' % (self.n_chans, spectra.shape[-1]))
+        chans = numpy.broadcast_to(numpy.arange(self.n_chans), spectra.shape)
+        inputs = numpy.asarray(inputs)
+        if inputs.ndim > 0:
+            inputs = inputs.reshape(inputs.shape + (1,))
+        self.add(spectra, chans, numpy.broadcast_to(inputs, spectra.shape))
+
+    def mean(self):
+        """The average value in each channel. Channels that received no data are zero."""
+        return self.sums / numpy.maximum(self.counts, 1)
+
+    def coverage(self):
+        """Boolean (n_inputs x n_chans) array of the channels that have received data."""
+        return self.counts > 0
+
+def feng_tx_spectrum_add(acc, decoded, pol_inputs = (0, 1)):
+    """Adds the per-packet RMS levels from snap.feng_tx_packets_decode to accumulator acc, at each packet's frequency.
+    pol_inputs gives the accumulator rows to use for the two polarisations."""
+    freqs = decoded['freq'].astype(numpy.int64)
+    for pol, input_n in enumerate(pol_inputs):
+        acc.add(decoded['rms'][:, pol], freqs, input_n)
+
+def ct_spectrum_add(acc, words, fchan_lookup, words_per_chan, n_bits = 4, pol_inputs = (0, 1)):
+    """Adds the mean amplitude per channel of narrowband corner-turner snapshot data to accumulator acc.
+    words is an array of 32-bit snap words, each holding two samples of each of two pols as {p0_r, p0_i, p1_r, p1_i, p0_r, p0_i, p1_r, p1_i} 4-bit values.
+    Every words_per_chan consecutive words are one frequency channel; fchan_lookup maps the n'th such block to its channel number."""
+    words = numpy.asarray(words, dtype = numpy.uint32)
+    n_fchans = len(words) // words_per_chan
+    vals = corr.snap.unpack_fix4(words[0:n_fchans * words_per_chan], bin_pt = n_bits - 1).reshape(n_fchans, words_per_chan * 2, 4)
+    chans = numpy.asarray(fchan_lookup)[0:n_fchans]
+    for pol, input_n in enumerate(pol_inputs):
+        amp = numpy.abs(vals[:, :, pol * 2] + (1j * vals[:, :, pol * 2 + 1])).mean(axis = 1)
+        acc.add(amp, chans, input_n)
+    return chans
+
+def fft_to_power(vals):
+    """Power of complex snapshot values (eg quantiser or FFT outputs)."""
+    vals = numpy.asarray(vals)
+    return vals.real**2 + vals.imag**2
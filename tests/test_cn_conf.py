@@ -0,0 +1,31 @@
+"""Checks that the shipped config file, and variations of its optional receiver settings, can be parsed."""
+
+from __future__ import absolute_import
+import os, re
+import pytest
+
+pytest.importorskip('iniparse')
+cn_conf = pytest.importorskip('corr.cn_conf')
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'etc', 'default')
+
+def _config_copy(tmp_path, stride = None):
+    """Copy of etc/default, with rx_udp_port_stride set to stride if given (it is commented out in the shipped file)."""
+    text = open(DEFAULT_CONFIG).read()
+    if stride is not None:
+        text = re.sub(r'(?m)^#\s*rx_udp_port_stride\s*=.*$', 'rx_udp_port_stride = %s' % stride, text)
+    filename = str(tmp_path / 'default')
+    open(filename, 'w').write(text)
+    return filename
+
+def test_default_config():
+    conf = cn_conf.CorrConf(DEFAULT_CONFIG)
+    assert conf['rx_udp_port_stride'] == 0
+    assert conf['n_ants'] > 0
+
+def test_rx_udp_port_stride(tmp_path):
+    assert cn_conf.CorrConf(_config_copy(tmp_path, 2))['rx_udp_port_stride'] == 2
+
+def test_rx_udp_port_stride_malformed(tmp_path):
+    with pytest.raises(ValueError):
+        cn_conf.CorrConf(_config_copy(tmp_path, 'two'))
@@ -0,0 +1,31 @@
+"""Checks that the correlator simulator's output carries everything CorrRx needs to store dumps and feed the signal displays."""
+
+from __future__ import absolute_import
+import pytest
+
+spead2 = pytest.importorskip('spead2')
+import spead2.recv
+rx = pytest.importorskip('corr.rx')
+sim = pytest.importorskip('corr.sim')
+
+def _decode(heaps):
+    """Decodes SpeadHeaps with spead2, returning the item group holding the last value of every item."""
+    stream = spead2.recv.Stream(spead2.ThreadPool())
+    stream.add_buffer_reader(b''.join([bytes(packet) for heap in heaps for packet in heap.packets()]))
+    ig = spead2.ItemGroup()
+    for heap in stream:
+        ig.update(heap)
+    return ig
+
+@pytest.mark.parametrize('xeng_format', ['inter', 'cont'])
+def test_required_metadata(xeng_format):
+    s = sim.CorrSimulator(n_ants = 4, n_chans = 64, n_xeng = 4, xeng_format = xeng_format, n_noise = 1, seed = 1)
+    ig = _decode([s.descriptors()] + s.data_heaps(0))
+    missing = [name for name in rx.SD_META if name not in ig or ig[name].value is None]
+    assert missing == []
+    assert ig['n_chans'].value == s.n_chans
+    assert ig['n_bls'].value == s.n_bls
+    assert ig['n_xengs'].value == s.n_xeng
+    assert ig['center_freq'].value == s.center_freq
+    assert ig['bandwidth'].value == s.bandwidth
+    assert len(ig['bls_ordering'].value) == s.n_bls